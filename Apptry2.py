@@ -4,10 +4,29 @@
 # Run: python HealthyMe_Pharmacy.py
 # Then open http://127.0.0.1:5000 in your browser
 
-from flask import Flask, jsonify, request
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, Text
+from flask import Flask, jsonify, request, send_file, abort
+from werkzeug.utils import safe_join
+from sqlalchemy import create_engine, inspect, Column, Integer, String, Float, Boolean, Text, Date, DateTime, UniqueConstraint, Index
+from sqlalchemy import update
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
+from sqlalchemy.sql import text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from PIL import Image, ImageOps
+from collections import Counter
+from datetime import date, datetime, timedelta
+import click
+import csv
+import hashlib
+import heapq
+import json
+import math
 import os
+import re
+import sqlite3
+import threading
+import time
+import urllib.request
+import uuid
 
 app = Flask(__name__)
 
@@ -27,11 +46,159 @@ class Medicine(Base):
     stock = Column(Integer, default=0)
     liked = Column(Boolean, default=False)
     image = Column(String(300))
+    form = Column(String(30))
+    # normalized salts+strengths+form, e.g. "amoxicillin:500mg|clavulanic acid:125mg@tablet"
+    composition_key = Column(String(300))
+    # units held by open carts (sum of StockHold.qty); available = stock - reserved
+    reserved = Column(Integer, nullable=False, default=0)
+    # cheapest in-stock medicines with the same composition come straight off this index
+    __table_args__ = (Index('ix_medicines_substitutes', 'composition_key', 'price', sqlite_where=stock > 0),)
+
+# One salt (active ingredient at a strength) of a medicine's composition
+class MedicineSalt(Base):
+    __tablename__ = 'medicine_salts'
+    medicine_id = Column(Integer, primary_key=True)
+    salt = Column(String(100), primary_key=True)
+    strength = Column(String(30), nullable=False, default='')
+
+# Received batch of a medicine; Medicine.stock is kept equal to the sum of its batches' qty
+class StockBatch(Base):
+    __tablename__ = 'stock_batches'
+    id = Column(Integer, primary_key=True)
+    medicine_id = Column(Integer, nullable=False)
+    batch_no = Column(String(50), nullable=False)
+    expiry = Column(Date, nullable=False)
+    qty = Column(Integer, nullable=False, default=0)
+    received_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        UniqueConstraint('medicine_id', 'batch_no'),
+        # FEFO allocation and the near-expiry report only ever look at batches with stock left
+        Index('ix_stock_batches_fefo', 'medicine_id', 'expiry', 'id', sqlite_where=qty > 0),
+        Index('ix_stock_batches_expiry', 'expiry', sqlite_where=qty > 0),
+    )
+
+# Which batch each sold unit came from (ref is e.g. "pos:<sale id>:<line>" or "checkout:<order ref>")
+class StockAllocation(Base):
+    __tablename__ = 'stock_allocations'
+    id = Column(Integer, primary_key=True)
+    ref = Column(String(80), nullable=False, index=True)
+    batch_id = Column(Integer, nullable=False)
+    qty = Column(Integer, nullable=False)
+
+# Units of a medicine held for a shopper's cart until expires_at
+class StockHold(Base):
+    __tablename__ = 'stock_holds'
+    id = Column(Integer, primary_key=True)
+    cart_id = Column(String(36), nullable=False)
+    medicine_id = Column(Integer, nullable=False)
+    qty = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    __table_args__ = (UniqueConstraint('cart_id', 'medicine_id'),)
+
+# Branch store; its stock is kept per medicine in StoreStock, separate from the online pool in Medicine.stock
+class Store(Base):
+    __tablename__ = 'stores'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(150), nullable=False, unique=True)
+    address = Column(Text)
+    lat = Column(Float, nullable=False)
+    lng = Column(Float, nullable=False)
+
+class StoreStock(Base):
+    __tablename__ = 'store_stock'
+    store_id = Column(Integer, primary_key=True)
+    medicine_id = Column(Integer, primary_key=True)
+    qty = Column(Integer, nullable=False, default=0)
+
+# Barcode printed on a medicine's pack; a medicine can have several (pack sizes, suppliers)
+class MedicineBarcode(Base):
+    __tablename__ = 'medicine_barcodes'
+    barcode = Column(String(32), primary_key=True)
+    medicine_id = Column(Integer, nullable=False, index=True)
+
+# Sale rung up on a counter terminal; sale_id is generated on the terminal so re-sent syncs are harmless
+class PosSale(Base):
+    __tablename__ = 'pos_sales'
+    sale_id = Column(String(36), primary_key=True)
+    terminal = Column(String(50), nullable=False)
+    sold_at = Column(DateTime, nullable=False)
+    received_at = Column(DateTime, default=datetime.utcnow)
+    total = Column(Float, nullable=False)
+    status = Column(String(20), nullable=False)
+
+class PosSaleLine(Base):
+    __tablename__ = 'pos_sale_lines'
+    sale_id = Column(String(36), primary_key=True)
+    line_no = Column(Integer, primary_key=True)
+    medicine_id = Column(Integer, nullable=False)
+    qty = Column(Integer, nullable=False)
+    price = Column(Float, nullable=False)
+
+# Stock discrepancy found while applying an offline sale, for staff to reconcile
+class PosConflict(Base):
+    __tablename__ = 'pos_conflicts'
+    id = Column(Integer, primary_key=True)
+    sale_id = Column(String(36), nullable=False, index=True)
+    medicine_id = Column(Integer)
+    requested = Column(Integer, nullable=False)
+    available = Column(Integer, nullable=False)
+    reason = Column(String(50), nullable=False)
+    resolved = Column(Boolean, default=False)
+
+# Bumped whenever the data behind an in-memory index changes, so the server reloads it
+class IndexVersion(Base):
+    __tablename__ = 'index_versions'
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+# Active ingredients of a medicine (lower-cased, single-spaced)
+class MedicineIngredient(Base):
+    __tablename__ = 'medicine_ingredients'
+    medicine_id = Column(Integer, primary_key=True)
+    ingredient = Column(String(100), primary_key=True)
+
+# Known interaction between two ingredients, stored once with ingredient_a < ingredient_b
+class Interaction(Base):
+    __tablename__ = 'interactions'
+    id = Column(Integer, primary_key=True)
+    ingredient_a = Column(String(100), nullable=False)
+    ingredient_b = Column(String(100), nullable=False)
+    severity = Column(String(20), nullable=False, default='moderate')
+    note = Column(String(300))
+    __table_args__ = (UniqueConstraint('ingredient_a', 'ingredient_b'),)
 
 engine = create_engine("sqlite:///database.db", echo=False)
 Base.metadata.create_all(engine)
 Session = sessionmaker(bind=engine)
 
+def upgrade_schema(engine):
+    """create_all() never touches existing tables: add any newer columns and indexes to them."""
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    conn.execute(text(f'ALTER TABLE {quote(table.name)} ADD COLUMN '
+                                      f'{quote(column.name)} {column.type.compile(engine.dialect)}'))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+upgrade_schema(engine)
+
+# Batches for stock that predates batch tracking: expiry unknown, so they are allocated last
+UNTRACKED_BATCH = 'UNTRACKED'
+UNTRACKED_EXPIRY = date(9999, 12, 31)
+
+def backfill_untracked_batches(engine):
+    with engine.begin() as conn:
+        conn.execute(text('UPDATE medicines SET reserved = 0 WHERE reserved IS NULL'))
+        conn.execute(text('INSERT INTO stock_batches (medicine_id, batch_no, expiry, qty, received_at) '
+                          'SELECT m.id, :batch_no, :expiry, m.stock, CURRENT_TIMESTAMP FROM medicines m '
+                          'WHERE m.stock > 0 AND NOT EXISTS (SELECT 1 FROM stock_batches b WHERE b.medicine_id = m.id)'),
+                     {'batch_no': UNTRACKED_BATCH, 'expiry': UNTRACKED_EXPIRY})
+
 # Add sample data if database empty
 session = Session()
 if not session.query(Medicine).first():
@@ -43,6 +210,824 @@ if not session.query(Medicine).first():
     session.add_all(meds)
     session.commit()
 session.close()
+backfill_untracked_batches(engine)
+
+
+def index_version(session, name):
+    row = session.get(IndexVersion, name)
+    return row.version if row else 0
+
+def bump_index_version(session, name):
+    row = session.get(IndexVersion, name)
+    if row is None:
+        row = IndexVersion(name=name, version=0)
+        session.add(row)
+    row.version += 1
+
+
+# -----------------------------
+# DRUG INTERACTIONS
+# -----------------------------
+SEVERITY_RANK = {'major': 0, 'moderate': 1, 'minor': 2}
+
+def normalize_ingredient(name):
+    return ' '.join(name.lower().split())
+
+class InteractionIndex:
+    """Ingredient adjacency map plus each medicine's ingredient set, compiled from the tables."""
+    def __init__(self, version=0):
+        self.version = version
+        self.adjacent = {}
+        self.ingredients = {}
+
+    def add_interaction(self, a, b, severity, note):
+        self.adjacent.setdefault(a, {})[b] = (severity, note)
+        self.adjacent.setdefault(b, {})[a] = (severity, note)
+
+    def check(self, medicine_id, other_ids):
+        """Warnings for adding medicine_id to a cart that already holds other_ids."""
+        warnings = []
+        for ingredient in self.ingredients.get(medicine_id, ()):
+            neighbours = self.adjacent.get(ingredient)
+            if not neighbours:
+                continue
+            for other_id in other_ids:
+                if other_id == medicine_id:
+                    continue
+                for other_ingredient in self.ingredients.get(other_id, ()):
+                    hit = neighbours.get(other_ingredient)
+                    if hit:
+                        warnings.append({'medicine_id': medicine_id, 'other_id': other_id,
+                                         'ingredients': [ingredient, other_ingredient],
+                                         'severity': hit[0], 'note': hit[1]})
+        return warnings
+
+    def check_all(self, medicine_ids):
+        """Warnings for a whole cart, checking each line only against the lines before it."""
+        warnings = []
+        for position, medicine_id in enumerate(medicine_ids):
+            warnings.extend(self.check(medicine_id, medicine_ids[:position]))
+        warnings.sort(key=lambda w: SEVERITY_RANK.get(w['severity'], len(SEVERITY_RANK)))
+        return warnings
+
+_interactions = None
+
+def interaction_index(session):
+    global _interactions
+    version = index_version(session, 'interactions')
+    if _interactions is None or _interactions.version != version:
+        index = InteractionIndex(version=version)
+        for it in session.query(Interaction):
+            index.add_interaction(it.ingredient_a, it.ingredient_b, it.severity, it.note)
+        ingredients = {}
+        for medicine_id, ingredient in session.query(MedicineIngredient.medicine_id, MedicineIngredient.ingredient):
+            ingredients.setdefault(medicine_id, set()).add(ingredient)
+        index.ingredients = {m: frozenset(i) for m, i in ingredients.items()}
+        _interactions = index
+    return _interactions
+
+def describe_interactions(session, warnings):
+    """Attach medicine names to warnings for display."""
+    ids = {w['medicine_id'] for w in warnings} | {w['other_id'] for w in warnings}
+    names = dict(session.query(Medicine.id, Medicine.name).filter(Medicine.id.in_(ids))) if ids else {}
+    for w in warnings:
+        w['medicine'] = names.get(w['medicine_id'], '?')
+        w['other'] = names.get(w['other_id'], '?')
+    return warnings
+
+@app.cli.command('import-interactions')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_interactions_command(path):
+    """Load ingredient interactions from a CSV with ingredient_a,ingredient_b,severity,note columns."""
+    session = Session()
+    count = 0
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            a, b = sorted((normalize_ingredient(row['ingredient_a']), normalize_ingredient(row['ingredient_b'])))
+            severity = (row.get('severity') or 'moderate').strip().lower()
+            stmt = sqlite_insert(Interaction).values(ingredient_a=a, ingredient_b=b, severity=severity,
+                                                     note=(row.get('note') or '').strip() or None)
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=['ingredient_a', 'ingredient_b'],
+                set_={'severity': stmt.excluded.severity, 'note': stmt.excluded.note}))
+            count += 1
+    bump_index_version(session, 'interactions')
+    session.commit()
+    session.close()
+    print(f"✅ Imported {count} interactions")
+
+@app.cli.command('import-ingredients')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_ingredients_command(path):
+    """Load medicine ingredients from a CSV with medicine,ingredient columns (medicine matched by name)."""
+    session = Session()
+    name_to_id = dict(session.query(Medicine.name, Medicine.id))
+    loaded, unknown = 0, set()
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            medicine_id = name_to_id.get(row['medicine'].strip())
+            if medicine_id is None:
+                unknown.add(row['medicine'].strip())
+                continue
+            stmt = sqlite_insert(MedicineIngredient).values(medicine_id=medicine_id,
+                                                            ingredient=normalize_ingredient(row['ingredient']))
+            session.execute(stmt.on_conflict_do_nothing())
+            loaded += 1
+    bump_index_version(session, 'interactions')
+    session.commit()
+    session.close()
+    print(f"✅ Imported {loaded} medicine ingredients")
+    if unknown:
+        print("⚠ Unknown medicines: " + ', '.join(sorted(unknown)))
+
+
+# -----------------------------
+# GENERIC SUBSTITUTES
+# -----------------------------
+def normalize_strength(strength):
+    """'500 MG' -> '500mg', '0.50 g' -> '0.5g'."""
+    strength = ''.join((strength or '').lower().split())
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)(.*)', strength)
+    if not match:
+        return strength
+    number, unit = match.groups()
+    if '.' in number:
+        number = number.rstrip('0').rstrip('.')
+    return number + unit
+
+def composition_key(salts, form):
+    """Order-independent key for a list of (salt, strength) pairs plus dosage form."""
+    parts = sorted(f'{normalize_ingredient(salt)}:{normalize_strength(strength)}' for salt, strength in salts)
+    return '|'.join(parts) + '@' + normalize_ingredient(form or '') if parts else None
+
+def refresh_composition_key(session, med):
+    salts = session.query(MedicineSalt.salt, MedicineSalt.strength).filter_by(medicine_id=med.id).all()
+    med.composition_key = composition_key(salts, med.form)
+
+def substitutes_for(session, med, qty=1, limit=5):
+    """Medicines with the same composition and qty sellable (not held), cheapest first.
+
+    One query on ix_medicines_substitutes; ``stock > 0`` stays in the filter so SQLite can use the partial index.
+    """
+    if not med.composition_key:
+        return []
+    return (session.query(Medicine)
+            .filter(Medicine.composition_key == med.composition_key, Medicine.stock > 0,
+                    Medicine.stock - Medicine.reserved >= qty, Medicine.id != med.id)
+            .order_by(Medicine.price)
+            .limit(limit).all())
+
+def substitute_json(med):
+    return {'id': med.id, 'name': med.name, 'brand': med.brand, 'price': med.price, 'stock': med.stock,
+            'available': max(med.stock - med.reserved, 0)}
+
+@app.cli.command('import-compositions')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_compositions_command(path):
+    """Load compositions from a CSV with medicine,salt,strength,form columns (one row per salt)."""
+    session = Session()
+    by_name = {m.name: m for m in session.query(Medicine)}
+    touched, unknown = {}, set()
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            med = by_name.get(row['medicine'].strip())
+            if med is None:
+                unknown.add(row['medicine'].strip())
+                continue
+            if med.id not in touched:
+                session.query(MedicineSalt).filter_by(medicine_id=med.id).delete()
+                touched[med.id] = med
+            if row.get('form'):
+                med.form = normalize_ingredient(row['form'])
+            session.add(MedicineSalt(medicine_id=med.id, salt=normalize_ingredient(row['salt']),
+                                     strength=normalize_strength(row.get('strength'))))
+    session.flush()
+    for med in touched.values():
+        refresh_composition_key(session, med)
+    session.commit()
+    session.close()
+    print(f"✅ Imported compositions for {len(touched)} medicines")
+    if unknown:
+        print("⚠ Unknown medicines: " + ', '.join(sorted(unknown)))
+
+
+# -----------------------------
+# PRODUCT IMAGES
+# -----------------------------
+# Medicine.image paths are relative to IMAGE_ROOT; resized variants are cached under IMAGE_CACHE
+IMAGE_ROOT = app.root_path
+IMAGE_CACHE = os.path.join(app.root_path, 'image_cache')
+IMAGE_WIDTHS = (160, 320, 480, 640, 960, 1280)
+_source_hashes = {}
+
+def source_hash(path):
+    """Short content hash of an image file, re-read only when its size or mtime changes."""
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _source_hashes.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    _source_hashes[path] = (stamp, digest.hexdigest()[:16])
+    return _source_hashes[path][1]
+
+def width_bucket(width):
+    return next((w for w in IMAGE_WIDTHS if w >= width), IMAGE_WIDTHS[-1])
+
+def image_variant(path, width, fmt):
+    """Path of the cached ``width``-px ``fmt`` variant of ``path``, generating it on first use."""
+    digest = source_hash(path)
+    out = os.path.join(IMAGE_CACHE, f'{digest}-{width}.{fmt}')
+    if os.path.exists(out):
+        return out, digest
+    os.makedirs(IMAGE_CACHE, exist_ok=True)
+    with Image.open(path) as img:
+        img.draft('RGB', (width, width))
+        img = ImageOps.exif_transpose(img)
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        has_alpha = img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info)
+        if fmt == 'webp':
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+        elif has_alpha:
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        else:
+            img = img.convert('RGB')
+        tmp = f'{out}.{uuid.uuid4().hex}.tmp'
+        if fmt == 'webp':
+            img.save(tmp, 'WEBP', quality=80, method=4)
+        else:
+            img.save(tmp, 'JPEG', quality=80, optimize=True, progressive=True)
+    os.replace(tmp, out)
+    return out, digest
+
+def image_file(med):
+    path = safe_join(IMAGE_ROOT, med.image) if med.image else None
+    return path if path and os.path.isfile(path) else None
+
+def image_urls(med):
+    """src/srcset for a product card; the ?v= hash makes every URL safe to cache forever."""
+    path = image_file(med)
+    if not path:
+        return None, None
+    digest = source_hash(path)
+    srcset = ', '.join(f'/img/{med.id}/{w}?v={digest} {w}w' for w in IMAGE_WIDTHS)
+    return f'/img/{med.id}/320?v={digest}', srcset
+
+
+# -----------------------------
+# BARCODES / POS
+# -----------------------------
+def normalize_barcode(code):
+    """Numeric codes (UPC-A, EAN-8/13, GTIN-14) become 14-digit GTINs; others are upper-cased."""
+    code = ''.join((code or '').split()).upper()
+    return code.zfill(14) if code.isdigit() and len(code) <= 14 else code
+
+def gtin_check_digit_ok(gtin):
+    digits = [int(d) for d in gtin]
+    total = sum(d * (3 if i % 2 == 0 else 1) for i, d in enumerate(reversed(digits[:-1])))
+    return (10 - total % 10) % 10 == digits[-1]
+
+class BarcodeIndex:
+    """barcode -> (medicine id, name, brand, price), rebuilt when the 'catalog' version changes."""
+    def __init__(self, version=0):
+        self.version = version
+        self.checked_at = 0.0
+        self.by_code = {}
+
+_barcodes = None
+BARCODE_VERSION_TTL = 1.0
+
+def barcode_index(session):
+    """The cached BarcodeIndex; the catalog version is re-read at most once per BARCODE_VERSION_TTL."""
+    global _barcodes
+    now = time.monotonic()
+    if _barcodes is not None and now - _barcodes.checked_at < BARCODE_VERSION_TTL:
+        return _barcodes
+    version = index_version(session, 'catalog')
+    if _barcodes is None or _barcodes.version != version:
+        index = BarcodeIndex(version)
+        rows = (session.query(MedicineBarcode.barcode, Medicine.id, Medicine.name, Medicine.brand, Medicine.price)
+                .join(Medicine, Medicine.id == MedicineBarcode.medicine_id))
+        index.by_code = {code: (med_id, name, brand, price) for code, med_id, name, brand, price in rows}
+        _barcodes = index
+    _barcodes.checked_at = now
+    return _barcodes
+
+@app.cli.command('import-barcodes')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_barcodes_command(path):
+    """Load pack barcodes from a CSV with medicine,barcode columns (medicine matched by name)."""
+    session = Session()
+    name_to_id = dict(session.query(Medicine.name, Medicine.id))
+    loaded, unknown, bad = 0, set(), []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            medicine_id = name_to_id.get(row['medicine'].strip())
+            if medicine_id is None:
+                unknown.add(row['medicine'].strip())
+                continue
+            code = normalize_barcode(row['barcode'])
+            if code.isdigit() and not gtin_check_digit_ok(code):
+                bad.append(row['barcode'])
+                continue
+            stmt = sqlite_insert(MedicineBarcode).values(barcode=code, medicine_id=medicine_id)
+            session.execute(stmt.on_conflict_do_update(index_elements=['barcode'],
+                                                       set_={'medicine_id': stmt.excluded.medicine_id}))
+            loaded += 1
+    bump_index_version(session, 'catalog')
+    session.commit()
+    session.close()
+    print(f"✅ Imported {loaded} barcodes")
+    if unknown:
+        print("⚠ Unknown medicines: " + ', '.join(sorted(unknown)))
+    if bad:
+        print("⚠ Bad check digit: " + ', '.join(bad))
+
+
+# -----------------------------
+# BATCH INVENTORY (FEFO)
+# -----------------------------
+class OutOfStock(Exception):
+    def __init__(self, medicine_id, requested, available):
+        super().__init__(f'medicine {medicine_id}: requested {requested}, available {available}')
+        self.medicine_id, self.requested, self.available = medicine_id, requested, available
+
+def allocate_fefo(session, medicine_id, qty, ref, today=None, partial=False):
+    """Take qty units of a medicine from its unexpired batches, first-expiry-first-out.
+
+    Batches are read a few at a time off ix_stock_batches_fefo and decremented with a guarded
+    UPDATE, so the cost is proportional to the batches touched, not the batches on record.
+    Medicine.stock is decremented by the amount taken. Returns the units taken. If there is not
+    enough, raises OutOfStock, or with partial=True takes what there is. The caller commits,
+    or rolls back after OutOfStock.
+    """
+    today = today or date.today()
+    remaining = qty
+    while remaining > 0:
+        batches = (session.query(StockBatch.id, StockBatch.qty)
+                   .filter(StockBatch.medicine_id == medicine_id, StockBatch.qty > 0, StockBatch.expiry >= today)
+                   .order_by(StockBatch.expiry, StockBatch.id).limit(4).all())
+        if not batches:
+            break
+        for batch_id, batch_qty in batches:
+            take = min(batch_qty, remaining)
+            taken = session.execute(update(StockBatch).where(StockBatch.id == batch_id, StockBatch.qty >= take)
+                                    .values(qty=StockBatch.qty - take)).rowcount
+            if not taken:
+                break  # changed under us: re-read
+            session.add(StockAllocation(ref=ref, batch_id=batch_id, qty=take))
+            remaining -= take
+            if not remaining:
+                break
+    if remaining and not partial:
+        raise OutOfStock(medicine_id, qty, qty - remaining)
+    if qty - remaining:
+        session.execute(update(Medicine).where(Medicine.id == medicine_id)
+                        .values(stock=Medicine.stock - (qty - remaining)))
+    return qty - remaining
+
+def near_expiry(session, days, today=None):
+    """Batches with stock that expire within ``days`` (already expired ones included), soonest first."""
+    today = today or date.today()
+    return (session.query(StockBatch, Medicine.name)
+            .join(Medicine, Medicine.id == StockBatch.medicine_id)
+            .filter(StockBatch.qty > 0, StockBatch.expiry <= today + timedelta(days=days))
+            .order_by(StockBatch.expiry).all())
+
+@app.cli.command('receive-stock')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def receive_stock_command(path):
+    """Receive batches from a CSV with medicine,batch_no,expiry (YYYY-MM-DD),qty columns."""
+    session = Session()
+    name_to_id = dict(session.query(Medicine.name, Medicine.id))
+    received, unknown = 0, set()
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            medicine_id = name_to_id.get(row['medicine'].strip())
+            if medicine_id is None:
+                unknown.add(row['medicine'].strip())
+                continue
+            qty = int(row['qty'])
+            stmt = sqlite_insert(StockBatch).values(medicine_id=medicine_id, batch_no=row['batch_no'].strip(),
+                                                    expiry=date.fromisoformat(row['expiry'].strip()), qty=qty,
+                                                    received_at=datetime.utcnow())
+            session.execute(stmt.on_conflict_do_update(index_elements=['medicine_id', 'batch_no'],
+                                                       set_={'qty': StockBatch.qty + stmt.excluded.qty}))
+            session.execute(update(Medicine).where(Medicine.id == medicine_id).values(stock=Medicine.stock + qty))
+            received += 1
+    session.commit()
+    session.close()
+    print(f"✅ Received {received} batches")
+    if unknown:
+        print("⚠ Unknown medicines: " + ', '.join(sorted(unknown)))
+
+@app.cli.command('near-expiry')
+@click.option('--days', default=30, help='Report batches expiring within this many days.')
+def near_expiry_command(days):
+    """Print batches that expire soon (nightly report)."""
+    session = Session()
+    rows = near_expiry(session, days)
+    for batch, name in rows:
+        flag = 'EXPIRED' if batch.expiry < date.today() else ''
+        print(f"{batch.expiry}  {name:<30} batch {batch.batch_no:<12} qty {batch.qty:>5} {flag}")
+    session.close()
+    print(f"✅ {len(rows)} batches expire within {days} days")
+
+
+# -----------------------------
+# STOCK HOLDS
+# -----------------------------
+HOLD_TTL = timedelta(minutes=15)
+
+def hold_stock(session, cart_id, medicine_id, qty):
+    """Set the cart's hold on a medicine to qty units (0 releases it) and restart its TTL.
+
+    Only the change in qty is added to Medicine.reserved, with a guarded UPDATE so holds never
+    exceed stock. Raises OutOfStock if they would. The caller commits and then schedules the
+    returned hold with the sweeper.
+    """
+    hold = session.query(StockHold).filter_by(cart_id=cart_id, medicine_id=medicine_id).first()
+    delta = qty - (hold.qty if hold else 0)
+    if delta > 0:
+        held = session.execute(update(Medicine)
+                               .where(Medicine.id == medicine_id, Medicine.stock - Medicine.reserved >= delta)
+                               .values(reserved=Medicine.reserved + delta)).rowcount
+        if not held:
+            available = session.query(Medicine.stock - Medicine.reserved).filter(Medicine.id == medicine_id).scalar()
+            raise OutOfStock(medicine_id, qty, (available or 0) + qty - delta)
+    elif delta < 0:
+        session.execute(update(Medicine).where(Medicine.id == medicine_id).values(reserved=Medicine.reserved + delta))
+    if not qty:
+        if hold:
+            session.delete(hold)
+        return None
+    if not hold:
+        hold = StockHold(cart_id=cart_id, medicine_id=medicine_id)
+        session.add(hold)
+    hold.qty, hold.expires_at = qty, datetime.utcnow() + HOLD_TTL
+    session.flush()
+    return hold
+
+def release_holds(session, holds):
+    """Delete holds and give their units back to available stock. Returns {medicine_id: qty}."""
+    released = {}
+    for hold in holds:
+        released[hold.medicine_id] = released.get(hold.medicine_id, 0) + hold.qty
+        session.delete(hold)
+    for medicine_id, qty in released.items():
+        session.execute(update(Medicine).where(Medicine.id == medicine_id).values(reserved=Medicine.reserved - qty))
+    return released
+
+def convert_holds(session, cart_id, items, ref):
+    """Turn a cart's holds into a sale: release them and allocate the items FEFO, in the caller's transaction.
+
+    Items need not have been held, but the sale may not dip into other carts' holds; if it would,
+    OutOfStock is raised and the caller rolls back (which also puts this cart's holds back).
+    """
+    release_holds(session, session.query(StockHold).filter_by(cart_id=cart_id).all())
+    for it in items:
+        allocate_fefo(session, it['id'], it['qty'], ref)
+        stock, reserved = session.query(Medicine.stock, Medicine.reserved).filter(Medicine.id == it['id']).one()
+        if stock < reserved:
+            raise OutOfStock(it['id'], it['qty'], it['qty'] - (reserved - stock))
+
+class HoldSweeper:
+    """Expires stock holds from a min-heap of (expires_at, hold id), so nothing ever scans stock_holds.
+
+    A hold whose TTL was extended leaves a stale heap entry behind; it is skipped when it comes
+    due because the row's expires_at has moved on (the extension pushed a fresh entry).
+
+    The heap only lives in memory, so each process rebuilds it from stock_holds when it starts
+    its sweeper (see start_hold_sweeper).
+    """
+    RETRY_SECONDS = 5
+
+    def __init__(self):
+        self.heap = []
+        self.wakeup = threading.Condition()
+        self.thread = None
+        self.pid = None
+
+    def schedule(self, expires_at, hold_id):
+        with self.wakeup:
+            heapq.heappush(self.heap, (expires_at, hold_id))
+            if self.heap[0][1] == hold_id:
+                self.wakeup.notify()
+
+    def due(self, now):
+        with self.wakeup:
+            ids = []
+            while self.heap and self.heap[0][0] <= now:
+                ids.append(heapq.heappop(self.heap)[1])
+            return ids
+
+    def sweep(self, now=None):
+        """Expire every hold that has come due, in one transaction. Returns how many were released."""
+        now = now or datetime.utcnow()
+        ids = self.due(now)
+        if not ids:
+            return 0
+        session = Session()
+        try:
+            holds = session.query(StockHold).filter(StockHold.id.in_(ids), StockHold.expires_at <= now).all()
+            release_holds(session, holds)
+            session.commit()
+        except Exception:
+            session.rollback()
+            for hold_id in ids:  # put them back so the retry sees them again
+                self.schedule(now, hold_id)
+            raise
+        finally:
+            session.close()
+        return len(holds)
+
+    def run(self):
+        while True:
+            with self.wakeup:
+                timeout = (self.heap[0][0] - datetime.utcnow()).total_seconds() if self.heap else None
+                if timeout is None or timeout > 0:
+                    self.wakeup.wait(timeout)
+            try:
+                self.sweep()
+            except Exception:
+                app.logger.exception('Hold sweep failed, retrying in %ss', self.RETRY_SECONDS)
+                time.sleep(self.RETRY_SECONDS)
+
+    def start(self):
+        """Start this process's sweeper thread, loading the holds already on record first.
+
+        Safe to call on every request: it only does work once per process, including in workers
+        forked from a parent that had already started one.
+        """
+        if self.pid == os.getpid():
+            return
+        with self.wakeup:
+            if self.pid == os.getpid():
+                return
+            session = Session()
+            try:
+                # ix_stock_holds_expires_at hands them back already in heap order
+                self.heap = [(expires_at, hold_id) for hold_id, expires_at
+                             in session.query(StockHold.id, StockHold.expires_at).order_by(StockHold.expires_at)]
+            finally:
+                session.close()
+            self.thread = threading.Thread(target=self.run, name='hold-sweeper', daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+hold_sweeper = HoldSweeper()
+
+
+# -----------------------------
+# STORES
+# -----------------------------
+STORE_CELL_DEG = 0.05  # grid cell size, about 5.5 km north-south
+EARTH_RADIUS_KM = 6371.0
+MAX_STORE_RADIUS_KM = 50
+MAX_STORE_RESULTS = 20
+
+def distance_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def store_cell(lat, lng):
+    return math.floor(lat / STORE_CELL_DEG), math.floor(lng / STORE_CELL_DEG)
+
+class StoreGrid:
+    """Stores bucketed into a lat/lng grid, rebuilt when the 'stores' version changes."""
+    def __init__(self, version=0):
+        self.version = version
+        self.cells = {}  # (row, col) -> [(store id, name, lat, lng)]
+
+    def add(self, store_id, name, lat, lng):
+        self.cells.setdefault(store_cell(lat, lng), []).append((store_id, name, lat, lng))
+
+    def within(self, lat, lng, radius_km):
+        """[(distance, store id, name)] of stores within radius_km, nearest first; only covering cells are read."""
+        dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+        dlng = math.degrees(radius_km / (EARTH_RADIUS_KM * max(math.cos(math.radians(lat)), 1e-6)))
+        (row0, col0), (row1, col1) = store_cell(lat - dlat, lng - dlng), store_cell(lat + dlat, lng + dlng)
+        if (row1 - row0 + 1) * (col1 - col0 + 1) > len(self.cells):
+            # near a pole or with a huge radius there are more covering cells than occupied ones
+            cells = [cell for cell in self.cells if row0 <= cell[0] <= row1 and col0 <= cell[1] <= col1]
+        else:
+            cells = [(row, col) for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)]
+        found = []
+        for cell in cells:
+            for store_id, name, s_lat, s_lng in self.cells.get(cell, ()):
+                d = distance_km(lat, lng, s_lat, s_lng)
+                if d <= radius_km:
+                    found.append((d, store_id, name))
+        found.sort()
+        return found
+
+_store_grid = None
+
+def store_grid(session):
+    global _store_grid
+    version = index_version(session, 'stores')
+    if _store_grid is None or _store_grid.version != version:
+        grid = StoreGrid(version)
+        for store_id, name, lat, lng in session.query(Store.id, Store.name, Store.lat, Store.lng):
+            grid.add(store_id, name, lat, lng)
+        _store_grid = grid
+    return _store_grid
+
+def stores_with_items(session, lat, lng, items, radius_km=10, limit=5):
+    """Nearest stores within radius_km that stock every cart item in the quantity wanted.
+
+    Candidates come off the grid; their stock is then read for just the cart's medicines in one
+    query on the (store_id, medicine_id) primary key.
+    """
+    wanted = {}
+    for it in items:
+        wanted[it['id']] = wanted.get(it['id'], 0) + int(it['qty'])
+    candidates = store_grid(session).within(lat, lng, radius_km)
+    if not candidates or not wanted:
+        return [{'id': store_id, 'name': name, 'distance_km': round(d, 2)} for d, store_id, name in candidates[:limit]]
+    covered = Counter()
+    rows = (session.query(StoreStock.store_id, StoreStock.medicine_id, StoreStock.qty)
+            .filter(StoreStock.store_id.in_([store_id for _, store_id, _ in candidates]),
+                    StoreStock.medicine_id.in_(wanted)))
+    for store_id, medicine_id, qty in rows:
+        if qty >= wanted[medicine_id]:
+            covered[store_id] += 1
+    return [{'id': store_id, 'name': name, 'distance_km': round(d, 2)}
+            for d, store_id, name in candidates if covered[store_id] == len(wanted)][:limit]
+
+@app.cli.command('import-stores')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_stores_command(path):
+    """Load branch stores from a CSV with name,address,lat,lng columns (matched by name)."""
+    session = Session()
+    loaded = 0
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            stmt = sqlite_insert(Store).values(name=row['name'].strip(), address=row.get('address'),
+                                               lat=float(row['lat']), lng=float(row['lng']))
+            session.execute(stmt.on_conflict_do_update(index_elements=['name'], set_={
+                'address': stmt.excluded.address, 'lat': stmt.excluded.lat, 'lng': stmt.excluded.lng}))
+            loaded += 1
+    bump_index_version(session, 'stores')
+    session.commit()
+    session.close()
+    print(f"✅ Imported {loaded} stores")
+
+@app.cli.command('import-store-stock')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_store_stock_command(path):
+    """Set branch stock from a CSV with store,medicine,qty columns (both matched by name)."""
+    session = Session()
+    store_ids = dict(session.query(Store.name, Store.id))
+    name_to_id = dict(session.query(Medicine.name, Medicine.id))
+    loaded, unknown = 0, set()
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            store_id, medicine_id = store_ids.get(row['store'].strip()), name_to_id.get(row['medicine'].strip())
+            if store_id is None or medicine_id is None:
+                unknown.add(row['store'].strip() if store_id is None else row['medicine'].strip())
+                continue
+            stmt = sqlite_insert(StoreStock).values(store_id=store_id, medicine_id=medicine_id, qty=int(row['qty']))
+            session.execute(stmt.on_conflict_do_update(index_elements=['store_id', 'medicine_id'],
+                                                       set_={'qty': stmt.excluded.qty}))
+            loaded += 1
+    session.commit()
+    session.close()
+    print(f"✅ Imported {loaded} store stock rows")
+    if unknown:
+        print("⚠ Unknown stores/medicines: " + ', '.join(sorted(unknown)))
+
+
+# -----------------------------
+# OFFLINE POS SYNC
+# -----------------------------
+def valid_pos_lines(lines):
+    """True for a non-empty list of {'id': int, 'qty': int > 0, 'price': number} lines."""
+    if not isinstance(lines, list) or not lines:
+        return False
+    for line in lines:
+        try:
+            if not isinstance(line['id'], int) or int(line['qty']) <= 0 or float(line['price']) < 0:
+                return False
+        except (KeyError, TypeError, ValueError):
+            return False
+    return True
+
+def valid_pos_sale(sale):
+    try:
+        datetime.fromisoformat(sale['sold_at'])
+        return isinstance(sale['sale_id'], str) and bool(sale['sale_id']) and valid_pos_lines(sale['lines'])
+    except (KeyError, TypeError, ValueError):
+        return False
+
+def apply_pos_sales(session, terminal, sales):
+    """Apply a batch of terminal sales in one transaction and return a result per sale.
+
+    Sales already on record are reported as duplicates. Sales always count, since the goods have
+    left the counter; stock is taken from batches first-expiry-first-out as far as it goes, and any
+    shortfall or unknown medicine is logged as a PosConflict for staff to reconcile.
+    """
+    ids = [sale['sale_id'] for sale in sales]
+    known = dict(session.query(PosSale.sale_id, PosSale.status).filter(PosSale.sale_id.in_(ids)))
+    fresh, seen = [], set()
+    for sale in sorted(sales, key=lambda sale: sale['sold_at']):
+        if sale['sale_id'] not in known and sale['sale_id'] not in seen:
+            seen.add(sale['sale_id'])
+            fresh.append(sale)
+    medicine_ids = {line['id'] for sale in fresh for line in sale['lines']}
+    known_medicines = {m for (m,) in session.query(Medicine.id).filter(Medicine.id.in_(medicine_ids))} if medicine_ids else set()
+
+    sale_rows, line_rows, conflict_rows, results = [], [], [], {}
+    for sale in fresh:
+        conflicts = []
+        for line_no, line in enumerate(sale['lines']):
+            medicine_id, qty = line['id'], int(line['qty'])
+            if medicine_id not in known_medicines:
+                conflicts.append({'medicine_id': medicine_id, 'requested': qty, 'available': 0, 'reason': 'unknown medicine'})
+                continue
+            taken = allocate_fefo(session, medicine_id, qty, f"pos:{sale['sale_id']}:{line_no}",
+                                  today=datetime.fromisoformat(sale['sold_at']).date(), partial=True)
+            if taken < qty:
+                conflicts.append({'medicine_id': medicine_id, 'requested': qty, 'available': taken, 'reason': 'oversold'})
+            line_rows.append({'sale_id': sale['sale_id'], 'line_no': line_no, 'medicine_id': medicine_id,
+                              'qty': qty, 'price': float(line['price'])})
+        status = 'conflict' if conflicts else 'applied'
+        sale_rows.append({'sale_id': sale['sale_id'], 'terminal': terminal, 'status': status,
+                          'sold_at': datetime.fromisoformat(sale['sold_at']), 'received_at': datetime.utcnow(),
+                          'total': sum(float(l['price']) * int(l['qty']) for l in sale['lines'])})
+        conflict_rows += [dict(c, sale_id=sale['sale_id']) for c in conflicts]
+        results[sale['sale_id']] = {'status': status, 'conflicts': conflicts}
+
+    if sale_rows:
+        session.execute(PosSale.__table__.insert(), sale_rows)
+    if line_rows:
+        session.execute(PosSaleLine.__table__.insert(), line_rows)
+    if conflict_rows:
+        session.execute(PosConflict.__table__.insert(), conflict_rows)
+    session.commit()
+    return [{'sale_id': sid, **(results.get(sid) or {'status': 'duplicate', 'previous': known.get(sid)})}
+            for sid in ids]
+
+class PosJournal:
+    """Sales recorded on a counter terminal (local SQLite), uploaded to the central server by sync()."""
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS pos_journal (sale_id TEXT PRIMARY KEY, sold_at TEXT NOT NULL, '
+                          "payload TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'queued', detail TEXT)")
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ix_pos_journal_status ON pos_journal (status, sold_at)')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def record_sale(self, lines):
+        """Journal a sale of [{'id', 'qty', 'price'}] lines; works with no connection to the server."""
+        sale = {'sale_id': str(uuid.uuid4()), 'sold_at': datetime.utcnow().isoformat(), 'lines': lines}
+        self.conn.execute('INSERT INTO pos_journal (sale_id, sold_at, payload) VALUES (?, ?, ?)',
+                          (sale['sale_id'], sale['sold_at'], json.dumps(sale)))
+        self.conn.commit()
+        return sale['sale_id']
+
+    def sync(self, server, terminal, batch_size=500, timeout=60):
+        """Upload queued sales in batches of batch_size, one request (and server transaction) each."""
+        counts = {}
+        while True:
+            rows = self.conn.execute("SELECT payload FROM pos_journal WHERE status = 'queued' ORDER BY sold_at LIMIT ?",
+                                     (batch_size,)).fetchall()
+            if not rows:
+                return counts
+            body = json.dumps({'terminal': terminal, 'sales': [json.loads(p) for (p,) in rows]}).encode()
+            req = urllib.request.Request(server.rstrip('/') + '/pos/sync', data=body,
+                                         headers={'Content-Type': 'application/json'})
+            with urllib.request.urlopen(req, timeout=timeout) as response:
+                results = json.load(response)['results']
+            self.conn.executemany('UPDATE pos_journal SET status = ?, detail = ? WHERE sale_id = ?',
+                                  [(r['status'], json.dumps(r.get('conflicts') or []), r['sale_id']) for r in results])
+            self.conn.commit()
+            for r in results:
+                counts[r['status']] = counts.get(r['status'], 0) + 1
+
+@app.cli.command('pos-sync')
+@click.option('--journal', default='pos_journal.db', help='Terminal journal file.')
+@click.option('--server', required=True, help='Central server URL, e.g. http://10.0.0.5:5000')
+@click.option('--terminal', default=lambda: os.environ.get('POS_TERMINAL', 'counter-1'))
+@click.option('--batch-size', default=500, help='Sales per request.')
+def pos_sync_command(journal, server, terminal, batch_size):
+    """Upload sales queued in a terminal journal to the central server."""
+    journal = PosJournal(journal)
+    try:
+        counts = journal.sync(server, terminal, batch_size)
+    finally:
+        journal.close()
+    print('✅ Synced: ' + (', '.join(f'{n} {status}' for status, n in counts.items()) or 'nothing queued'))
 
 
 # -----------------------------
@@ -62,12 +1047,33 @@ def get_medicines():
         'description': m.description,
         'price': m.price,
         'stock': m.stock,
+        'available': max(m.stock - m.reserved, 0),
         'liked': m.liked,
-        'image': m.image
+        'image': m.image,
+        **dict(zip(('image_url', 'image_srcset'), image_urls(m)))
     } for m in meds]
     session.close()
     return jsonify(data)
 
+@app.route('/img/<int:med_id>/<int:size>')
+def medicine_image(med_id, size):
+    session = Session()
+    med = session.get(Medicine, med_id)
+    path = image_file(med) if med else None
+    session.close()
+    if not path:
+        abort(404)
+    fmt = 'webp' if 'image/webp' in request.accept_mimetypes.values() else 'jpeg'
+    out, digest = image_variant(path, width_bucket(size), fmt)
+    versioned = request.args.get('v') == digest
+    response = send_file(out, mimetype=f'image/{fmt}', etag=f'{digest}-{fmt}',
+                         max_age=31536000 if versioned else 300)
+    response.vary.add('Accept')
+    if versioned:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
 @app.route('/api/medicines/<int:med_id>/like', methods=['POST'])
 def toggle_like(med_id):
     session = Session()
@@ -81,21 +1087,162 @@ def toggle_like(med_id):
     session.close()
     return jsonify(data)
 
+@app.route('/api/medicines/<int:med_id>/substitutes')
+def get_substitutes(med_id):
+    session = Session()
+    med = session.get(Medicine, med_id)
+    if not med:
+        session.close()
+        return jsonify({'error': 'Not found'}), 404
+    data = [substitute_json(m) for m in substitutes_for(session, med)]
+    session.close()
+    return jsonify(data)
+
+@app.route('/pos/scan')
+def pos_scan():
+    started = time.perf_counter()
+    code = normalize_barcode(request.args.get('code'))
+    session = Session()
+    hit = barcode_index(session).by_code.get(code)
+    if not hit:
+        session.close()
+        return jsonify({'error': 'Unknown barcode', 'barcode': code}), 404
+    medicine_id, name, brand, price = hit
+    stock = session.query(Medicine.stock).filter_by(id=medicine_id).scalar()
+    session.close()
+    response = jsonify({'id': medicine_id, 'name': name, 'brand': brand, 'price': price,
+                        'stock': stock, 'barcode': code})
+    response.headers['Server-Timing'] = f'scan;dur={(time.perf_counter() - started) * 1000:.3f}'
+    return response
+
+@app.route('/pos/sales', methods=['POST'])
+def pos_record_sale():
+    # Terminal side: journal locally, never waits for the central server
+    lines = (request.get_json(silent=True) or {}).get('lines')
+    if not valid_pos_lines(lines):
+        return jsonify({'error': 'lines[id, qty, price] are required'}), 400
+    journal = PosJournal(os.environ.get('POS_JOURNAL', 'pos_journal.db'))
+    try:
+        sale_id = journal.record_sale(lines)
+    finally:
+        journal.close()
+    return jsonify({'sale_id': sale_id, 'status': 'queued'}), 202
+
+@app.route('/pos/sync', methods=['POST'])
+def pos_sync():
+    # Central side: one transaction per uploaded batch
+    data = request.get_json(silent=True) or {}
+    sales = data.get('sales', [])
+    if not data.get('terminal') or not isinstance(sales, list) or not all(valid_pos_sale(s) for s in sales):
+        return jsonify({'error': 'terminal and sales[sale_id, sold_at, lines] are required'}), 400
+    session = Session()
+    try:
+        results = apply_pos_sales(session, data['terminal'], sales)
+    finally:
+        session.close()
+    return jsonify({'results': results})
+
+@app.route('/api/stock/near-expiry')
+def get_near_expiry():
+    session = Session()
+    data = [{'medicine_id': b.medicine_id, 'name': name, 'batch_no': b.batch_no,
+             'expiry': b.expiry.isoformat(), 'qty': b.qty}
+            for b, name in near_expiry(session, request.args.get('days', 30, type=int))]
+    session.close()
+    return jsonify(data)
+
+@app.before_request
+def start_hold_sweeper():
+    # started by the first request each process serves, so it runs under flask run and WSGI
+    # servers alike, and not in the debug reloader's watcher process
+    hold_sweeper.start()
+
+@app.route('/api/holds', methods=['POST'])
+def place_hold():
+    data = request.get_json(silent=True) or {}
+    try:
+        cart_id, medicine_id, qty = str(data['cart_id']), int(data['id']), int(data['qty'])
+    except (KeyError, TypeError, ValueError):
+        cart_id = qty = None
+    if not cart_id or qty is None or qty < 0:
+        return jsonify({'error': 'cart_id, id and a qty of 0 or more are required'}), 400
+    session = Session()
+    try:
+        hold = hold_stock(session, cart_id, medicine_id, qty)
+    except OutOfStock as e:
+        session.rollback()
+        session.close()
+        return jsonify({'error': 'Not enough stock', 'available': e.available}), 409
+    session.commit()
+    result = {'cart_id': cart_id, 'id': medicine_id, 'qty': qty,
+              'expires_at': hold.expires_at.isoformat() if hold else None}
+    if hold:
+        hold_sweeper.schedule(hold.expires_at, hold.id)
+    session.close()
+    return jsonify(result)
+
+@app.route('/api/holds/<cart_id>', methods=['DELETE'])
+def drop_holds(cart_id):
+    session = Session()
+    released = release_holds(session, session.query(StockHold).filter_by(cart_id=cart_id).all())
+    session.commit()
+    session.close()
+    return jsonify({'released': len(released)})
+
+@app.route('/api/stores/nearby', methods=['POST'])
+def nearby_stores():
+    data = request.get_json(silent=True) or {}
+    try:
+        lat, lng = float(data['lat']), float(data['lng'])
+        radius_km, limit = float(data.get('radius_km', 10)), int(data.get('limit', 5))
+        items = [{'id': int(it['id']), 'qty': int(it['qty'])} for it in data.get('items', [])]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'lat, lng and items[id, qty] are required'}), 400
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180) or not 0 < radius_km <= MAX_STORE_RADIUS_KM or limit < 1:
+        return jsonify({'error': f'lat/lng out of range, or radius_km not within 0-{MAX_STORE_RADIUS_KM}'}), 400
+    session = Session()
+    stores = stores_with_items(session, lat, lng, items, radius_km=radius_km, limit=min(limit, MAX_STORE_RESULTS))
+    session.close()
+    return jsonify(stores)
+
+@app.route('/api/cart/interactions', methods=['POST'])
+def check_interactions():
+    # Called on each add-to-cart: only the new line is checked against the lines already in the cart
+    data = request.json or {}
+    session = Session()
+    warnings = interaction_index(session).check(data.get('id'), [it['id'] for it in data.get('items', [])])
+    data = {'warnings': describe_interactions(session, warnings)}
+    session.close()
+    return jsonify(data)
+
 @app.route('/api/cart/checkout', methods=['POST'])
 def checkout():
     items = request.json.get('items', [])
+    cart_id = request.json.get('cart_id') or str(uuid.uuid4())
     session = Session()
     for it in items:
         med = session.get(Medicine, it['id'])
         if not med or med.stock < it['qty']:
+            alternatives = [substitute_json(m) for m in substitutes_for(session, med, it['qty'])] if med else []
             session.close()
-            return jsonify({'error': f'{med.name if med else "Unknown"} out of stock'}), 400
-    for it in items:
-        med = session.get(Medicine, it['id'])
-        med.stock -= it['qty']
+            return jsonify({'error': f'{med.name if med else "Unknown"} out of stock',
+                            'alternatives': alternatives}), 400
+    warnings = interaction_index(session).check_all([it['id'] for it in items])
+    warnings = describe_interactions(session, warnings)
+    order_ref = str(uuid.uuid4())
+    try:
+        convert_holds(session, cart_id, items, f'checkout:{order_ref}')
+    except OutOfStock as e:
+        # stock counted expired batches or other carts' holds, or another checkout got there first
+        session.rollback()
+        med = session.get(Medicine, e.medicine_id)
+        alternatives = [substitute_json(m) for m in substitutes_for(session, med, e.requested)]
+        session.close()
+        return jsonify({'error': f'{med.name} out of stock', 'alternatives': alternatives}), 400
     session.commit()
     session.close()
-    return jsonify({'status': 'success', 'message': 'Order placed (mock)'})
+    return jsonify({'status': 'success', 'message': 'Order placed (mock)', 'warnings': warnings,
+                    'order_ref': order_ref})
 
 # -----------------------------
 # FRONTEND (HTML + CSS + JS)
@@ -117,6 +1264,7 @@ def home():
     #medList{display:flex;flex-wrap:wrap;gap:15px;padding:15px;}
     .med{background:white;border-radius:8px;padding:10px;width:220px;box-shadow:0 2px 5px rgba(0,0,0,0.1);}
     .med h4{margin:5px 0;}
+    .med img{width:100%;height:160px;object-fit:contain;}
     #cartPanel{position:fixed;right:10px;top:70px;width:300px;background:white;border:1px solid #ccc;padding:10px;border-radius:8px;box-shadow:0 4px 12px rgba(0,0,0,0.2);display:none;}
   </style>
 </head>
@@ -139,6 +1287,7 @@ def home():
 
   <script>
     let cart = [];
+    const cartId = crypto.randomUUID();
 
     async function fetchMeds(q=''){
       let url = '/api/medicines';
@@ -155,10 +1304,11 @@ def home():
         const div = document.createElement('div');
         div.className='med';
         div.innerHTML = `
+          ${m.image_url ? `<img src='${m.image_url}' srcset='${m.image_srcset}' sizes='220px' width='220' height='160' loading='lazy' decoding='async' alt='${m.name}'>` : ''}
           <h4>${m.name}</h4>
           <small>${m.brand||''}</small>
           <p>${m.description||''}</p>
-          <b>₹ ${m.price}</b> | Stock: ${m.stock}<br>
+          <b>₹ ${m.price}</b> | Available: ${m.available}<br>
           <button onclick='likeMed(${m.id}, this)'>${m.liked?'♥':'♡'}</button>
           <button onclick='addToCart(${m.id})'>Add to cart</button>
         `;
@@ -172,8 +1322,19 @@ def home():
       btn.textContent = data.liked ? '♥':'♡';
     }
 
-    function addToCart(id){
+    function interactionText(warnings){
+      return warnings.map(w=>`⚠ ${w.medicine} may interact with ${w.other} (${w.severity})${w.note?': '+w.note:''}`).join('\n');
+    }
+
+    async function addToCart(id){
       const item = cart.find(i=>i.id===id);
+      if(!item){
+        const res = await fetch('/api/cart/interactions',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({id, items:cart})});
+        const data = await res.json();
+        if(data.warnings.length) alert(interactionText(data.warnings));
+      }
+      const hold = await fetch('/api/holds',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({cart_id:cartId, id, qty:(item?item.qty:0)+1})});
+      if(!hold.ok){const data = await hold.json(); alert(`${data.error} (${data.available} available)`); return;}
       if(item) item.qty++; else cart.push({id, qty:1});
       document.getElementById('cartCount').textContent = cart.reduce((a,i)=>a+i.qty,0);
     }
@@ -187,9 +1348,10 @@ def home():
 
     async function checkout(){
       if(cart.length===0){alert('Cart empty');return;}
-      const res = await fetch('/api/cart/checkout',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({items:cart})});
+      const res = await fetch('/api/cart/checkout',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({cart_id:cartId, items:cart})});
       const data = await res.json();
-      alert(data.message||data.error);
+      const alternatives = (data.alternatives||[]).map(a=>`Try ${a.name} (${a.brand||''}) ₹ ${a.price}`).join('\n');
+      alert([data.message||data.error, interactionText(data.warnings||[]), alternatives].filter(Boolean).join('\n'));
       if(data.status==='success'){cart=[];document.getElementById('cartCount').textContent='0';toggleCart();}
     }
 
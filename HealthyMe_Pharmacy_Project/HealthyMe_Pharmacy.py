@@ -1,11 +1,50 @@
-from flask import Flask, render_template_string, request, redirect, url_for, session, flash
+from flask import Flask, render_template_string, request, redirect, url_for, session, flash, jsonify, abort, send_file
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from sqlalchemy import func, tuple_, inspect, text, or_, and_, update, bindparam
+from sqlalchemy.orm import validates
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from collections import Counter
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from email.message import EmailMessage
+from itertools import islice
+from xml.sax.saxutils import escape
+from zoneinfo import ZoneInfo
+from PIL import Image, ImageOps
+from reportlab import rl_config
+from reportlab.lib import colors
+from reportlab.graphics.barcode import code128, eanbc
+from reportlab.graphics.shapes import Drawing
+from reportlab.graphics import renderPDF
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.pdfgen import canvas as pdf_canvas
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer, Frame
+import click
+import csv
+import hashlib
+import io
+import json
+import os
+import queue
+import random
+import re
+import smtplib
+import socketserver
+import tempfile
+import threading
+import time
+import uuid
 
 app = Flask(__name__)
 app.secret_key = "supersecretkey"
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///pharmacy.db"
+app.config["SQLALCHEMY_BINDS"] = {"prescriptions": "sqlite:///healthyme_final.db"}
 db = SQLAlchemy(app)
 
 # ----------------------- DATABASE MODELS -----------------------
@@ -13,27 +52,165 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(100), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
+    # normalized patient name this account's orders belong to on the patient timeline
+    patient_key = db.Column(db.String(120), index=True)
+    email = db.Column(db.String(200))
+    is_staff = db.Column(db.Boolean, default=False)  # can move orders through packing and dispatch
+    points_seq = db.Column(db.Integer, default=0)  # bumped to lock the account while points are redeemed
     cart_items = db.relationship("Cart", backref="user", lazy=True)
     orders = db.relationship("Order", backref="user", lazy=True)
 
 class Medicine(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(100), nullable=False, index=True)
+    category = db.Column(db.String(50), default="General", index=True)
     price = db.Column(db.Float, nullable=False)
+    tax_class = db.Column(db.String(10), db.ForeignKey("tax_class.code"))  # None means DEFAULT_TAX_CLASS
+    days_per_unit = db.Column(db.Integer)  # how long one unit lasts, for chronic medication; None = no refill reminders
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 class Cart(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     medicine_id = db.Column(db.Integer, db.ForeignKey("medicine.id"), nullable=False)
     quantity = db.Column(db.Integer, default=1)
+    price_snapshot = db.Column(db.Float)  # Medicine.price when the line was added or last accepted
+    medicine = db.relationship("Medicine")
+    # one line per medicine, so whole baskets can be merged in with a single upsert
+    __table_args__ = (db.Index("ux_cart_user_medicine", "user_id", "medicine_id", unique=True),)
+
+# Every price a medicine has had; the current one is the row with valid_to NULL
+class PriceHistory(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    medicine_id = db.Column(db.Integer, db.ForeignKey("medicine.id"), nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    valid_from = db.Column(db.DateTime, nullable=False)
+    valid_to = db.Column(db.DateTime)  # exclusive
+    __table_args__ = (db.Index("ix_price_history_asof", "medicine_id", "valid_from"),
+                      db.Index("ux_price_history_open", "medicine_id", unique=True,
+                               sqlite_where=db.text("valid_to IS NULL")))
+
+# What a user keeps ordering, folded in at every order; drives "usual items" and reorders
+class UsualItem(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    medicine_id = db.Column(db.Integer, db.ForeignKey("medicine.id"), primary_key=True)
+    times_ordered = db.Column(db.Integer, nullable=False, default=0)
+    total_quantity = db.Column(db.Integer, nullable=False, default=0)
+    last_ordered_at = db.Column(db.DateTime)
     medicine = db.relationship("Medicine")
+    __table_args__ = (db.Index("ix_usual_item_rank", "user_id", "times_ordered"),)
+
+# When to nudge a user to refill a medicine; retired reminders have no next_due_at, so due scans skip them
+class RefillReminder(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    medicine_id = db.Column(db.Integer, db.ForeignKey("medicine.id"), nullable=False)
+    next_due_at = db.Column(db.DateTime)
+    runs_out_at = db.Column(db.DateTime)
+    sent_count = db.Column(db.Integer, nullable=False, default=0)
+    last_sent_at = db.Column(db.DateTime)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    __table_args__ = (
+        db.UniqueConstraint("user_id", "medicine_id"),
+        db.Index("ix_refill_reminder_due", "next_due_at", "id"),
+    )
+
+# Outbound mail; workers claim rows by moving next_attempt_at past a lease, so a crashed worker's rows come back
+class Notification(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30), nullable=False)  # order_confirmation, refill_reminder, ...
+    recipient = db.Column(db.String(200), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default="queued")  # queued, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    claim_token = db.Column(db.String(32))
+    last_error = db.Column(db.String(300))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    __table_args__ = (db.Index("ix_notification_due", "status", "next_attempt_at", "id"),
+                      db.Index("ix_notification_sent", "status", "sent_at"))
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     total_amount = db.Column(db.Float, nullable=False)
     date = db.Column(db.DateTime, default=datetime.utcnow)
+    slot_id = db.Column(db.Integer, db.ForeignKey("delivery_slot.id"), index=True)
+    # basket-level discount; line discounts are already taken off OrderItem.price
+    discount = db.Column(db.Float, default=0)
+    status = db.Column(db.String(12), default="placed")  # see ORDER_TRANSITIONS; only change via transition_order
+    refunded_paise = db.Column(db.Integer, default=0)  # added to by the refund settlement job only
+    points_paise = db.Column(db.Integer, default=0)  # part of total_amount paid with loyalty points
     items = db.relationship("OrderItem", backref="order", lazy=True)
+    slot = db.relationship("DeliverySlot")
+    __table_args__ = (db.Index("ix_order_user_date", "user_id", "date", "id"),
+                      db.Index("ix_order_status_date", "status", "date", "id"))
+
+# Append-only loyalty points ledger; a balance is the user's snapshot plus entries after it
+class PointsEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(20), nullable=False)  # earned, redeemed, cancelled, returned
+    order_id = db.Column(db.Integer, db.ForeignKey("order.id"))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index("ix_points_entry_user", "user_id", "id"),)
+
+# Balance of a user's ledger up to last_entry_id, advanced by the snapshot-points job
+class PointsSnapshot(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    balance = db.Column(db.Integer, nullable=False, default=0)
+    last_entry_id = db.Column(db.Integer, nullable=False, default=0)
+    taken_at = db.Column(db.DateTime)
+
+# Customer's request to return some units of an order line; batch_no/expiry come off the returned pack
+class ReturnRequest(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    order_item_id = db.Column(db.Integer, db.ForeignKey("order_item.id"), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(200))
+    status = db.Column(db.String(10), nullable=False, default="requested")  # requested, approved, rejected, refunded
+    batch_no = db.Column(db.String(50))
+    expiry = db.Column(db.Date)
+    resaleable = db.Column(db.Boolean, default=False)  # sealed and in date: goes back on the shelf
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    decided_at = db.Column(db.DateTime)
+    decided_by = db.Column(db.Integer, db.ForeignKey("user.id"))
+    item = db.relationship("OrderItem")
+    __table_args__ = (db.Index("ix_return_request_status", "status", "id"),)
+
+# Money owed for an approved return; ids are in approval order, which the settlement job walks with a checkpoint
+class Refund(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    return_id = db.Column(db.Integer, db.ForeignKey("return_request.id"), nullable=False, unique=True)
+    order_id = db.Column(db.Integer, db.ForeignKey("order.id"), nullable=False, index=True)
+    amount_paise = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(10), nullable=False, default="pending")  # pending, settled
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    settled_at = db.Column(db.DateTime)
+
+# Returned units to put back into inventory batches; exported for the inventory app's receive-stock
+class RestockLine(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    refund_id = db.Column(db.Integer, db.ForeignKey("refund.id"), nullable=False)
+    medicine_name = db.Column(db.String(100), nullable=False)
+    batch_no = db.Column(db.String(50), nullable=False)
+    expiry = db.Column(db.Date, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    exported_at = db.Column(db.DateTime, index=True)
+
+# Every status an order has entered, in order; ids double as a change feed for long-poll waiters
+class OrderStatusChange(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey("order.id"), nullable=False)
+    from_status = db.Column(db.String(12))
+    to_status = db.Column(db.String(12), nullable=False)
+    changed_by = db.Column(db.Integer, db.ForeignKey("user.id"))
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index("ix_order_status_change_order", "order_id", "id"),)
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -41,10 +218,183 @@ class OrderItem(db.Model):
     medicine_name = db.Column(db.String(100))
     quantity = db.Column(db.Integer)
     price = db.Column(db.Float)
+    # GST breakdown fixed at order time, in paise; None on orders placed before it was recorded
+    hsn_code = db.Column(db.String(10))
+    tax_rate_bp = db.Column(db.Integer)
+    taxable_paise = db.Column(db.Integer)
+    cgst_paise = db.Column(db.Integer)
+    sgst_paise = db.Column(db.Integer)
+    amount_paise = db.Column(db.Integer)
+    __table_args__ = (db.Index("ix_order_item_order", "order_id", "id"),)
+
+# GST slab; rate_bp is in basis points (1200 = 12%) and prices include the tax
+class TaxClass(db.Model):
+    code = db.Column(db.String(10), primary_key=True)
+    rate_bp = db.Column(db.Integer, nullable=False)
+    hsn_code = db.Column(db.String(10), nullable=False)
+
+# Promotion: scoped to a medicine, a category, or (neither set) the whole basket.
+# kind is "percent", "flat" (per unit on lines, per order on baskets) or "bogo" (value = units bought per free unit).
+class DiscountRule(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    code = db.Column(db.String(30), index=True)  # coupon code; rules without one apply automatically
+    kind = db.Column(db.String(10), nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    medicine_id = db.Column(db.Integer, db.ForeignKey("medicine.id"))
+    category = db.Column(db.String(50))
+    min_basket = db.Column(db.Float, nullable=False, default=0)
+    starts_at = db.Column(db.DateTime)
+    ends_at = db.Column(db.DateTime)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+
+# Delivery window for a zone; booked is only ever changed by a conditional UPDATE (see book_slot)
+class DeliverySlot(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    zone = db.Column(db.String(50), nullable=False)
+    starts_at = db.Column(db.DateTime, nullable=False)
+    ends_at = db.Column(db.DateTime, nullable=False)
+    capacity = db.Column(db.Integer, nullable=False)
+    booked = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint("zone", "starts_at"), db.Index("ix_delivery_slot_starts", "starts_at"))
+
+# Rendered invoice PDF of an order; content_hash covers the order data it was rendered from
+class Invoice(db.Model):
+    order_id = db.Column(db.Integer, db.ForeignKey("order.id"), primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False)
+    path = db.Column(db.String(300), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# How often two medicines were bought in the same order (stored both ways round)
+class CoPurchase(db.Model):
+    medicine_id = db.Column(db.Integer, db.ForeignKey("medicine.id"), primary_key=True)
+    other_id = db.Column(db.Integer, db.ForeignKey("medicine.id"), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index("ix_co_purchase_rank", "medicine_id", "count"),)
+
+# Last row an offline job has fully processed, so reruns only pick up new data
+class JobCheckpoint(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+
+# Bumped whenever the data behind an in-memory index changes, so running workers reload it
+class IndexVersion(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+# Active ingredients of a medicine (lower-cased, single-spaced)
+class MedicineIngredient(db.Model):
+    medicine_id = db.Column(db.Integer, db.ForeignKey("medicine.id"), primary_key=True)
+    ingredient = db.Column(db.String(100), primary_key=True)
+
+# Known interaction between two ingredients, stored once with ingredient_a < ingredient_b
+class Interaction(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    ingredient_a = db.Column(db.String(100), nullable=False)
+    ingredient_b = db.Column(db.String(100), nullable=False)
+    severity = db.Column(db.String(20), nullable=False, default="moderate")
+    note = db.Column(db.String(300))
+    __table_args__ = (db.UniqueConstraint("ingredient_a", "ingredient_b"),)
+
+class Prescription(db.Model):
+    __bind_key__ = "prescriptions"
+    id = db.Column(db.Integer, primary_key=True)
+    patient_name = db.Column(db.String(120), nullable=False)
+    age = db.Column(db.Integer, nullable=False)
+    medicine = db.Column(db.String(400), nullable=False)
+    dosage = db.Column(db.String(200), nullable=False)
+    notes = db.Column(db.String(500))
+    created_by = db.Column(db.String(80))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    patient_key = db.Column(db.String(120))
+    matches = db.relationship("PrescriptionMatch", backref="prescription", lazy=True,
+                              order_by="PrescriptionMatch.line_no")
+    images = db.relationship("PrescriptionImage", backref="prescription", lazy=True,
+                             order_by="PrescriptionImage.id")
+    __table_args__ = (db.Index("ix_prescription_patient_timeline", "patient_key", "created_at", "id"),
+                      db.Index("ix_prescription_created_at", "created_at"))
+
+    @validates("patient_name")
+    def _set_patient_key(self, key, patient_name):
+        self.patient_key = normalize_patient(patient_name)
+        return patient_name
+
+# Uploaded photo of a prescription; the variants are filled in by the image worker pool
+class PrescriptionImage(db.Model):
+    __bind_key__ = "prescriptions"
+    id = db.Column(db.Integer, primary_key=True)
+    prescription_id = db.Column(db.Integer, db.ForeignKey("prescription.id"), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default="pending")
+    original = db.Column(db.String(300), nullable=False)
+    large = db.Column(db.String(300))
+    thumb = db.Column(db.String(300))
+    thumb_jpeg = db.Column(db.String(300))
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# One line of a prescription resolved against the catalog (medicine_id is None when nothing matched)
+class PrescriptionMatch(db.Model):
+    __bind_key__ = "prescriptions"
+    prescription_id = db.Column(db.Integer, db.ForeignKey("prescription.id"), primary_key=True)
+    line_no = db.Column(db.Integer, primary_key=True)
+    line = db.Column(db.String(400), nullable=False)
+    medicine_id = db.Column(db.Integer)
+    confidence = db.Column(db.Float, nullable=False, default=0)
 
 # ----------------------- INITIAL SETUP -----------------------
+def normalize_patient(name):
+    """'  Ravi   KUMAR.' -> 'ravi kumar'"""
+    return " ".join(re.findall(r"[a-z0-9]+", (name or "").lower()))
+
+def upgrade_schema():
+    """create_all() never touches existing tables: add any newer columns and indexes to them."""
+    for bind_key, metadata in db.metadatas.items():
+        engine = db.engines[bind_key]
+        inspector = inspect(engine)
+        quote = engine.dialect.identifier_preparer.quote
+        with engine.begin() as conn:
+            for table in metadata.sorted_tables:
+                existing = {c["name"] for c in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing:
+                        conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN "
+                                          f"{quote(column.name)} {column.type.compile(engine.dialect)}"))
+                for index in table.indexes:
+                    index.create(conn, checkfirst=True)
+
+def backfill_patient_keys(batch_size=1000):
+    """Fill patient_key for prescriptions written before the column existed or by other apps sharing the database.
+
+    Only this app's ORM sets the key on insert, and a trigger cannot compute it without normalize_patient()
+    registered on every writer's connection, so readers of patient_key call this first. Finding no NULL
+    keys is a single lookup on ix_prescription_patient_timeline.
+    """
+    while True:
+        batch = Prescription.query.filter(Prescription.patient_key.is_(None)).limit(batch_size).all()
+        if not batch:
+            break
+        for prescription in batch:
+            prescription.patient_key = normalize_patient(prescription.patient_name)
+        db.session.commit()
+
+def merge_duplicate_cart_lines():
+    """Fold repeated (user, medicine) cart rows into one, so the unique cart index can be built."""
+    with db.engine.begin() as conn:
+        conn.execute(text("UPDATE cart SET quantity = (SELECT SUM(c.quantity) FROM cart c WHERE c.user_id = cart.user_id "
+                          "AND c.medicine_id = cart.medicine_id) WHERE id IN (SELECT MIN(id) FROM cart "
+                          "GROUP BY user_id, medicine_id HAVING COUNT(*) > 1)"))
+        conn.execute(text("DELETE FROM cart WHERE id NOT IN (SELECT MIN(id) FROM cart GROUP BY user_id, medicine_id)"))
+
 def create_tables():
     db.create_all()
+    merge_duplicate_cart_lines()
+    upgrade_schema()
+    backfill_patient_keys()
+    backfill_prices()
+    # orders from before statuses were tracked have long since been handed over
+    Order.query.filter(Order.status.is_(None)).update({"status": "delivered"})
+    db.session.commit()
     if not Medicine.query.first():
         meds = [
             Medicine(name="Paracetamol", price=20),
@@ -53,7 +403,1762 @@ def create_tables():
             Medicine(name="Vitamin C", price=35),
         ]
         db.session.bulk_save_objects(meds)
+        bump_index_version("catalog")
+        db.session.commit()
+        backfill_prices()
+    if not TaxClass.query.first():
+        db.session.add_all([TaxClass(code=code, rate_bp=rate_bp, hsn_code="3004") for code, rate_bp in GST_SLABS])
+        db.session.commit()
+
+# ----------------------- RECOMMENDATIONS -----------------------
+ALSO_BOUGHT_K = 8
+
+class TopKIndex:
+    """Top-K co-purchased medicine ids per medicine, packed into one flat int array.
+
+    Slot ``medicine_id * k`` starts that medicine's neighbours, best first; 0 marks an empty slot.
+    """
+    def __init__(self, k, size, version=0):
+        self.k = k
+        self.version = version
+        self.slots = array("i", bytes(4 * k * size))
+
+    def neighbours(self, medicine_id):
+        start = medicine_id * self.k
+        if start < 0 or start >= len(self.slots):
+            return []
+        return [m for m in self.slots[start:start + self.k] if m]
+
+    def save(self, path):
+        """Write k and the slots to ``path``, replacing it atomically."""
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            array("i", [self.k]).tofile(f)
+            self.slots.tofile(f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, version=0):
+        with open(path, "rb") as f:
+            header = array("i")
+            header.fromfile(f, 1)
+            index = cls(header[0], 0, version=version)
+            index.slots.frombytes(f.read())
+        return index
+
+def update_co_purchases(batch_size=5000, flush_pairs=200000):
+    """Fold order lines newer than the checkpoint into CoPurchase, in bounded memory.
+
+    Lines are read in (order_id, id) keyset batches and pair counts are flushed whenever
+    ``flush_pairs`` distinct pairs have piled up, together with the checkpoint, so an
+    interrupted run can simply be restarted. Returns the number of orders processed.
+    """
+    checkpoint = db.session.get(JobCheckpoint, "co_purchase")
+    if checkpoint is None:
+        checkpoint = JobCheckpoint(name="co_purchase", last_id=0)
+        db.session.add(checkpoint)
+    name_to_id = dict(db.session.query(Medicine.name, Medicine.id))
+    pairs = Counter()
+    basket, basket_order = set(), None
+    position = (checkpoint.last_id, 0)
+    processed = 0
+
+    def flush(done_order):
+        for (medicine_id, other_id), count in pairs.items():
+            stmt = sqlite_insert(CoPurchase).values(medicine_id=medicine_id, other_id=other_id, count=count)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=["medicine_id", "other_id"],
+                set_={"count": CoPurchase.count + stmt.excluded.count}))
+        pairs.clear()
+        checkpoint.last_id = done_order
+        db.session.commit()
+
+    new_lines = (db.session.query(OrderItem.order_id, OrderItem.id, OrderItem.medicine_name)
+                 .filter(OrderItem.order_id > checkpoint.last_id))
+    while True:
+        rows = (new_lines.filter(tuple_(OrderItem.order_id, OrderItem.id) > position)
+                .order_by(OrderItem.order_id, OrderItem.id)
+                .limit(batch_size).all())
+        if not rows:
+            break
+        for order_id, item_id, medicine_name in rows:
+            if order_id != basket_order:
+                if basket_order is not None:
+                    for a in basket:
+                        for b in basket:
+                            if a != b:
+                                pairs[(a, b)] += 1
+                    processed += 1
+                    if len(pairs) >= flush_pairs:
+                        flush(basket_order)
+                basket, basket_order = set(), order_id
+            medicine_id = name_to_id.get(medicine_name)
+            if medicine_id:
+                basket.add(medicine_id)
+        position = (rows[-1][0], rows[-1][1])
+
+    if basket_order is not None:
+        for a in basket:
+            for b in basket:
+                if a != b:
+                    pairs[(a, b)] += 1
+        processed += 1
+        flush(basket_order)
+    return processed
+
+def build_also_bought_index(k=ALSO_BOUGHT_K):
+    """Load the strongest ``k`` neighbours of every medicine from CoPurchase (a full scan; job only)."""
+    checkpoint = db.session.get(JobCheckpoint, "co_purchase")
+    size = (db.session.query(func.max(Medicine.id)).scalar() or 0) + 1
+    index = TopKIndex(k, size, version=checkpoint.last_id if checkpoint else 0)
+    filled, current = 0, None
+    rows = (db.session.query(CoPurchase.medicine_id, CoPurchase.other_id)
+            .filter(CoPurchase.medicine_id < size, CoPurchase.other_id < size)
+            .order_by(CoPurchase.medicine_id, CoPurchase.count.desc())
+            .yield_per(10000))
+    for medicine_id, other_id in rows:
+        if medicine_id != current:
+            current, filled = medicine_id, 0
+        if filled < k:
+            index.slots[medicine_id * k + filled] = other_id
+            filled += 1
+    return index
+
+def also_bought_index_path():
+    return os.path.join(app.instance_path, "also_bought.idx")
+
+def publish_also_bought_index():
+    """Build the index from CoPurchase, write it out and bump its version so running workers load it."""
+    os.makedirs(app.instance_path, exist_ok=True)
+    build_also_bought_index().save(also_bought_index_path())
+    bump_index_version("also_bought")
+    db.session.commit()
+
+_also_bought = None
+
+def also_bought_index():
+    """The TopKIndex last published by the recommendation job, loaded from disk once per version.
+
+    Requests never scan CoPurchase; until the job has published an index there are no suggestions.
+    """
+    global _also_bought
+    version = index_version("also_bought")
+    if _also_bought is None or _also_bought.version != version:
+        path = also_bought_index_path()
+        _also_bought = (TopKIndex.load(path, version=version) if os.path.exists(path)
+                        else TopKIndex(ALSO_BOUGHT_K, 0, version=version))
+    return _also_bought
+
+def also_bought_for(medicine_ids, limit=4):
+    """Suggestions for a cart holding ``medicine_ids``, strongest first."""
+    if not medicine_ids:
+        return []
+    index = also_bought_index()
+    suggestions = []
+    for medicine_id in medicine_ids:
+        for other_id in index.neighbours(medicine_id):
+            if other_id not in medicine_ids and other_id not in suggestions:
+                suggestions.append(other_id)
+    suggestions = suggestions[:limit]
+    if not suggestions:
+        return []
+    by_id = {m.id: m for m in Medicine.query.filter(Medicine.id.in_(suggestions))}
+    return [by_id[m] for m in suggestions if m in by_id]
+
+def index_version(name):
+    row = db.session.get(IndexVersion, name)
+    return row.version if row else 0
+
+def bump_index_version(name):
+    row = db.session.get(IndexVersion, name)
+    if row is None:
+        row = IndexVersion(name=name, version=0)
+        db.session.add(row)
+    row.version += 1
+
+# ----------------------- DRUG INTERACTIONS -----------------------
+SEVERITY_RANK = {"major": 0, "moderate": 1, "minor": 2}
+
+def normalize_ingredient(name):
+    return " ".join(name.lower().split())
+
+class InteractionIndex:
+    """Ingredient adjacency map plus each medicine's ingredient set, compiled from the tables."""
+    def __init__(self, version=0):
+        self.version = version
+        self.adjacent = {}
+        self.ingredients = {}
+
+    def add_interaction(self, a, b, severity, note):
+        self.adjacent.setdefault(a, {})[b] = (severity, note)
+        self.adjacent.setdefault(b, {})[a] = (severity, note)
+
+    def check(self, medicine_id, other_ids):
+        """Warnings for adding ``medicine_id`` to a cart that already holds ``other_ids``."""
+        warnings = []
+        for ingredient in self.ingredients.get(medicine_id, ()):
+            neighbours = self.adjacent.get(ingredient)
+            if not neighbours:
+                continue
+            for other_id in other_ids:
+                if other_id == medicine_id:
+                    continue
+                for other_ingredient in self.ingredients.get(other_id, ()):
+                    hit = neighbours.get(other_ingredient)
+                    if hit:
+                        warnings.append({"medicine_id": medicine_id, "other_id": other_id,
+                                         "ingredients": (ingredient, other_ingredient),
+                                         "severity": hit[0], "note": hit[1]})
+        return warnings
+
+    def check_all(self, medicine_ids):
+        """Warnings for a whole cart, checking each line only against the lines before it."""
+        warnings = []
+        for position, medicine_id in enumerate(medicine_ids):
+            warnings.extend(self.check(medicine_id, medicine_ids[:position]))
+        warnings.sort(key=lambda w: SEVERITY_RANK.get(w["severity"], len(SEVERITY_RANK)))
+        return warnings
+
+def build_interaction_index():
+    index = InteractionIndex(version=index_version("interactions"))
+    for a, b, severity, note in db.session.query(Interaction.ingredient_a, Interaction.ingredient_b,
+                                                 Interaction.severity, Interaction.note):
+        index.add_interaction(a, b, severity, note)
+    ingredients = {}
+    for medicine_id, ingredient in db.session.query(MedicineIngredient.medicine_id, MedicineIngredient.ingredient):
+        ingredients.setdefault(medicine_id, set()).add(ingredient)
+    index.ingredients = {m: frozenset(i) for m, i in ingredients.items()}
+    return index
+
+_interactions = None
+
+def interaction_index():
+    global _interactions
+    version = index_version("interactions")
+    if _interactions is None or _interactions.version != version:
+        _interactions = build_interaction_index()
+    return _interactions
+
+def describe_interactions(warnings):
+    """Attach medicine names to warnings for display."""
+    ids = {w["medicine_id"] for w in warnings} | {w["other_id"] for w in warnings}
+    names = dict(db.session.query(Medicine.id, Medicine.name).filter(Medicine.id.in_(ids))) if ids else {}
+    for w in warnings:
+        w["medicine"] = names.get(w["medicine_id"], "?")
+        w["other"] = names.get(w["other_id"], "?")
+    return warnings
+
+def import_interactions_csv(path):
+    """Upsert rows of ingredient_a,ingredient_b,severity,note. Returns the row count."""
+    count = 0
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            a, b = sorted((normalize_ingredient(row["ingredient_a"]), normalize_ingredient(row["ingredient_b"])))
+            severity = (row.get("severity") or "moderate").strip().lower()
+            stmt = sqlite_insert(Interaction).values(ingredient_a=a, ingredient_b=b, severity=severity,
+                                                     note=(row.get("note") or "").strip() or None)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=["ingredient_a", "ingredient_b"],
+                set_={"severity": stmt.excluded.severity, "note": stmt.excluded.note}))
+            count += 1
+    bump_index_version("interactions")
+    db.session.commit()
+    return count
+
+def import_ingredients_csv(path):
+    """Load rows of medicine,ingredient (medicine matched by name). Returns (loaded, unknown names)."""
+    name_to_id = dict(db.session.query(Medicine.name, Medicine.id))
+    loaded, unknown = 0, set()
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            medicine_id = name_to_id.get(row["medicine"].strip())
+            if medicine_id is None:
+                unknown.add(row["medicine"].strip())
+                continue
+            stmt = sqlite_insert(MedicineIngredient).values(medicine_id=medicine_id,
+                                                            ingredient=normalize_ingredient(row["ingredient"]))
+            db.session.execute(stmt.on_conflict_do_nothing())
+            loaded += 1
+    bump_index_version("interactions")
+    db.session.commit()
+    return loaded, sorted(unknown)
+
+# ----------------------- PRESCRIPTION MATCHING -----------------------
+MATCH_ACCEPT = 0.65
+MATCH_SUGGEST = 0.4
+STRENGTH_RE = re.compile(r"(\d+(?:\.\d+)?)\s*(mg|mcg|g|ml|iu|%)\b")
+FORM_WORDS = {"tab", "tabs", "tablet", "tablets", "cap", "caps", "capsule", "capsules", "syp", "syrup",
+              "inj", "injection", "drops", "cream", "gel", "oint", "ointment", "susp", "suspension"}
+DOSING_WORDS = {"od", "bd", "bid", "tds", "tid", "qid", "hs", "sos", "prn", "stat", "once", "twice", "thrice",
+                "daily", "day", "days", "week", "weeks", "x", "after", "before", "food", "meal", "meals",
+                "morning", "night", "for", "and", "with", "take"}
+
+def split_prescription(text):
+    """Free-text prescription -> list of medicine lines."""
+    return [line.strip() for line in re.split(r"[\n;,]+", text or "") if line.strip()]
+
+def parse_medicine_line(line):
+    """Return (name tokens, strengths) for one prescription line, dropping form and dosing words."""
+    line = line.lower()
+    strengths = {f"{float(n):g}{unit}" for n, unit in STRENGTH_RE.findall(line)}
+    line = STRENGTH_RE.sub(" ", line)
+    tokens = [t for t in re.findall(r"[a-z]+", line) if t not in FORM_WORDS and t not in DOSING_WORDS]
+    return tokens, strengths
+
+def trigrams(tokens):
+    grams = set()
+    for token in tokens:
+        padded = f"  {token} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+class CatalogMatcher:
+    """Token and trigram index over medicine names, used to resolve free-text prescription lines."""
+    def __init__(self, medicines, version=0):
+        self.version = version
+        self.by_token = {}
+        self.by_trigram = {}
+        self.names = {}
+        for medicine_id, name in medicines:
+            tokens, strengths = parse_medicine_line(name)
+            grams = trigrams(tokens)
+            self.names[medicine_id] = (set(tokens), strengths, len(grams))
+            for token in tokens:
+                self.by_token.setdefault(token, []).append(medicine_id)
+            for gram in grams:
+                self.by_trigram.setdefault(gram, []).append(medicine_id)
+
+    def match(self, line, limit=3):
+        """Best catalog candidates for ``line`` as [(medicine_id, confidence)], highest first."""
+        tokens, strengths = parse_medicine_line(line)
+        if not tokens:
+            return []
+        grams = trigrams(tokens)
+        shared = Counter()
+        for gram in grams:
+            for medicine_id in self.by_trigram.get(gram, ()):
+                shared[medicine_id] += 1
+        for token in tokens:
+            for medicine_id in self.by_token.get(token, ()):
+                shared.setdefault(medicine_id, 0)
+        scored = []
+        query_tokens = set(tokens)
+        for medicine_id, common in shared.items():
+            name_tokens, name_strengths, name_grams = self.names[medicine_id]
+            similarity = common / (len(grams) + name_grams - common)
+            coverage = common / name_grams if name_grams else 0
+            token_overlap = len(query_tokens & name_tokens) / len(name_tokens) if name_tokens else 0
+            confidence = 0.5 * similarity + 0.5 * max(coverage, token_overlap)
+            if strengths and name_strengths:
+                confidence += 0.1 if strengths & name_strengths else -0.2
+            scored.append((medicine_id, round(max(0.0, min(confidence, 1.0)), 3)))
+        scored.sort(key=lambda m: -m[1])
+        return [m for m in scored[:limit] if m[1] >= MATCH_SUGGEST]
+
+_matcher = None
+
+def catalog_matcher():
+    global _matcher
+    version = index_version("catalog")
+    if _matcher is None or _matcher.version != version:
+        _matcher = CatalogMatcher(db.session.query(Medicine.id, Medicine.name), version=version)
+    return _matcher
+
+def match_prescription(prescription):
+    """Replace the stored line matches of one prescription and return them (caller commits).
+
+    The rows are added to the session, not to ``prescription.matches``, which stays stale until reloaded.
+    """
+    matcher = catalog_matcher()
+    PrescriptionMatch.query.filter_by(prescription_id=prescription.id).delete()
+    matches = []
+    for line_no, line in enumerate(split_prescription(prescription.medicine)):
+        best = matcher.match(line, limit=1)
+        matches.append(PrescriptionMatch(prescription_id=prescription.id, line_no=line_no, line=line[:400],
+                                         medicine_id=best[0][0] if best else None,
+                                         confidence=best[0][1] if best else 0))
+    db.session.add_all(matches)
+    return matches
+
+def match_prescription_backlog(batch_size=500):
+    """Match prescriptions added since the last run, committing after every keyset batch."""
+    backfill_patient_keys()
+    checkpoint = db.session.get(JobCheckpoint, "prescription_match")
+    if checkpoint is None:
+        checkpoint = JobCheckpoint(name="prescription_match", last_id=0)
+        db.session.add(checkpoint)
+    processed = 0
+    while True:
+        batch = (Prescription.query.filter(Prescription.id > checkpoint.last_id)
+                 .order_by(Prescription.id).limit(batch_size).all())
+        if not batch:
+            break
+        for prescription in batch:
+            match_prescription(prescription)
+        checkpoint.last_id = batch[-1].id
+        db.session.commit()
+        processed += len(batch)
+    return processed
+
+# ----------------------- PRESCRIPTION IMAGES -----------------------
+MAX_PRESCRIPTION_UPLOAD = 20 * 1024 * 1024
+UPLOAD_CHUNK = 64 * 1024
+# werkzeug refuses larger bodies before spooling them; the slack covers multipart headers
+app.config["MAX_CONTENT_LENGTH"] = MAX_PRESCRIPTION_UPLOAD + UPLOAD_CHUNK
+IMAGE_VARIANTS = {"large": 1600, "thumb": 320}
+
+def prescription_upload_dir(prescription_id):
+    return os.path.join(app.instance_path, "uploads", "prescriptions", str(prescription_id))
+
+def save_upload_stream(stream, path, max_bytes):
+    """Copy an upload to ``path`` chunk by chunk; returns False (and removes the file) if it is too big."""
+    written = 0
+    with open(path, "wb") as f:
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK)
+            if not chunk:
+                return True
+            written += len(chunk)
+            if written > max_bytes:
+                break
+            f.write(chunk)
+    os.remove(path)
+    return False
+
+def process_prescription_image(original, out_dir, stem):
+    """Runs in the worker pool: decode, fix EXIF orientation, downscale and re-encode every variant.
+
+    Returns the variant paths and the (width, height) of the large variant.
+    """
+    paths = {}
+    with Image.open(original) as img:
+        largest = max(IMAGE_VARIANTS.values())
+        img.draft("RGB", (largest, largest))  # JPEG decodes at reduced scale, much faster for phone photos
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        size = None
+        for variant, width in sorted(IMAGE_VARIANTS.items(), key=lambda v: -v[1]):
+            img.thumbnail((width, width), Image.LANCZOS)
+            size = size or img.size
+            paths[variant] = os.path.join(out_dir, f"{stem}-{variant}.webp")
+            img.save(paths[variant], "WEBP", quality=80, method=4)
+        paths["thumb_jpeg"] = os.path.join(out_dir, f"{stem}-thumb.jpg")
+        img.save(paths["thumb_jpeg"], "JPEG", quality=80, optimize=True, progressive=True)
+    return paths, size
+
+_worker_pool = None
+
+def worker_pool():
+    """Process pool for CPU-heavy work (images, PDFs) that must stay off the request threads."""
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = ProcessPoolExecutor(max_workers=max(1, min(4, (os.cpu_count() or 2) - 1)))
+    return _worker_pool
+
+def record_processed_image(image_id, future):
+    """Done-callback for the worker pool: store variant paths (or the failure) on the image row."""
+    with app.app_context():
+        image = db.session.get(PrescriptionImage, image_id)
+        if image is None:
+            return
+        try:
+            paths, (image.width, image.height) = future.result()
+        except Exception:
+            app.logger.exception("Processing prescription image %s failed", image_id)
+            image.status = "failed"
+        else:
+            image.large, image.thumb, image.thumb_jpeg = paths["large"], paths["thumb"], paths["thumb_jpeg"]
+            image.status = "ready"
+        db.session.commit()
+
+# ----------------------- DISCOUNTS -----------------------
+DISCOUNT_KINDS = ("percent", "flat", "bogo")
+
+class OfferLadder:
+    """Best offer of each kind for every min-basket threshold of one scope.
+
+    Thresholds are sorted and ``best[i]`` holds the best percent, flat and BOGO offer among rules
+    with ``min_basket <= thresholds[i]``, so a lookup is one bisect however many rules there are.
+    """
+    def __init__(self, rules):
+        rules = sorted(rules, key=lambda r: r.min_basket)
+        self.thresholds, self.best = [], []
+        best = {"percent": (0, None), "flat": (0, None), "bogo": (0, None)}
+        for rule in rules:
+            current = best[rule.kind]
+            if rule.kind == "bogo":
+                # fewer units to buy per free one is better; 0 means no offer
+                if rule.value < 1:
+                    continue  # import_discounts_csv refuses these; don't let an old one take the slot
+                if not current[1] or rule.value < current[0]:
+                    best[rule.kind] = (int(rule.value), rule.id)
+            elif rule.value > current[0]:
+                best[rule.kind] = (rule.value, rule.id)
+            if self.thresholds and self.thresholds[-1] == rule.min_basket:
+                self.best[-1] = dict(best)
+            else:
+                self.thresholds.append(rule.min_basket)
+                self.best.append(dict(best))
+
+    def at(self, subtotal):
+        i = bisect_right(self.thresholds, subtotal) - 1
+        return self.best[i] if i >= 0 else None
+
+def line_discount(offers, unit_price, quantity):
+    """(amount, rule id) of the best single offer on one cart line."""
+    gross = unit_price * quantity
+    percent, flat, (bogo_n, bogo_rule) = offers["percent"], offers["flat"], offers["bogo"]
+    candidates = [(gross * percent[0] / 100, percent[1]), (min(flat[0] * quantity, gross), flat[1])]
+    if bogo_n:
+        candidates.append((quantity // (bogo_n + 1) * unit_price, bogo_rule))
+    return max(candidates, key=lambda c: c[0])
+
+class DiscountEngine:
+    """Active rules compiled into per-scope OfferLadders, for one coupon code (or none) each.
+
+    Pricing a cart is one pass for the subtotal and one over the lines, each line looking up
+    only its own medicine's and category's ladders, so the cost is linear in cart lines.
+    """
+    def __init__(self, rules, now, version=0):
+        self.version = version
+        self.names = {r.id: r.name for r in rules}
+        # recompile when the next rule starts or ends
+        edges = [t for r in rules for t in (r.starts_at, r.ends_at) if t and t > now]
+        self.valid_until = min(edges, default=datetime.max)
+        grouped = {}
+        for r in rules:
+            if (r.starts_at and r.starts_at > now) or (r.ends_at and r.ends_at <= now) or r.kind not in DISCOUNT_KINDS:
+                continue
+            scope = ("medicine", r.medicine_id) if r.medicine_id else ("category", r.category) if r.category else ("basket",)
+            if scope == ("basket",) and r.kind == "bogo":
+                continue
+            grouped.setdefault((r.code or None, scope), []).append(r)
+        self.ladders = {key: OfferLadder(group) for key, group in grouped.items()}
+        self.codes = {code for code, _ in self.ladders if code}
+
+    def price(self, lines, coupon=None):
+        """Price [(medicine_id, category, unit_price, quantity)] lines with the best offers available.
+
+        Each line gets its best single offer; the basket offer then applies to what is left.
+        """
+        coupon = (coupon or "").strip().upper() or None
+        codes = (None, coupon) if coupon in self.codes else (None,)
+        subtotal = sum(unit_price * quantity for _, _, unit_price, quantity in lines)
+        priced = []
+        for medicine_id, category, unit_price, quantity in lines:
+            best = (0, None)
+            for code in codes:
+                for scope in (("medicine", medicine_id), ("category", category)):
+                    ladder = self.ladders.get((code, scope))
+                    offers = ladder.at(subtotal) if ladder else None
+                    if offers:
+                        best = max(best, line_discount(offers, unit_price, quantity), key=lambda c: c[0])
+            gross = unit_price * quantity
+            priced.append({"gross": gross, "discount": round(best[0], 2), "net": round(gross - best[0], 2),
+                           "rule": self.names.get(best[1])})
+        net = sum(line["net"] for line in priced)
+        basket = (0, None)
+        for code in codes:
+            ladder = self.ladders.get((code, ("basket",)))
+            offers = ladder.at(subtotal) if ladder else None
+            if offers:
+                percent, flat = offers["percent"], offers["flat"]
+                basket = max(basket, (net * percent[0] / 100, percent[1]), (min(flat[0], net), flat[1]),
+                             key=lambda c: c[0])
+        basket_discount = round(basket[0], 2)
+        return {"lines": priced, "subtotal": round(subtotal, 2), "basket_discount": basket_discount,
+                "basket_rule": self.names.get(basket[1]), "total": round(net - basket_discount, 2),
+                "coupon": coupon if coupon in self.codes else None, "coupon_invalid": bool(coupon) and coupon not in self.codes}
+
+_discounts = None
+
+def discount_engine():
+    """The cached DiscountEngine, recompiled when rules change or one starts or ends."""
+    global _discounts
+    version, now = index_version("discounts"), datetime.utcnow()
+    if _discounts is None or _discounts.version != version or now >= _discounts.valid_until:
+        rules = DiscountRule.query.filter(DiscountRule.active.is_(True),
+                                          or_(DiscountRule.ends_at.is_(None), DiscountRule.ends_at > now)).all()
+        _discounts = DiscountEngine(rules, now, version)
+    return _discounts
+
+def price_cart(cart_items, coupon=None):
+    return discount_engine().price(
+        [(item.medicine_id, item.medicine.category, item.medicine.price, item.quantity) for item in cart_items], coupon)
+
+def import_discounts_csv(path):
+    """Replace all rules with those in a CSV (name,code,kind,value,medicine,category,min_basket,starts_at,ends_at).
+
+    Rows with an unknown kind, or a BOGO value under 1 unit bought per free unit, are skipped.
+    Returns (rules imported, names of skipped rows).
+    """
+    name_to_id = dict(db.session.query(Medicine.name, Medicine.id))
+    when = lambda v: datetime.fromisoformat(v) if v else None
+    rules, skipped = [], []
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            if row["kind"] not in DISCOUNT_KINDS or (row["kind"] == "bogo" and float(row["value"]) < 1):
+                skipped.append(row["name"])
+                continue
+            rules.append(DiscountRule(
+                name=row["name"], code=(row.get("code") or "").strip().upper() or None, kind=row["kind"],
+                value=float(row["value"]), medicine_id=name_to_id.get(row.get("medicine") or ""),
+                category=row.get("category") or None, min_basket=float(row.get("min_basket") or 0),
+                starts_at=when(row.get("starts_at")), ends_at=when(row.get("ends_at"))))
+    DiscountRule.query.delete()
+    db.session.add_all(rules)
+    bump_index_version("discounts")
+    db.session.commit()
+    return len(rules), skipped
+
+# ----------------------- PRICES -----------------------
+def backfill_prices():
+    """Open a price history row for medicines without one and snapshot cart lines added before snapshots."""
+    with db.engine.begin() as conn:
+        conn.execute(text("INSERT INTO price_history (medicine_id, price, valid_from) "
+                          "SELECT id, price, COALESCE(updated_at, CURRENT_TIMESTAMP) FROM medicine "
+                          "WHERE id NOT IN (SELECT medicine_id FROM price_history WHERE valid_to IS NULL)"))
+        conn.execute(text("UPDATE cart SET price_snapshot = (SELECT price FROM medicine WHERE medicine.id = cart.medicine_id) "
+                          "WHERE price_snapshot IS NULL"))
+
+def set_price(medicine_id, price, at=None):
+    """Change a medicine's price from ``at`` on, closing its open history row (caller commits).
+
+    Medicine.price changes straight away, so ``at`` can't be in the future, and it can't be before
+    the current price started either; both raise ValueError.
+    """
+    now = datetime.utcnow()
+    at = at or now
+    if at > now:
+        raise ValueError("Price changes can't be scheduled ahead; apply them when they take effect")
+    closed = (PriceHistory.query.filter(PriceHistory.medicine_id == medicine_id, PriceHistory.valid_to.is_(None),
+                                        PriceHistory.valid_from <= at)
+              .update({"valid_to": at}, synchronize_session=False))
+    if not closed and db.session.query(PriceHistory.id).filter(PriceHistory.medicine_id == medicine_id,
+                                                               PriceHistory.valid_to.is_(None)).first():
+        raise ValueError(f"Medicine #{medicine_id} already has a price from after {at:%Y-%m-%d %H:%M}")
+    db.session.add(PriceHistory(medicine_id=medicine_id, price=price, valid_from=at))
+    Medicine.query.filter_by(id=medicine_id).update({"price": price}, synchronize_session=False)
+    bump_index_version("catalog")
+
+def price_as_of(medicine_id, at):
+    """The price a medicine had at ``at``, or None if it is older than its history; one ix_price_history_asof seek."""
+    return (db.session.query(PriceHistory.price)
+            .filter(PriceHistory.medicine_id == medicine_id, PriceHistory.valid_from <= at,
+                    or_(PriceHistory.valid_to.is_(None), PriceHistory.valid_to > at))
+            .order_by(PriceHistory.valid_from.desc()).limit(1).scalar())
+
+def changed_cart_lines(user_id):
+    """{cart line id: (snapshot price, live price)} for lines whose medicine has been repriced since they were added."""
+    return {line_id: (was, now) for line_id, was, now
+            in db.session.query(Cart.id, Cart.price_snapshot, Medicine.price).join(Cart.medicine)
+            .filter(Cart.user_id == user_id, Cart.price_snapshot != Medicine.price)}
+
+def accept_cart_prices(user_id, shown):
+    """Move cart lines' snapshots to the prices the customer was shown ({line id: price}) (caller commits).
+
+    A line is only updated while its live price still equals the shown one, so a change made after
+    the page was rendered stays flagged.
+    """
+    if not shown:
+        return
+    cart_table, medicine_table = Cart.__table__, Medicine.__table__
+    live_price = (db.select(medicine_table.c.price).where(medicine_table.c.id == cart_table.c.medicine_id)
+                  .scalar_subquery())
+    db.session.execute(update(cart_table)
+                       .where(cart_table.c.id == bindparam("line_id"), cart_table.c.user_id == user_id,
+                              live_price == bindparam("shown"))
+                       .values(price_snapshot=bindparam("shown")),
+                       [{"line_id": line_id, "shown": price} for line_id, price in shown.items()])
+
+def import_prices_csv(path, at=None):
+    """Apply a CSV with medicine,price columns; unchanged prices are skipped. Returns (changed, unknown names)."""
+    current = {name: (medicine_id, price) for medicine_id, name, price
+               in db.session.query(Medicine.id, Medicine.name, Medicine.price)}
+    at = at or datetime.utcnow()
+    changed, unknown = 0, []
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            name = row["medicine"].strip()
+            if name not in current:
+                unknown.append(name)
+                continue
+            medicine_id, price = current[name]
+            if float(row["price"]) != price:
+                set_price(medicine_id, float(row["price"]), at)
+                changed += 1
+    db.session.commit()
+    return changed, unknown
+
+# ----------------------- REORDERS -----------------------
+def add_lines_to_cart(user_id, quantities):
+    """Merge {medicine_id: quantity} into a user's cart with one INSERT ... ON CONFLICT statement."""
+    if not quantities:
+        return
+    prices = dict(db.session.query(Medicine.id, Medicine.price).filter(Medicine.id.in_(quantities)))
+    stmt = sqlite_insert(Cart).values([{"user_id": user_id, "medicine_id": medicine_id, "quantity": quantity,
+                                        "price_snapshot": prices.get(medicine_id)}
+                                       for medicine_id, quantity in quantities.items()])
+    db.session.execute(stmt.on_conflict_do_update(index_elements=["user_id", "medicine_id"],
+                                                  set_={"quantity": Cart.quantity + stmt.excluded.quantity}))
+
+def resolve_order_lines(items):
+    """({medicine_id: quantity}, [names no longer in the catalog]) for past OrderItems, via ix_medicine_name."""
+    names = {item.medicine_name for item in items}
+    by_name = dict(db.session.query(Medicine.name, Medicine.id).filter(Medicine.name.in_(names))) if names else {}
+    quantities, missing = {}, []
+    for item in items:
+        medicine_id = by_name.get(item.medicine_name)
+        if medicine_id is None:
+            missing.append(item.medicine_name)
+        else:
+            quantities[medicine_id] = quantities.get(medicine_id, 0) + (item.quantity or 1)
+    return quantities, missing
+
+def record_usual_items(user_id, quantities, ordered_at):
+    """Fold one order's {medicine_id: quantity} into the user's usual items (caller's transaction)."""
+    if not quantities:
+        return
+    stmt = sqlite_insert(UsualItem).values([{"user_id": user_id, "medicine_id": medicine_id, "times_ordered": 1,
+                                             "total_quantity": quantity, "last_ordered_at": ordered_at}
+                                            for medicine_id, quantity in quantities.items()])
+    db.session.execute(stmt.on_conflict_do_update(index_elements=["user_id", "medicine_id"], set_={
+        "times_ordered": UsualItem.times_ordered + 1,
+        "total_quantity": UsualItem.total_quantity + stmt.excluded.total_quantity,
+        "last_ordered_at": stmt.excluded.last_ordered_at,
+    }))
+
+def usual_items(user_id, limit=8, min_orders=2):
+    """Medicines the user has ordered at least ``min_orders`` times, most often first."""
+    return (UsualItem.query.filter(UsualItem.user_id == user_id, UsualItem.times_ordered >= min_orders)
+            .order_by(UsualItem.times_ordered.desc(), UsualItem.last_ordered_at.desc()).limit(limit).all())
+
+def typical_quantity(usual):
+    return max(1, round(usual.total_quantity / usual.times_ordered))
+
+def rebuild_usual_items(batch_size=500):
+    """Recompute every user's usual items from order history (for orders placed before they were kept)."""
+    UsualItem.query.delete()
+    last_id = 0
+    while True:
+        orders = Order.query.filter(Order.id > last_id).order_by(Order.id).limit(batch_size).all()
+        if not orders:
+            break
+        for order in orders:
+            record_usual_items(order.user_id, resolve_order_lines(order.items)[0], order.date)
+        last_id = orders[-1].id
+        db.session.commit()
+        db.session.expunge_all()
+
+# ----------------------- REFILL REMINDERS -----------------------
+REFILL_LEAD = timedelta(days=3)     # remind this long before the medicine runs out
+REFILL_REPEAT = timedelta(days=7)   # and again after this long if there was no reorder
+REFILL_MAX_SENDS = 2
+REFILL_RETRY = timedelta(hours=1)   # after a failed delivery
+
+def schedule_refills(user_id, quantities, ordered_at):
+    """Start or reset refill reminders for an order's {medicine_id: quantity} (caller's transaction).
+
+    Only medicines with days_per_unit get one; the order table is never scanned afterwards.
+    """
+    days = dict(db.session.query(Medicine.id, Medicine.days_per_unit)
+                .filter(Medicine.id.in_(quantities), Medicine.days_per_unit.isnot(None)))
+    rows = []
+    for medicine_id, days_per_unit in days.items():
+        runs_out_at = ordered_at + timedelta(days=days_per_unit * quantities[medicine_id])
+        rows.append({"user_id": user_id, "medicine_id": medicine_id, "runs_out_at": runs_out_at,
+                     "next_due_at": runs_out_at - REFILL_LEAD, "sent_count": 0, "active": True})
+    if rows:
+        stmt = sqlite_insert(RefillReminder).values(rows)
+        db.session.execute(stmt.on_conflict_do_update(index_elements=["user_id", "medicine_id"], set_={
+            "runs_out_at": stmt.excluded.runs_out_at, "next_due_at": stmt.excluded.next_due_at,
+            "sent_count": 0, "active": True}))
+
+class FileNotifier:
+    """Appends one JSON line per message to a file; the stand-in used in development and tests."""
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, to, subject, body):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"to": to, "subject": subject, "body": body, "at": datetime.utcnow().isoformat()}) + "\n")
+        return True
+
+class SMTPNotifier:
+    """Sends plain-text mail through one SMTP connection, opened on first use."""
+    def __init__(self, host="localhost", port=25, sender="reminders@healthyme.local"):
+        self.host, self.port, self.sender = host, port, sender
+        self.smtp = None
+
+    def send(self, to, subject, body):
+        if not to:
+            return False
+        message = EmailMessage()
+        message["From"], message["To"], message["Subject"] = self.sender, to, subject
+        message.set_content(body)
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(self.host, self.port, timeout=30)
+        try:
+            self.smtp.send_message(message)
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()  # reconnect for the next message
+            self.smtp = None
+            raise
+        return True
+
+class QueueNotifier:
+    """Puts messages on the notification queue (committed with the caller's transaction)."""
+    def __init__(self, kind):
+        self.kind = kind
+
+    def send(self, to, subject, body):
+        if not to:
+            return False
+        enqueue_notification(self.kind, to, subject, body)
+        return True
+
+def make_notifier(spec, queue_kind="refill_reminder"):
+    """'queue', 'file:reminders.jsonl' or 'smtp:host:port' -> notifier."""
+    kind, _, target = spec.partition(":")
+    if kind == "queue":
+        return QueueNotifier(queue_kind)
+    if kind == "file":
+        return FileNotifier(target or "notifications.jsonl")
+    if kind == "smtp":
+        host, _, port = target.partition(":")
+        return SMTPNotifier(host or "localhost", int(port or 25))
+    raise ValueError(f"Unknown notifier {spec!r}")
+
+def send_due_reminders(notifier, now=None, batch_size=1000):
+    """Send every reminder due by ``now``, reading (next_due_at, id) keyset batches off the due index.
+
+    A sent reminder is pushed REFILL_REPEAT ahead, or retired after REFILL_MAX_SENDS. One for a
+    user with no email address goes the same way unsent, and one the notifier failed on is retried
+    REFILL_RETRY later, so nothing stays due to be read again on every run. Each batch is committed
+    as it goes. Returns the number sent.
+    """
+    now = now or datetime.utcnow()
+    sent, position = 0, None
+    while True:
+        query = (db.session.query(RefillReminder, User.username, User.email, Medicine.name)
+                 .join(User, User.id == RefillReminder.user_id)
+                 .join(Medicine, Medicine.id == RefillReminder.medicine_id)
+                 .filter(RefillReminder.active.is_(True), RefillReminder.next_due_at <= now))
+        if position:
+            query = query.filter(tuple_(RefillReminder.next_due_at, RefillReminder.id) > position)
+        batch = query.order_by(RefillReminder.next_due_at, RefillReminder.id).limit(batch_size).all()
+        if not batch:
+            break
+        position = (batch[-1][0].next_due_at, batch[-1][0].id)
+        for reminder, username, email, medicine_name in batch:
+            if email:
+                body = (f"Hi {username},\n\nYour {medicine_name} runs out around {reminder.runs_out_at:%d-%m-%Y}. "
+                        f"Reorder it from My Orders in one click.\n\n– HealthyMe Pharmacy")
+                try:
+                    delivered = notifier.send(email, f"Time to refill {medicine_name}", body)
+                except (smtplib.SMTPException, OSError):
+                    app.logger.exception("Refill reminder %s could not be sent", reminder.id)
+                    delivered = False
+                if not delivered:
+                    reminder.next_due_at = now + REFILL_RETRY
+                    continue
+                sent += 1
+                reminder.last_sent_at = now
+            reminder.sent_count += 1
+            if reminder.sent_count >= REFILL_MAX_SENDS:
+                reminder.active, reminder.next_due_at = False, None
+            else:
+                reminder.next_due_at = now + REFILL_REPEAT
+        db.session.commit()
+        db.session.expunge_all()
+    return sent
+
+# ----------------------- NOTIFICATIONS -----------------------
+NOTIFY_LEASE = timedelta(minutes=5)  # a claimed batch not finished by then is handed out again
+NOTIFY_MAX_ATTEMPTS = 6
+NOTIFY_BACKOFF_BASE = 30             # seconds before the first retry, doubled each attempt
+NOTIFY_BACKOFF_MAX = 3600
+
+def enqueue_notification(kind, recipient, subject, body):
+    """Queue a message in the caller's transaction; nothing is sent until a worker picks it up."""
+    db.session.add(Notification(kind=kind, recipient=recipient, subject=subject, body=body))
+
+def notification_backoff(attempts):
+    delay = min(NOTIFY_BACKOFF_BASE * 2 ** (attempts - 1), NOTIFY_BACKOFF_MAX)
+    return timedelta(seconds=delay * random.uniform(0.9, 1.1))
+
+def claim_notifications(batch_size):
+    """Claim up to batch_size due messages (queued, or sending with an expired lease) for this worker."""
+    now, token = datetime.utcnow(), uuid.uuid4().hex
+    ids = [i for (i,) in db.session.query(Notification.id)
+           .filter(Notification.status.in_(("queued", "sending")), Notification.next_attempt_at <= now)
+           .order_by(Notification.next_attempt_at).limit(batch_size)]
+    if not ids:
+        return []
+    # the guard makes a row claimed by another worker in the meantime fall out of this UPDATE
+    Notification.query.filter(Notification.id.in_(ids), Notification.status.in_(("queued", "sending")),
+                              Notification.next_attempt_at <= now).update(
+        {"status": "sending", "claim_token": token, "next_attempt_at": now + NOTIFY_LEASE},
+        synchronize_session=False)
+    db.session.commit()
+    return Notification.query.filter_by(claim_token=token, status="sending").all()
+
+def record_deliveries(token, results):
+    """Store [(notification, error or None)] outcomes of one batch claimed as ``token``, in one transaction.
+
+    Each UPDATE is guarded on the claim token, so a message whose lease ran out and was claimed by
+    another worker is left to that worker.
+    """
+    now = datetime.utcnow()
+    for notification, error in results:
+        claimed = Notification.query.filter_by(id=notification.id, claim_token=token, status="sending")
+        if error is None:
+            claimed.update({"status": "sent", "sent_at": now, "last_error": None}, synchronize_session=False)
+            continue
+        attempts = notification.attempts + 1
+        values = {"attempts": attempts, "last_error": error[:300], "status": "failed"}
+        if attempts < NOTIFY_MAX_ATTEMPTS:
+            values.update(status="queued", next_attempt_at=now + notification_backoff(attempts))
+        claimed.update(values, synchronize_session=False)
+    db.session.commit()
+
+class SMTPPool:
+    """Reusable SMTP connections, so a worker sends a whole batch without reconnecting."""
+    def __init__(self, host, port, size=4, sender="noreply@healthyme.local"):
+        self.host, self.port, self.sender = host, port, sender
+        self.idle = queue.LifoQueue(size)
+
+    @contextmanager
+    def connection(self):
+        conn = None
+        while conn is None:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = smtplib.SMTP(self.host, self.port, timeout=30)
+                break
+            try:
+                conn.noop()
+            except (smtplib.SMTPException, OSError):
+                conn = None  # dropped while idle
+        try:
+            yield conn
+        except BaseException:
+            conn.close()  # whatever went wrong, the session's state is unknown
+            raise
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.quit()
+
+    def close(self):
+        while not self.idle.empty():
+            try:
+                self.idle.get_nowait().quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+class NotificationDispatcher:
+    """Worker threads that claim batches off the queue and send each over one pooled SMTP connection."""
+    def __init__(self, smtp_host="localhost", smtp_port=25, workers=4, batch_size=50, idle_wait=2.0):
+        self.pool = SMTPPool(smtp_host, smtp_port, size=workers)
+        self.workers, self.batch_size, self.idle_wait = workers, batch_size, idle_wait
+        self.stopping = threading.Event()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.sent = self.failed = 0
+        self.started_at = time.monotonic()
+
+    def deliver(self, batch):
+        results = []
+        try:
+            with self.pool.connection() as conn:
+                for notification in batch:
+                    if datetime.utcnow() >= notification.next_attempt_at:
+                        break  # lease ran out: the rest may already be claimed by another worker
+                    message = EmailMessage()
+                    message["From"], message["To"] = self.pool.sender, notification.recipient
+                    message["Subject"] = notification.subject
+                    message.set_content(notification.body)
+                    try:
+                        conn.send_message(message)
+                        results.append((notification, None))
+                    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as e:
+                        results.append((notification, str(e)))
+        except (smtplib.SMTPException, OSError) as e:
+            # connection trouble: whatever was not sent yet is retried later
+            done = {n.id for n, _ in results}
+            results += [(n, f"connection: {e}") for n in batch if n.id not in done]
+        with self.lock:
+            self.sent += sum(1 for _, error in results if error is None)
+            self.failed += sum(1 for _, error in results if error is not None)
+        return results
+
+    def run_once(self):
+        """Claim and send one batch; returns how many messages it held."""
+        batch = claim_notifications(self.batch_size)
+        if batch:
+            record_deliveries(batch[0].claim_token, self.deliver(batch))
+        return len(batch)
+
+    def work(self):
+        with app.app_context():
+            while not self.stopping.is_set():
+                try:
+                    if not self.run_once():
+                        self.stopping.wait(self.idle_wait)
+                except Exception:
+                    app.logger.exception("Notification worker failed")
+                    db.session.rollback()
+                    self.stopping.wait(self.idle_wait)
+                finally:
+                    db.session.remove()
+
+    def start(self):
+        for n in range(self.workers):
+            thread = threading.Thread(target=self.work, name=f"notify-{n}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+        self.pool.close()
+
+    def stats(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.started_at, 1e-9)
+            return {"sent": self.sent, "failed_attempts": self.failed, "sent_per_second": round(self.sent / elapsed, 2)}
+
+def notification_metrics():
+    """Queue depth by status, age of the oldest waiting message, and sends over the last minute."""
+    now = datetime.utcnow()
+    counts = dict(db.session.query(Notification.status, func.count()).group_by(Notification.status))
+    oldest = (db.session.query(func.min(Notification.created_at))
+              .filter(Notification.status.in_(("queued", "sending"))).scalar())
+    recent = Notification.query.filter(Notification.status == "sent",
+                                       Notification.sent_at >= now - timedelta(minutes=1)).count()
+    return {"queued": counts.get("queued", 0), "sending": counts.get("sending", 0), "sent": counts.get("sent", 0),
+            "failed": counts.get("failed", 0),
+            "oldest_queued_age_seconds": round((now - oldest).total_seconds(), 1) if oldest else 0,
+            "sent_last_minute": recent}
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: accepts every message and hands it to the server."""
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 healthyme-sink ready")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("utf-8", "replace").rstrip("\r\n")
+            verb = command[:4].upper()
+            if verb in ("HELO", "EHLO"):
+                self.reply("250 healthyme-sink")
+            elif verb == "MAIL":
+                sender, recipients = command.partition(":")[2].strip(" <>"), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.partition(":")[2].strip(" <>"))
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                for raw in iter(self.rfile.readline, b""):
+                    if raw in (b".\r\n", b".\n"):
+                        break
+                    data.append(raw[1:] if raw.startswith(b"..") else raw)
+                self.server.deliver(sender, recipients, b"".join(data))
+                self.reply("250 OK")
+            elif verb in ("RSET", "NOOP"):
+                if verb == "RSET":
+                    sender, recipients = None, []
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """Local SMTP server for development and tests; keeps messages in memory and optionally as .eml files."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=1025, out_dir=None):
+        super().__init__((host, port), SMTPSinkHandler)
+        self.out_dir = out_dir
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def deliver(self, sender, recipients, data):
+        with self.lock:
+            self.messages.append((sender, recipients, data))
+            count = len(self.messages)
+        if self.out_dir:
+            with open(os.path.join(self.out_dir, f"{count:06d}.eml"), "wb") as f:
+                f.write(data)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="smtp-sink", daemon=True).start()
+        return self
+
+# ----------------------- ORDER STATUS -----------------------
+ORDER_TRANSITIONS = {
+    "placed": ("packed", "cancelled"),
+    "packed": ("dispatched", "cancelled"),
+    "dispatched": ("delivered",),
+    "delivered": (),
+    "cancelled": (),
+}
+ORDER_WAIT_MAX = 30      # seconds a long-poll request is held open at most
+ORDER_RECHECK = 5.0      # re-read the change feed this often too, for transitions made by other processes
+
+class InvalidTransition(Exception):
+    pass
+
+class OrderEvents:
+    """Wakes long-poll requests in this process as soon as an order changes status."""
+    def __init__(self):
+        self.changed = threading.Condition()
+
+    def notify(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    def wait(self, timeout):
+        with self.changed:
+            self.changed.wait(timeout)
+
+order_events = OrderEvents()
+
+def record_status_change(order_id, from_status, to_status, changed_by=None):
+    db.session.add(OrderStatusChange(order_id=order_id, from_status=from_status, to_status=to_status,
+                                     changed_by=changed_by))
+
+def transition_order(order, to_status, changed_by=None):
+    """Move an order to ``to_status`` in the caller's transaction; call order_events.notify() after commit.
+
+    The UPDATE is guarded on the current status, so two staff screens racing on one order can't
+    both win. Raises InvalidTransition if the move isn't allowed from where the order is now.
+    """
+    from_status = order.status
+    if to_status not in ORDER_TRANSITIONS.get(from_status, ()):
+        raise InvalidTransition(f"Order #{order.id} can't go from {from_status} to {to_status}")
+    moved = Order.query.filter_by(id=order.id, status=from_status).update({"status": to_status},
+                                                                           synchronize_session=False)
+    if not moved:
+        raise InvalidTransition(f"Order #{order.id} was changed by someone else")
+    order.status = to_status
+    record_status_change(order.id, from_status, to_status, changed_by)
+    if to_status == "cancelled":
+        reverse_order_points(order)
+        if order.slot_id:
+            release_slot(order.slot_id)
+    user = order.user
+    if user.email and to_status in ("dispatched", "delivered", "cancelled"):
+        enqueue_notification("order_status", user.email, f"HealthyMe order #{order.id} {to_status}",
+                             f"Hi {user.username},\n\nYour order #{order.id} is now {to_status}.\n\n– HealthyMe Pharmacy")
+
+def wait_for_changes(fetch, timeout):
+    """Call ``fetch`` until it returns something or ``timeout`` seconds pass, sleeping on order_events."""
+    deadline = time.monotonic() + min(timeout, ORDER_WAIT_MAX)
+    while True:
+        changes = fetch()
+        db.session.rollback()  # end the read so the next check sees new commits
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        order_events.wait(min(remaining, ORDER_RECHECK))
+
+def change_json(change):
+    return {"id": change.id, "order_id": change.order_id, "from": change.from_status, "to": change.to_status,
+            "at": change.changed_at.isoformat()}
+
+def staff_required():
+    user = db.session.get(User, session["user_id"]) if "user_id" in session else None
+    if user is None or not user.is_staff:
+        abort(403)
+    return user
+
+def can_see_patient(user, patient_key):
+    """Staff see every patient; customers only themselves."""
+    return user is not None and (user.is_staff or (bool(patient_key) and patient_key == user.patient_key))
+
+def user_prescription_or_404(prescription_id):
+    """A prescription the session user is the patient on or wrote; staff get any. 404 for everyone else's."""
+    prescription = db.get_or_404(Prescription, prescription_id)
+    user = db.session.get(User, session["user_id"])
+    if not (can_see_patient(user, prescription.patient_key) or (user and prescription.created_by == user.username)):
+        abort(404)
+    return prescription
+
+# ----------------------- RETURNS & REFUNDS -----------------------
+class ReturnError(Exception):
+    pass
+
+def returnable_quantity(item):
+    """Units of an order line not already covered by a pending, approved or refunded return."""
+    taken = (db.session.query(func.coalesce(func.sum(ReturnRequest.quantity), 0))
+             .filter(ReturnRequest.order_item_id == item.id, ReturnRequest.status != "rejected").scalar())
+    return (item.quantity or 0) - taken
+
+def request_return(user_id, item, quantity, reason):
+    """Open a return for ``quantity`` units of a delivered order line (caller's transaction)."""
+    if item.order.user_id != user_id:
+        raise ReturnError("That order line isn't yours")
+    if item.order.status != "delivered":
+        raise ReturnError(f"Order #{item.order_id} can only be returned once delivered")
+    if quantity < 1 or quantity > returnable_quantity(item):
+        raise ReturnError(f"You can return at most {returnable_quantity(item)} of {item.medicine_name}")
+    db.session.add(ReturnRequest(order_item_id=item.id, user_id=user_id, quantity=quantity, reason=reason))
+
+def refund_amount(item, quantity):
+    """Share of what was paid for the line (tax and discounts included), in paise, rounded down."""
+    paid = item.amount_paise if item.amount_paise is not None else to_paise(item.price or 0)
+    return paid * quantity // item.quantity
+
+def decide_return(ret, approve, staff_id, batch_no=None, expiry=None, resaleable=False):
+    """Approve (queueing a pending Refund) or reject a requested return, in the caller's transaction."""
+    if ret.status != "requested":
+        raise ReturnError(f"Return #{ret.id} is already {ret.status}")
+    ret.decided_at, ret.decided_by = datetime.utcnow(), staff_id
+    if not approve:
+        ret.status = "rejected"
+        return
+    if resaleable and not (batch_no and expiry):
+        raise ReturnError("Batch number and expiry are needed to restock a return")
+    ret.status, ret.batch_no, ret.expiry, ret.resaleable = "approved", batch_no, expiry, resaleable
+    # the part paid with points goes back as points; only the rest is refunded in cash
+    db.session.add(Refund(return_id=ret.id, order_id=ret.item.order_id,
+                          amount_paise=refund_points(ret.item.order, refund_amount(ret.item, ret.quantity))))
+
+def settle_refunds(batch_size=500):
+    """Settle approved refunds past the checkpoint, one short transaction per ``batch_size`` refunds.
+
+    Each batch marks its refunds settled and their returns refunded, adds the amounts to the
+    orders (one executemany UPDATE, summed per order), queues restock lines for resaleable
+    returns and advances the checkpoint, all together; a run that dies is simply started again.
+    Returns (refunds settled, paise refunded).
+    """
+    checkpoint = db.session.get(JobCheckpoint, "refund_settlement")
+    if checkpoint is None:
+        checkpoint = JobCheckpoint(name="refund_settlement", last_id=0)
+        db.session.add(checkpoint)
+        db.session.commit()
+    settled, total = 0, 0
+    while True:
+        rows = (db.session.query(Refund.id, Refund.order_id, Refund.amount_paise, ReturnRequest.id,
+                                 ReturnRequest.quantity, ReturnRequest.resaleable, ReturnRequest.batch_no,
+                                 ReturnRequest.expiry, OrderItem.medicine_name)
+                .join(ReturnRequest, ReturnRequest.id == Refund.return_id)
+                .join(OrderItem, OrderItem.id == ReturnRequest.order_item_id)
+                .filter(Refund.id > checkpoint.last_id)
+                .order_by(Refund.id).limit(batch_size).all())
+        if not rows:
+            break
+        now = datetime.utcnow()
+        per_order = Counter()
+        restock = []
+        for refund_id, order_id, amount, _, quantity, resaleable, batch_no, expiry, medicine_name in rows:
+            per_order[order_id] += amount
+            if resaleable:
+                restock.append({"refund_id": refund_id, "medicine_name": medicine_name, "batch_no": batch_no,
+                                "expiry": expiry, "quantity": quantity})
+        Refund.query.filter(Refund.id.in_([r[0] for r in rows])).update(
+            {"status": "settled", "settled_at": now}, synchronize_session=False)
+        ReturnRequest.query.filter(ReturnRequest.id.in_([r[3] for r in rows])).update(
+            {"status": "refunded"}, synchronize_session=False)
+        order_table = Order.__table__
+        db.session.execute(update(order_table).where(order_table.c.id == bindparam("order_id"))
+                           .values(refunded_paise=func.coalesce(order_table.c.refunded_paise, 0) + bindparam("amount")),
+                           [{"order_id": o, "amount": a} for o, a in per_order.items()])
+        if restock:
+            db.session.execute(RestockLine.__table__.insert(), restock)
+        checkpoint.last_id = rows[-1][0]
+        db.session.commit()
+        settled += len(rows)
+        total += sum(per_order.values())
+    return settled, total
+
+def export_restock_csv(path):
+    """Write unexported restock lines as medicine,batch_no,expiry,qty (the inventory receive-stock format)."""
+    lines = RestockLine.query.filter(RestockLine.exported_at.is_(None)).order_by(RestockLine.id).all()
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["medicine", "batch_no", "expiry", "qty"])
+        for line in lines:
+            writer.writerow([line.medicine_name, line.batch_no, line.expiry.isoformat(), line.quantity])
+    now = datetime.utcnow()
+    for line in lines:
+        line.exported_at = now
+    db.session.commit()
+    return len(lines)
+
+# ----------------------- LOYALTY POINTS -----------------------
+POINTS_PER_RUPEES = 20     # one point for every ₹20 paid (not counting points)
+POINT_VALUE_PAISE = 100    # a point is worth ₹1 at checkout
+
+class InsufficientPoints(Exception):
+    def __init__(self, balance):
+        super().__init__(f"Only {balance} points available")
+        self.balance = balance
+
+def points_balance(user_id):
+    """Snapshot balance plus the ledger entries written since, read off ix_points_entry_user."""
+    snapshot = db.session.get(PointsSnapshot, user_id)
+    balance, after = (snapshot.balance, snapshot.last_entry_id) if snapshot else (0, 0)
+    tail = (db.session.query(func.coalesce(func.sum(PointsEntry.delta), 0))
+            .filter(PointsEntry.user_id == user_id, PointsEntry.id > after).scalar())
+    return balance + tail
+
+def redeem_points(user_id, points, order_id):
+    """Spend ``points`` on an order in the caller's transaction; raises InsufficientPoints.
+
+    The account row is written first, so concurrent checkouts from the same account queue up
+    behind this transaction and each one reads a balance that already includes the others.
+    """
+    db.session.execute(update(User).where(User.id == user_id)
+                       .values(points_seq=func.coalesce(User.points_seq, 0) + 1))
+    balance = points_balance(user_id)
+    if points > balance:
+        raise InsufficientPoints(balance)
+    db.session.add(PointsEntry(user_id=user_id, delta=-points, reason="redeemed", order_id=order_id))
+
+def award_points(user_id, paid_paise, order_id):
+    points = paid_paise // (POINTS_PER_RUPEES * 100)
+    if points > 0:
+        db.session.add(PointsEntry(user_id=user_id, delta=points, reason="earned", order_id=order_id))
+    return points
+
+def reverse_order_points(order):
+    """Undo everything an order did to the ledger (points earned off, points redeemed back) for a cancellation."""
+    net = (db.session.query(func.coalesce(func.sum(PointsEntry.delta), 0))
+           .filter(PointsEntry.user_id == order.user_id, PointsEntry.order_id == order.id).scalar())
+    if net:
+        db.session.add(PointsEntry(user_id=order.user_id, delta=-net, reason="cancelled", order_id=order.id))
+
+def refund_points(order, paise):
+    """Split a refund of ``paise`` off ``order`` into points and cash; returns the cash part in paise.
+
+    The points share is in proportion to what the order paid with points, and is given back as
+    points (rounded down, the remainder goes to cash); points earned on the order are taken off in
+    the same proportion. Ledger rows are written in the caller's transaction.
+    """
+    total = to_paise(order.total_amount)
+    if not total:
+        return paise
+    points_back = paise * (order.points_paise or 0) // total // POINT_VALUE_PAISE
+    earned = (db.session.query(func.coalesce(func.sum(PointsEntry.delta), 0))
+              .filter(PointsEntry.user_id == order.user_id, PointsEntry.order_id == order.id,
+                      PointsEntry.reason == "earned").scalar())
+    delta = points_back - earned * paise // total
+    if delta:
+        db.session.add(PointsEntry(user_id=order.user_id, delta=delta, reason="returned", order_id=order.id))
+    return paise - points_back * POINT_VALUE_PAISE
+
+def snapshot_points(batch_size=5000):
+    """Fold ledger entries past the checkpoint into per-user snapshots, one keyset batch per transaction."""
+    checkpoint = db.session.get(JobCheckpoint, "points_snapshot")
+    if checkpoint is None:
+        checkpoint = JobCheckpoint(name="points_snapshot", last_id=0)
+        db.session.add(checkpoint)
+        db.session.commit()
+    folded = 0
+    while True:
+        upper = (db.session.query(PointsEntry.id).filter(PointsEntry.id > checkpoint.last_id)
+                 .order_by(PointsEntry.id).offset(batch_size - 1).limit(1).scalar()
+                 or db.session.query(func.max(PointsEntry.id)).scalar() or 0)
+        if upper <= checkpoint.last_id:
+            break
+        rows = (db.session.query(PointsEntry.user_id, func.sum(PointsEntry.delta), func.max(PointsEntry.id),
+                                 func.count())
+                .filter(PointsEntry.id > checkpoint.last_id, PointsEntry.id <= upper)
+                .group_by(PointsEntry.user_id).all())
+        stmt = sqlite_insert(PointsSnapshot).values([
+            {"user_id": user_id, "balance": delta, "last_entry_id": last_id, "taken_at": datetime.utcnow()}
+            for user_id, delta, last_id, _ in rows])
+        db.session.execute(stmt.on_conflict_do_update(index_elements=["user_id"], set_={
+            "balance": PointsSnapshot.balance + stmt.excluded.balance,
+            "last_entry_id": stmt.excluded.last_entry_id, "taken_at": stmt.excluded.taken_at}))
+        checkpoint.last_id = upper
         db.session.commit()
+        folded += sum(count for *_, count in rows)
+    return folded
+
+# ----------------------- TAXES -----------------------
+GST_SLABS = [("GST0", 0), ("GST5", 500), ("GST12", 1200), ("GST18", 1800), ("GST28", 2800)]
+DEFAULT_TAX_CLASS = "GST12"
+
+def to_paise(amount):
+    return int(round(amount * 100))
+
+_tax_classes = None
+
+def tax_classes():
+    """code -> (rate_bp, hsn_code), reloaded when the 'tax' index version changes."""
+    global _tax_classes
+    version = index_version("tax")
+    if _tax_classes is None or _tax_classes[0] != version:
+        _tax_classes = (version, {t.code: (t.rate_bp, t.hsn_code) for t in TaxClass.query})
+    return _tax_classes[1]
+
+def compute_taxes(lines, basket_discount_paise=0):
+    """GST breakdown of [(amount_paise, rate_bp)] tax-inclusive lines, in one pass of integer maths.
+
+    The basket discount is spread over the lines in proportion to their amounts (remainder paise
+    to the largest lines), then each line's tax is backed out of its amount and split evenly
+    into CGST and SGST, the odd paisa going to SGST. Every figure is an exact integer, so lines
+    always add up to the order total.
+    """
+    gross = sum(amount for amount, _ in lines)
+    shares = [amount * basket_discount_paise // gross if gross else 0 for amount, _ in lines]
+    leftover = basket_discount_paise - sum(shares) if gross else 0
+    for i in sorted(range(len(lines)), key=lambda i: -lines[i][0])[:leftover]:
+        shares[i] += 1
+    breakdown = []
+    for (amount, rate_bp), share in zip(lines, shares):
+        amount -= share
+        taxable = (amount * 10000 + (10000 + rate_bp) // 2) // (10000 + rate_bp)
+        tax = amount - taxable
+        breakdown.append({"amount": amount, "taxable": taxable, "cgst": tax // 2, "sgst": tax - tax // 2,
+                          "rate_bp": rate_bp})
+    return breakdown
+
+def tax_order_lines(cart_items, pricing):
+    """Tax breakdowns (plus hsn_code) for priced cart lines, ready to store on OrderItems."""
+    classes = tax_classes()
+    lines, hsn_codes = [], []
+    for item, line in zip(cart_items, pricing["lines"]):
+        rate_bp, hsn_code = classes.get(item.medicine.tax_class or DEFAULT_TAX_CLASS, (0, ""))
+        lines.append((to_paise(line["net"]), rate_bp))
+        hsn_codes.append(hsn_code)
+    breakdown = compute_taxes(lines, to_paise(pricing["basket_discount"]))
+    for line, hsn_code in zip(breakdown, hsn_codes):
+        line["hsn_code"] = hsn_code
+    return breakdown
+
+def assign_tax_classes_csv(path):
+    """Set medicines' tax classes from a CSV with medicine,tax_class columns."""
+    classes = tax_classes()
+    name_to_id = dict(db.session.query(Medicine.name, Medicine.id))
+    assigned, unknown = 0, set()
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            medicine_id, code = name_to_id.get(row["medicine"].strip()), row["tax_class"].strip().upper()
+            if medicine_id is None or code not in classes:
+                unknown.add(row["medicine"].strip() if medicine_id is None else code)
+                continue
+            Medicine.query.filter_by(id=medicine_id).update({"tax_class": code})
+            assigned += 1
+    if assigned:
+        bump_index_version("catalog")
+    db.session.commit()
+    return assigned, sorted(unknown)
+
+def tax_summary(start=None, end=None):
+    """Stored GST totals per rate over orders in [start, end): [(rate_bp, taxable, cgst, sgst, lines)] in paise."""
+    query = (db.session.query(OrderItem.tax_rate_bp, func.sum(OrderItem.taxable_paise), func.sum(OrderItem.cgst_paise),
+                              func.sum(OrderItem.sgst_paise), func.count())
+             .join(Order, Order.id == OrderItem.order_id)
+             .filter(OrderItem.tax_rate_bp.isnot(None)))
+    if start:
+        query = query.filter(Order.date >= start)
+    if end:
+        query = query.filter(Order.date < end)
+    return query.group_by(OrderItem.tax_rate_bp).order_by(OrderItem.tax_rate_bp).all()
+
+# ----------------------- INVOICES -----------------------
+def invoice_dir():
+    return os.path.join(app.instance_path, "invoices")
+
+def invoice_data(order):
+    """Plain, picklable snapshot of everything printed on an order's invoice."""
+    return {
+        "id": order.id,
+        "date": order.date.strftime("%d-%m-%Y %H:%M"),
+        "customer": order.user.username,
+        "items": [{"name": i.medicine_name, "quantity": i.quantity, "price": i.price, "hsn": i.hsn_code,
+                   "rate_bp": i.tax_rate_bp, "taxable": i.taxable_paise, "cgst": i.cgst_paise, "sgst": i.sgst_paise,
+                   "amount": i.amount_paise}
+                  for i in sorted(order.items, key=lambda i: i.id)],
+        "discount": order.discount or 0,
+        "points": (order.points_paise or 0) / 100,
+        "total": order.total_amount,
+    }
+
+def invoice_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+def render_invoice_pdf(data, out_dir):
+    """Runs in the worker pool: draw the invoice and write it under a content-addressed name."""
+    styles = getSampleStyleSheet()
+    buf = io.BytesIO()
+    doc = SimpleDocTemplate(buf, pagesize=A4, title=f"Invoice #{data['id']}")
+    if all(i.get("taxable") is not None for i in data["items"]):
+        # stored GST breakdown; the basket discount is already spread over the lines
+        rupees = lambda paise: f"{paise / 100:.2f}"
+        rows = [["Medicine", "HSN", "Qty", "Taxable", "GST", "CGST", "SGST", "Amount (Rs.)"]]
+        rows += [[i["name"], i["hsn"], i["quantity"], rupees(i["taxable"]), f"{i['rate_bp'] / 100:g}%",
+                  rupees(i["cgst"]), rupees(i["sgst"]), rupees(i["amount"])] for i in data["items"]]
+        totals = [sum(i[k] for i in data["items"]) for k in ("taxable", "cgst", "sgst")]
+        rows.append(["", "", "Total", rupees(totals[0]), "", rupees(totals[1]), rupees(totals[2]),
+                     f"{data['total']:.2f}"])
+        if data.get("points"):
+            rows.append(["", "", "Paid with points", "", "", "", "", f"-{data['points']:.2f}"])
+        widths = [150, 45, 35, 60, 40, 55, 55, 83]
+    else:
+        rows = [["Medicine", "Qty", "Amount (Rs.)"]]
+        rows += [[i["name"], i["quantity"], f"{i['price']:.2f}"] for i in data["items"]]
+        if data.get("discount"):
+            rows.append(["", "Discount", f"-{data['discount']:.2f}"])
+        rows.append(["", "Total", f"{data['total']:.2f}"])
+        widths = [280, 60, 120]
+    table = Table(rows, colWidths=widths)
+    table.setStyle(TableStyle([
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#198754")),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+        ("GRID", (0, 0), (-1, -2), 0.5, colors.grey),
+        ("ALIGN", (1, 0), (-1, -1), "RIGHT"),
+        ("FONTNAME", (0, -1), (-1, -1), "Helvetica-Bold"),
+    ]))
+    doc.build([
+        Paragraph("HealthyMe Pharmacy – Tax Invoice", styles["Title"]),
+        Paragraph(f"Invoice for order #{data['id']} · {data['date']}", styles["Normal"]),
+        Paragraph(f"Billed to: {escape(data['customer'])}", styles["Normal"]),
+        Spacer(1, 16),
+        table,
+    ])
+    content_hash = invoice_hash(data)
+    path = os.path.join(out_dir, f"{data['id']}-{content_hash[:16]}.pdf")
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(buf.getvalue())
+    os.replace(tmp, path)
+    return data["id"], content_hash, path
+
+def record_invoice(result):
+    """Store a rendered invoice; the first render of an order wins."""
+    order_id, content_hash, path = result
+    stmt = sqlite_insert(Invoice).values(order_id=order_id, content_hash=content_hash, path=path,
+                                         created_at=datetime.utcnow())
+    db.session.execute(stmt.on_conflict_do_nothing())
+    db.session.commit()
+
+def record_invoice_callback(future):
+    with app.app_context():
+        try:
+            record_invoice(future.result())
+        except Exception:
+            app.logger.exception("Rendering invoice failed")
+
+def queue_invoice(order):
+    os.makedirs(invoice_dir(), exist_ok=True)
+    worker_pool().submit(render_invoice_pdf, invoice_data(order), invoice_dir()).add_done_callback(
+        record_invoice_callback)
+
+# ----------------------- ACCOUNT STATEMENTS -----------------------
+STATEMENT_ROWS_PER_PAGE = 40
+
+def statement_lines(user_id, start=None, end=None, batch_size=500):
+    """Yield a user's order lines oldest first, reading one keyset batch at a time."""
+    query = (db.session.query(Order.date, Order.id, OrderItem.id, OrderItem.medicine_name,
+                              OrderItem.quantity, OrderItem.price)
+             .join(OrderItem, OrderItem.order_id == Order.id)
+             .filter(Order.user_id == user_id))
+    if start:
+        query = query.filter(Order.date >= start)
+    if end:
+        query = query.filter(Order.date < end)
+    position = None
+    while True:
+        batch = query
+        if position:
+            batch = batch.filter(tuple_(Order.date, Order.id, OrderItem.id) > position)
+        rows = batch.order_by(Order.date, Order.id, OrderItem.id).limit(batch_size).all()
+        if not rows:
+            return
+        yield from rows
+        position = rows[-1][:3]
+        db.session.expunge_all()
+
+def write_statement_pdf(out, username, lines, start=None, end=None):
+    """Draw a statement page by page; only one page of rows is ever held in memory.
+
+    Each page is a platypus Table placed into a Frame and flushed with showPage(), so memory
+    grows only by the compressed page streams reportlab keeps until save().
+    """
+    styles = getSampleStyleSheet()
+    width, height = A4
+    c = pdf_canvas.Canvas(out, pagesize=A4, pageCompression=1)
+    c.setTitle(f"HealthyMe statement – {username}")
+    period = f"{start:%d-%m-%Y} to {(end - timedelta(days=1)):%d-%m-%Y}" if start and end else \
+        f"from {start:%d-%m-%Y}" if start else f"until {(end - timedelta(days=1)):%d-%m-%Y}" if end else "all orders"
+    style = TableStyle([
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#198754")),
+        ("TEXTCOLOR", (0, 0), (-1, 0), colors.white),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+        ("ALIGN", (3, 0), (-1, -1), "RIGHT"),
+        ("FONTSIZE", (0, 0), (-1, -1), 8),
+    ])
+    lines = iter(lines)
+    running, count, page = 0.0, 0, 0
+    while True:
+        chunk = list(islice(lines, STATEMENT_ROWS_PER_PAGE))
+        if not chunk and page:
+            break
+        page += 1
+        rows = [["Date", "Order", "Medicine", "Qty", "Amount (Rs.)", "Running total"]]
+        for date, order_id, _, name, quantity, price in chunk:
+            running += price or 0
+            rows.append([f"{date:%d-%m-%Y}", f"#{order_id}", name, quantity, f"{price or 0:.2f}", f"{running:.2f}"])
+        count += len(chunk)
+        flowables = [Paragraph(f"HealthyMe Pharmacy – Statement for {escape(username)}", styles["Heading2"]),
+                     Paragraph(f"Period: {period} · page {page}", styles["Normal"]), Spacer(1, 8)]
+        if len(rows) > 1:
+            flowables.append(Table(rows, colWidths=[60, 50, 200, 40, 80, 90], style=style))
+        else:
+            flowables.append(Paragraph("No orders in this period.", styles["Normal"]))
+        Frame(36, 36, width - 72, height - 72).addFromList(flowables, c)
+        c.showPage()
+        if len(chunk) < STATEMENT_ROWS_PER_PAGE:
+            break
+    c.setFont("Helvetica-Bold", 12)
+    c.drawString(36, height - 60, f"{count} line(s), total Rs. {running:.2f}")
+    c.showPage()
+    c.save()
+
+def parse_statement_range(start, end):
+    """YYYY-MM-DD strings -> (start, exclusive end) datetimes; raises ValueError on bad input."""
+    start = datetime.strptime(start, "%Y-%m-%d") if start else None
+    end = datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1) if end else None
+    return start, end
+
+# ----------------------- DELIVERY SLOTS -----------------------
+SLOT_CACHE_TTL = 5.0  # seconds; booking itself always checks capacity in the database
+STORE_TZ = ZoneInfo(os.environ.get("STORE_TIMEZONE", "Asia/Kolkata"))  # slots are stored in UTC, shown in this
+_slot_cache = {}
+
+def from_store_time(local):
+    """Naive store-local datetime -> naive UTC, as stored."""
+    return local.replace(tzinfo=STORE_TZ).astimezone(timezone.utc).replace(tzinfo=None)
+
+@app.template_filter("store_time")
+def store_time(utc, fmt="%d-%m-%Y %H:%M"):
+    """Format a stored (naive UTC) datetime in the store's timezone."""
+    return utc.replace(tzinfo=timezone.utc).astimezone(STORE_TZ).strftime(fmt)
+
+def book_slot(slot_id):
+    """Take one place in a slot, in the caller's transaction. False if it is full or has started.
+
+    A single conditional UPDATE does the check and the increment, so concurrent checkouts never
+    read-modify-write the counter and can't overbook it.
+    """
+    return DeliverySlot.query.filter(
+        DeliverySlot.id == slot_id,
+        DeliverySlot.booked < DeliverySlot.capacity,
+        DeliverySlot.starts_at > datetime.utcnow(),
+    ).update({DeliverySlot.booked: DeliverySlot.booked + 1}, synchronize_session=False) == 1
+
+def release_slot(slot_id):
+    """Give back a place taken by book_slot (cancelled order), in the caller's transaction."""
+    DeliverySlot.query.filter(DeliverySlot.id == slot_id, DeliverySlot.booked > 0).update(
+        {DeliverySlot.booked: DeliverySlot.booked - 1}, synchronize_session=False)
+
+def available_slots(zone=None, days=7):
+    """Upcoming slots with room left, soonest first; cached per zone for SLOT_CACHE_TTL seconds."""
+    now = time.monotonic()
+    cached = _slot_cache.get(zone)
+    if cached and now - cached[0] < SLOT_CACHE_TTL:
+        return cached[1]
+    start = datetime.utcnow()
+    query = DeliverySlot.query.filter(DeliverySlot.starts_at > start,
+                                      DeliverySlot.starts_at < start + timedelta(days=days),
+                                      DeliverySlot.booked < DeliverySlot.capacity)
+    if zone:
+        query = query.filter(DeliverySlot.zone == zone)
+    slots = [{"id": s.id, "zone": s.zone, "starts_at": s.starts_at.isoformat(), "ends_at": s.ends_at.isoformat(),
+              "left": s.capacity - s.booked,
+              "label": f"{s.zone}: {store_time(s.starts_at, '%a %d %b %H:%M')}–{store_time(s.ends_at, '%H:%M')}"}
+             for s in query.order_by(DeliverySlot.starts_at, DeliverySlot.zone)]
+    _slot_cache[zone] = (now, slots)
+    return slots
+
+def parse_slot_windows(windows):
+    """'09-11,18-20' -> [(9, 11), (18, 20)]"""
+    return [tuple(int(h) for h in window.split("-")) for window in windows.split(",")]
+
+# ----------------------- SHELF LABELS -----------------------
+LABEL_COLUMNS, LABEL_ROWS = 3, 8
+LABEL_WIDTH, LABEL_HEIGHT = 70 * mm, 37 * mm
+LABELS_PER_PART = LABEL_COLUMNS * LABEL_ROWS * 100
+
+def label_code(medicine_id, symbology):
+    """Code printed on a medicine's shelf label.
+
+    EAN-13 uses the GS1 in-store prefix 2 followed by the medicine id; the check digit is added by reportlab.
+    """
+    return f"2{medicine_id:011d}" if symbology == "ean13" else f"HM{medicine_id:07d}"
+
+@contextmanager
+def shape_checking_off():
+    """Skip reportlab's per-attribute shape validation, which dominates barcode drawing, for one block."""
+    saved = rl_config.shapeChecking
+    rl_config.shapeChecking = 0
+    try:
+        yield
+    finally:
+        rl_config.shapeChecking = saved
+
+def render_label_part(labels, path, symbology):
+    """Runs in the worker pool: draw (id, name, price, category) labels onto A4 sheets at ``path``."""
+    with shape_checking_off():
+        return draw_label_sheets(labels, path, symbology)
+
+def draw_label_sheets(labels, path, symbology):
+    width, height = A4
+    left = (width - LABEL_COLUMNS * LABEL_WIDTH) / 2
+    top = height - (height - LABEL_ROWS * LABEL_HEIGHT) / 2
+    c = pdf_canvas.Canvas(path, pagesize=A4, pageCompression=1)
+    per_sheet = LABEL_COLUMNS * LABEL_ROWS
+    for n, (medicine_id, name, price, category) in enumerate(labels):
+        slot = n % per_sheet
+        if n and not slot:
+            c.showPage()
+        x = left + (slot % LABEL_COLUMNS) * LABEL_WIDTH
+        y = top - (slot // LABEL_COLUMNS + 1) * LABEL_HEIGHT
+        c.setFont("Helvetica-Bold", 9)
+        c.drawString(x + 4 * mm, y + LABEL_HEIGHT - 7 * mm, name[:34])
+        c.setFont("Helvetica", 7)
+        c.drawString(x + 4 * mm, y + LABEL_HEIGHT - 11 * mm, category or "")
+        c.setFont("Helvetica-Bold", 14)
+        c.drawRightString(x + LABEL_WIDTH - 4 * mm, y + LABEL_HEIGHT - 12 * mm, f"Rs. {price:.2f}")
+        code = label_code(medicine_id, symbology)
+        if symbology == "ean13":
+            widget = eanbc.Ean13BarcodeWidget(code, barHeight=12 * mm, barWidth=0.3 * mm)
+            drawing = Drawing(LABEL_WIDTH, 16 * mm)
+            drawing.add(widget)
+            renderPDF.draw(drawing, c, x + 4 * mm, y + 3 * mm)
+        else:
+            barcode = code128.Code128(code, barHeight=12 * mm, barWidth=0.3 * mm, humanReadable=True)
+            barcode.drawOn(c, x, y + 6 * mm)
+    c.showPage()
+    c.save()
+    return path
+
+def merge_pdfs(paths, out_path):
+    """Concatenate the pages of the PDFs at ``paths`` into ``out_path``; returns the page count."""
+    from pypdf import PdfWriter  # only print-labels needs it; not bundled with the site's interpreter
+    writer = PdfWriter()
+    for path in paths:
+        writer.append(path)
+    with open(out_path, "wb") as out:
+        writer.write(out)
+    return len(writer.pages)
 
 # ----------------------- ROUTES -----------------------
 @app.route("/test")
@@ -65,7 +2170,8 @@ def home():
     if "user_id" not in session:
         return redirect(url_for("login"))
     medicines = Medicine.query.all()
-    return render_template_string(HOME_PAGE, medicines=medicines, username=session["username"])
+    return render_template_string(HOME_PAGE, medicines=medicines, username=session["username"],
+                                  usual=usual_items(session["user_id"]), typical_quantity=typical_quantity)
 
 @app.route("/signup", methods=["GET", "POST"])
 def signup():
@@ -78,8 +2184,9 @@ def signup():
         if User.query.filter_by(username=username).first():
             flash("Username already exists!", "danger")
             return redirect(url_for("signup"))
+        email = request.form.get("email", "").strip() or None
         hashed_pw = generate_password_hash(password)
-        new_user = User(username=username, password=hashed_pw)
+        new_user = User(username=username, password=hashed_pw, patient_key=normalize_patient(username), email=email)
         db.session.add(new_user)
         db.session.commit()
         flash("Signup successful! Please login.", "success")
@@ -98,6 +2205,7 @@ def login():
         if user and check_password_hash(user.password, password):
             session["user_id"] = user.id
             session["username"] = user.username
+            session["is_staff"] = bool(user.is_staff)
             flash("Login successful!", "success")
             return redirect(url_for("home"))
         else:
@@ -117,20 +2225,54 @@ def add_to_cart(medicine_id):
     cart_item = Cart.query.filter_by(user_id=session["user_id"], medicine_id=medicine_id).first()
     if cart_item:
         cart_item.quantity += 1
+        warnings = []
     else:
-        new_item = Cart(user_id=session["user_id"], medicine_id=medicine_id)
+        price = db.session.query(Medicine.price).filter_by(id=medicine_id).scalar()
+        new_item = Cart(user_id=session["user_id"], medicine_id=medicine_id, price_snapshot=price)
         db.session.add(new_item)
+        other_ids = [m for (m,) in db.session.query(Cart.medicine_id).filter_by(user_id=session["user_id"])]
+        warnings = interaction_index().check(medicine_id, other_ids)
     db.session.commit()
     flash("Item added to cart!", "success")
+    for w in describe_interactions(warnings):
+        flash(f"⚠ {w['medicine']} may interact with {w['other']} ({w['severity']}): {w['note'] or ''}", "danger")
     return redirect(url_for("home"))
 
 @app.route("/cart")
 def cart():
     if "user_id" not in session:
         return redirect(url_for("login"))
+    if "coupon" in request.args:
+        session["coupon"] = request.args["coupon"].strip().upper()
     user_cart = Cart.query.filter_by(user_id=session["user_id"]).all()
-    total = sum(item.medicine.price * item.quantity for item in user_cart)
-    return render_template_string(CART_PAGE, cart=user_cart, total=total)
+    pricing = price_cart(user_cart, session.get("coupon"))
+    if pricing["coupon_invalid"]:
+        flash(f"Coupon {session.pop('coupon')} is not valid.", "warning")
+    also_bought = also_bought_for({item.medicine_id for item in user_cart})
+    interactions = describe_interactions(interaction_index().check_all([item.medicine_id for item in user_cart]))
+    points = points_balance(session["user_id"])
+    usable_points = min(points, to_paise(pricing["total"]) // POINT_VALUE_PAISE)
+    return render_template_string(CART_PAGE, cart=user_cart, pricing=pricing, total=pricing["total"],
+                                  also_bought=also_bought, interactions=interactions, slots=available_slots(),
+                                  points=points, usable_points=usable_points,
+                                  changed=changed_cart_lines(session["user_id"]))
+
+@app.route("/cart/accept_prices", methods=["POST"])
+def accept_prices():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    shown = {}
+    for key, value in request.form.items():
+        if key.startswith("price_"):
+            try:
+                shown[int(key[6:])] = float(value)
+            except ValueError:
+                abort(400)
+    accept_cart_prices(session["user_id"], shown)
+    db.session.commit()
+    if changed_cart_lines(session["user_id"]):
+        flash("Some prices changed again while you were looking – please review them.", "warning")
+    return redirect(url_for("cart"))
 
 @app.route("/place_order")
 def place_order():
@@ -140,28 +2282,358 @@ def place_order():
     if not user_cart:
         flash("Your cart is empty!", "warning")
         return redirect(url_for("cart"))
+    if changed_cart_lines(session["user_id"]):
+        flash("Some prices in your cart have changed – please review them before ordering.", "warning")
+        return redirect(url_for("cart"))
 
-    total = sum(item.medicine.price * item.quantity for item in user_cart)
-    new_order = Order(user_id=session["user_id"], total_amount=total)
+    slot_id = request.args.get("slot_id", type=int)
+    if slot_id and not book_slot(slot_id):
+        db.session.rollback()
+        flash("That delivery slot has just filled up, please pick another.", "warning")
+        return redirect(url_for("cart"))
+
+    pricing = price_cart(user_cart, session.pop("coupon", None))
+    new_order = Order(user_id=session["user_id"], total_amount=pricing["total"],
+                      discount=pricing["basket_discount"], slot_id=slot_id)
     db.session.add(new_order)
-    db.session.commit()
+    db.session.flush()
+    record_status_change(new_order.id, None, "placed", session["user_id"])
 
-    for item in user_cart:
+    redeem = min(request.args.get("redeem_points", 0, type=int), to_paise(new_order.total_amount) // POINT_VALUE_PAISE)
+    if redeem > 0:
+        try:
+            redeem_points(session["user_id"], redeem, new_order.id)
+        except InsufficientPoints as e:
+            db.session.rollback()
+            flash(f"{e} – please try again.", "warning")
+            return redirect(url_for("cart"))
+        new_order.points_paise = redeem * POINT_VALUE_PAISE
+    award_points(session["user_id"], to_paise(new_order.total_amount) - (new_order.points_paise or 0), new_order.id)
+
+    for item, line, tax in zip(user_cart, pricing["lines"], tax_order_lines(user_cart, pricing)):
         order_item = OrderItem(order_id=new_order.id, medicine_name=item.medicine.name,
-                               quantity=item.quantity, price=item.medicine.price * item.quantity)
+                               quantity=item.quantity, price=line["net"], hsn_code=tax["hsn_code"],
+                               tax_rate_bp=tax["rate_bp"], taxable_paise=tax["taxable"], cgst_paise=tax["cgst"],
+                               sgst_paise=tax["sgst"], amount_paise=tax["amount"])
         db.session.add(order_item)
         db.session.delete(item)
+    quantities = {}
+    for item in user_cart:
+        quantities[item.medicine_id] = quantities.get(item.medicine_id, 0) + item.quantity
+    record_usual_items(new_order.user_id, quantities, new_order.date)
+    schedule_refills(new_order.user_id, quantities, new_order.date)
+    user = db.session.get(User, session["user_id"])
+    if user.email:
+        lines = "\n".join(f"  {item.medicine.name} × {item.quantity}" for item in user_cart)
+        enqueue_notification("order_confirmation", user.email, f"HealthyMe order #{new_order.id} confirmed",
+                             f"Hi {user.username},\n\nThanks for your order #{new_order.id}:\n{lines}\n\n"
+                             f"Total: ₹{new_order.total_amount:.2f}\n\n– HealthyMe Pharmacy")
     db.session.commit()
+    order_events.notify()
+    queue_invoice(new_order)
 
     flash("Order placed successfully!", "success")
     return redirect(url_for("my_orders"))
 
+def user_order_changes(user_id):
+    """Status changes on a user's orders, read through ix_order_user_date and ix_order_status_change_order."""
+    return (OrderStatusChange.query.join(Order, Order.id == OrderStatusChange.order_id)
+            .filter(Order.user_id == user_id))
+
+@app.route("/my_orders/wait")
+def wait_for_my_orders():
+    """Long poll for My Orders: one request per user, answering with changes to any of their orders after ``after``."""
+    if "user_id" not in session:
+        abort(401)
+    user_id = session["user_id"]
+    after = request.args.get("after", type=int)
+    if after is None:
+        after = user_order_changes(user_id).with_entities(func.max(OrderStatusChange.id)).scalar() or 0
+    changes = wait_for_changes(
+        lambda: user_order_changes(user_id).filter(OrderStatusChange.id > after)
+        .order_by(OrderStatusChange.id).limit(200).all(), request.args.get("timeout", 25, type=float))
+    return jsonify({"last_change_id": changes[-1].id if changes else after, "changes": [change_json(c) for c in changes]})
+
+@app.route("/orders/<int:order_id>/status", methods=["POST"])
+def change_order_status(order_id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    to_status = request.form.get("status", "")
+    order = db.get_or_404(Order, order_id)
+    user = db.session.get(User, session["user_id"])
+    # customers may only cancel their own order before it is packed
+    if not user.is_staff and not (order.user_id == user.id and to_status == "cancelled" and order.status == "placed"):
+        abort(403)
+    try:
+        transition_order(order, to_status, changed_by=user.id)
+    except InvalidTransition as e:
+        db.session.rollback()
+        flash(str(e), "warning")
+    else:
+        db.session.commit()
+        order_events.notify()
+        flash(f"Order #{order.id} is now {to_status}.", "success")
+    return redirect(request.referrer or url_for("my_orders"))
+
+@app.route("/my_orders/<int:order_id>/return", methods=["GET", "POST"])
+def return_items(order_id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    order = Order.query.filter_by(id=order_id, user_id=session["user_id"]).first_or_404()
+    if request.method == "POST":
+        requested = 0
+        try:
+            for item in order.items:
+                quantity = request.form.get(f"qty_{item.id}", 0, type=int)
+                if quantity:
+                    request_return(session["user_id"], item, quantity, request.form.get("reason", "").strip()[:200])
+                    requested += 1
+        except ReturnError as e:
+            db.session.rollback()
+            flash(str(e), "warning")
+            return redirect(url_for("return_items", order_id=order.id))
+        db.session.commit()
+        flash(f"Return requested for {requested} item(s)." if requested else "Nothing selected to return.",
+              "success" if requested else "warning")
+        return redirect(url_for("my_orders"))
+    lines = [(item, returnable_quantity(item)) for item in sorted(order.items, key=lambda i: i.id)]
+    return render_template_string(RETURN_PAGE, order=order, lines=lines)
+
+@app.route("/staff/returns", methods=["GET", "POST"])
+def staff_returns():
+    staff = staff_required()
+    if request.method == "POST":
+        ret = db.get_or_404(ReturnRequest, request.form.get("return_id", type=int))
+        try:
+            expiry = request.form.get("expiry")
+            decide_return(ret, request.form.get("decision") == "approve", staff.id,
+                          batch_no=request.form.get("batch_no", "").strip() or None,
+                          expiry=date.fromisoformat(expiry) if expiry else None,
+                          resaleable=bool(request.form.get("resaleable")))
+        except (ReturnError, ValueError) as e:
+            db.session.rollback()
+            flash(str(e), "warning")
+        else:
+            db.session.commit()
+            flash(f"Return #{ret.id} {ret.status}.", "success")
+        return redirect(url_for("staff_returns"))
+    pending = ReturnRequest.query.filter_by(status="requested").order_by(ReturnRequest.id).limit(200).all()
+    return render_template_string(STAFF_RETURNS_PAGE, returns=pending)
+
+@app.route("/staff/packing")
+def packing_queue():
+    staff_required()
+    status = request.args.get("status", "placed")
+    orders = (Order.query.filter_by(status=status).order_by(Order.date, Order.id).limit(200).all())
+    last_change = db.session.query(func.max(OrderStatusChange.id)).scalar() or 0
+    return render_template_string(PACKING_PAGE, orders=orders, status=status, statuses=list(ORDER_TRANSITIONS),
+                                  transitions=ORDER_TRANSITIONS, last_change=last_change)
+
+@app.route("/staff/packing/wait")
+def packing_wait():
+    """Long poll for packing screens: any status change (including new orders) after change ``after``."""
+    staff_required()
+    after = request.args.get("after", 0, type=int)
+    changes = wait_for_changes(
+        lambda: OrderStatusChange.query.filter(OrderStatusChange.id > after)
+        .order_by(OrderStatusChange.id).limit(200).all(), request.args.get("timeout", 25, type=float))
+    return jsonify({"last_change_id": changes[-1].id if changes else after, "changes": [change_json(c) for c in changes]})
+
+@app.route("/metrics/notifications")
+def notifications_metrics():
+    staff_required()
+    return jsonify(notification_metrics())
+
+@app.route("/delivery_slots")
+def delivery_slots():
+    return jsonify(available_slots(request.args.get("zone")))
+
+@app.route("/reorder/<int:order_id>")
+def reorder(order_id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    order = Order.query.filter_by(id=order_id, user_id=session["user_id"]).first_or_404()
+    quantities, missing = resolve_order_lines(order.items)
+    add_lines_to_cart(session["user_id"], quantities)
+    db.session.commit()
+    flash(f"Added {len(quantities)} item(s) from order #{order.id} to your cart.", "success")
+    if missing:
+        flash("No longer available: " + ", ".join(missing), "warning")
+    return redirect(url_for("cart"))
+
+@app.route("/reorder/usual")
+def reorder_usual():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    usual = usual_items(session["user_id"])
+    add_lines_to_cart(session["user_id"], {u.medicine_id: typical_quantity(u) for u in usual})
+    db.session.commit()
+    flash(f"Added your {len(usual)} usual item(s) to the cart.", "success")
+    return redirect(url_for("cart"))
+
+@app.route("/my_orders/<int:order_id>/invoice.pdf")
+def order_invoice(order_id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    order = Order.query.filter_by(id=order_id, user_id=session["user_id"]).first_or_404()
+    invoice = db.session.get(Invoice, order.id)
+    if invoice is None or not os.path.exists(invoice.path):
+        # Not rendered yet (worker still busy, or an order from before invoices): render it once now
+        os.makedirs(invoice_dir(), exist_ok=True)
+        db.session.query(Invoice).filter_by(order_id=order.id).delete()
+        record_invoice(render_invoice_pdf(invoice_data(order), invoice_dir()))
+        invoice = db.session.get(Invoice, order.id)
+    return send_file(invoice.path, mimetype="application/pdf", conditional=True, etag=invoice.content_hash,
+                     download_name=f"HealthyMe-invoice-{order.id}.pdf", max_age=86400)
+
+@app.route("/my_orders/statement.pdf")
+def order_statement():
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    try:
+        start, end = parse_statement_range(request.args.get("from"), request.args.get("to"))
+    except ValueError:
+        flash("Dates must look like 2024-01-31.", "warning")
+        return redirect(url_for("my_orders"))
+    out = tempfile.TemporaryFile()
+    write_statement_pdf(out, session["username"], statement_lines(session["user_id"], start, end), start, end)
+    out.seek(0)
+    return send_file(out, mimetype="application/pdf", as_attachment=True,
+                     download_name=f"HealthyMe-statement-{datetime.utcnow():%Y%m%d}.pdf")
+
+@app.route("/prescriptions/<int:prescription_id>")
+def prescription_detail(prescription_id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    prescription = user_prescription_or_404(prescription_id)
+    if not prescription.matches:
+        match_prescription(prescription)
+        db.session.commit()
+    ids = [m.medicine_id for m in prescription.matches if m.medicine_id]
+    medicines = {m.id: m for m in Medicine.query.filter(Medicine.id.in_(ids))} if ids else {}
+    return render_template_string(PRESCRIPTION_PAGE, prescription=prescription, medicines=medicines,
+                                  accept=MATCH_ACCEPT)
+
+@app.route("/prescriptions/<int:prescription_id>/to_cart")
+def prescription_to_cart(prescription_id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    prescription = user_prescription_or_404(prescription_id)
+    matches = prescription.matches or match_prescription(prescription)
+    wanted = {m.medicine_id for m in matches if m.medicine_id and m.confidence >= MATCH_ACCEPT}
+    add_lines_to_cart(session["user_id"], dict.fromkeys(wanted, 1))
+    db.session.commit()
+    skipped = len(matches) - len(wanted)
+    flash(f"Added {len(wanted)} prescribed items to cart." + (f" {skipped} line(s) need checking." if skipped else ""),
+          "success" if not skipped else "warning")
+    return redirect(url_for("cart"))
+
+def timeline_page(source, date_col, id_col, rank, cursor, limit):
+    """Up to ``limit`` rows of one timeline source strictly after ``cursor`` in (date, rank, id) desc order."""
+    if cursor:
+        cursor_date, cursor_rank, cursor_id = cursor
+        if rank < cursor_rank:
+            source = source.filter(date_col <= cursor_date)
+        elif rank > cursor_rank:
+            source = source.filter(date_col < cursor_date)
+        else:
+            source = source.filter(or_(date_col < cursor_date,
+                                       and_(date_col == cursor_date, id_col < cursor_id)))
+    return source.limit(limit).all()
+
+TIMELINE_RANK = {"prescription": 0, "order": 1}
+
+@app.route("/patients/timeline")
+def patient_timeline():
+    """Keyset-paginated, newest-first merge of a patient's prescriptions and orders.
+
+    Pass the returned ``next`` value back as ``before`` to fetch the following page.
+    """
+    if "user_id" not in session:
+        return jsonify({"error": "Login required"}), 401
+    patient_key = normalize_patient(request.args.get("patient", ""))
+    if not patient_key:
+        return jsonify({"error": "patient is required"}), 400
+    if not can_see_patient(db.session.get(User, session["user_id"]), patient_key):
+        # 404 rather than 403, so the route does not confirm which patients exist
+        return jsonify({"error": "Not found"}), 404
+    backfill_patient_keys()
+    limit = min(request.args.get("limit", 50, type=int), 200)
+    cursor = None
+    if request.args.get("before"):
+        try:
+            date, kind, row_id = request.args["before"].split("~")
+            cursor = (datetime.fromisoformat(date), TIMELINE_RANK[kind], int(row_id))
+        except (ValueError, KeyError):
+            return jsonify({"error": "Invalid cursor"}), 400
+
+    prescriptions = timeline_page(
+        Prescription.query.filter(Prescription.patient_key == patient_key, Prescription.created_at.isnot(None))
+        .order_by(Prescription.created_at.desc(), Prescription.id.desc()),
+        Prescription.created_at, Prescription.id, TIMELINE_RANK["prescription"], cursor, limit + 1)
+    user_ids = [u for (u,) in db.session.query(User.id).filter_by(patient_key=patient_key)]
+    orders = timeline_page(
+        Order.query.filter(Order.user_id.in_(user_ids)).order_by(Order.date.desc(), Order.id.desc()),
+        Order.date, Order.id, TIMELINE_RANK["order"], cursor, limit + 1) if user_ids else []
+
+    events = [("prescription", p.created_at, p) for p in prescriptions] + [("order", o.date, o) for o in orders]
+    events.sort(key=lambda e: (e[1], TIMELINE_RANK[e[0]], e[2].id), reverse=True)
+    page, more = events[:limit], len(events) > limit
+    data = []
+    for kind, date, row in page:
+        entry = {"type": kind, "id": row.id, "date": date.isoformat()}
+        if kind == "prescription":
+            entry.update(medicine=row.medicine, dosage=row.dosage, created_by=row.created_by)
+        else:
+            entry.update(total_amount=row.total_amount)
+        data.append(entry)
+    next_cursor = f"{page[-1][1].isoformat()}~{page[-1][0]}~{page[-1][2].id}" if more else None
+    return jsonify({"patient": patient_key, "events": data, "next": next_cursor})
+
+@app.route("/prescriptions/<int:prescription_id>/images", methods=["POST"])
+def upload_prescription_image(prescription_id):
+    """Accept a photo as a multipart "photo" field or as the raw request body, streamed to disk."""
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    user_prescription_or_404(prescription_id)
+    stream = request.files["photo"].stream if "photo" in request.files else request.stream
+    out_dir = prescription_upload_dir(prescription_id)
+    os.makedirs(out_dir, exist_ok=True)
+    stem = uuid.uuid4().hex
+    original = os.path.join(out_dir, f"{stem}.orig")
+    if not save_upload_stream(stream, original, MAX_PRESCRIPTION_UPLOAD):
+        abort(413)
+    image = PrescriptionImage(prescription_id=prescription_id, original=original)
+    db.session.add(image)
+    db.session.commit()
+    future = worker_pool().submit(process_prescription_image, original, out_dir, stem)
+    future.add_done_callback(lambda f, image_id=image.id: record_processed_image(image_id, f))
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"id": image.id, "status": image.status}), 202
+    flash("Photo uploaded, preparing preview…", "info")
+    return redirect(url_for("prescription_detail", prescription_id=prescription_id))
+
+@app.route("/prescriptions/images/<int:image_id>/<variant>")
+def prescription_image(image_id, variant):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    if variant not in ("large", "thumb", "thumb_jpeg"):
+        abort(404)
+    image = db.get_or_404(PrescriptionImage, image_id)
+    user_prescription_or_404(image.prescription_id)
+    path = getattr(image, variant)
+    if image.status != "ready" or not path:
+        return jsonify({"id": image.id, "status": image.status}), 404
+    return send_file(path, max_age=86400)
+
 @app.route("/my_orders")
 def my_orders():
     if "user_id" not in session:
         return redirect(url_for("login"))
     orders = Order.query.filter_by(user_id=session["user_id"]).order_by(Order.date.desc()).all()
-    return render_template_string(ORDERS_PAGE, orders=orders)
+    last_change = user_order_changes(session["user_id"]).with_entities(func.max(OrderStatusChange.id)).scalar() or 0
+    return render_template_string(ORDERS_PAGE, orders=orders, last_change=last_change, transitions=ORDER_TRANSITIONS,
+                                  points=points_balance(session["user_id"]))
 
 # ----------------------- STYLED HTML -----------------------
 BOOTSTRAP = '''
@@ -176,6 +2648,10 @@ NAVBAR = '''
       {% if session.get("user_id") %}
       <a href="{{url_for('cart')}}" class="btn btn-light me-2">🛒 Cart</a>
       <a href="{{url_for('my_orders')}}" class="btn btn-warning me-2">📦 My Orders</a>
+      {% if session.get("is_staff") %}
+      <a href="{{url_for('packing_queue')}}" class="btn btn-light me-2">📋 Packing</a>
+      <a href="{{url_for('staff_returns')}}" class="btn btn-light me-2">↩ Returns</a>
+      {% endif %}
       <a href="{{url_for('logout')}}" class="btn btn-danger">Logout</a>
       {% else %}
       <a href="{{url_for('login')}}" class="btn btn-light me-2">Login</a>
@@ -184,11 +2660,25 @@ NAVBAR = '''
     </div>
   </div>
 </nav>
+<div class="container">
+  {% for category, message in get_flashed_messages(with_categories=true) %}
+  <div class="alert alert-{{category}} py-2">{{message}}</div>
+  {% endfor %}
+</div>
 '''
 
 HOME_PAGE = BOOTSTRAP + NAVBAR + '''
 <div class="container">
   <h3 class="mb-4 text-success">Welcome, {{username}} 👋</h3>
+  {% if usual %}
+  <div class="card shadow-sm mb-4">
+    <div class="card-body">
+      <h5 class="text-success">Your usual items</h5>
+      <p class="mb-2">{% for u in usual %}{{u.medicine.name}} × {{typical_quantity(u)}}{% if not loop.last %}, {% endif %}{% endfor %}</p>
+      <a href="{{url_for('reorder_usual')}}" class="btn btn-sm btn-warning">🔁 Add all to cart</a>
+    </div>
+  </div>
+  {% endif %}
   <div class="row">
     {% for med in medicines %}
     <div class="col-md-3 mb-3">
@@ -211,6 +2701,7 @@ SIGNUP_PAGE = BOOTSTRAP + NAVBAR + '''
   <form method="post" class="card p-4 shadow-sm">
     <input name="username" class="form-control mb-3" placeholder="Username" required>
     <input name="password" type="password" class="form-control mb-3" placeholder="Password" required>
+    <input name="email" type="email" class="form-control mb-3" placeholder="Email (for refill reminders)">
     <button type="submit" class="btn btn-success w-100">Signup</button>
   </form>
   <div class="text-center mt-2">
@@ -236,38 +2727,157 @@ LOGIN_PAGE = BOOTSTRAP + NAVBAR + '''
 CART_PAGE = BOOTSTRAP + NAVBAR + '''
 <div class="container">
   <h3 class="text-success mb-3">Your Cart 🛒</h3>
+  {% for w in interactions %}
+  <div class="alert alert-{{ 'danger' if w.severity == 'major' else 'warning' }}">
+    ⚠ <b>{{w.medicine}}</b> and <b>{{w.other}}</b> may interact ({{w.severity}}){% if w.note %}: {{w.note}}{% endif %}
+  </div>
+  {% endfor %}
+  {% if changed %}
+  <div class="alert alert-warning d-flex justify-content-between align-items-center">
+    <span>💱 Prices of {{changed|length}} item(s) have changed since you added them.</span>
+    <form method="POST" action="{{url_for('accept_prices')}}">
+      {% for line_id, (was, now) in changed.items() %}<input type="hidden" name="price_{{line_id}}" value="{{now}}">{% endfor %}
+      <button class="btn btn-sm btn-warning">Accept new prices</button>
+    </form>
+  </div>
+  {% endif %}
   {% if cart %}
   <table class="table table-bordered bg-white shadow-sm">
     <thead><tr><th>Medicine</th><th>Qty</th><th>Price</th></tr></thead>
     <tbody>
     {% for item in cart %}
-      <tr><td>{{item.medicine.name}}</td><td>{{item.quantity}}</td><td>₹{{item.medicine.price * item.quantity}}</td></tr>
+      {% set line = pricing.lines[loop.index0] %}
+      <tr{% if item.id in changed %} class="table-warning"{% endif %}><td>{{item.medicine.name}}
+        {% if item.id in changed %}<small class="text-muted">was ₹{{changed[item.id][0]}}, now ₹{{changed[item.id][1]}}</small>{% endif %}</td><td>{{item.quantity}}</td>
+        <td>{% if line.discount %}<s class="text-muted">₹{{line.gross}}</s> ₹{{line.net}} <small class="text-success">{{line.rule}}</small>{% else %}₹{{line.gross}}{% endif %}</td></tr>
     {% endfor %}
+    {% if pricing.basket_discount %}
+      <tr><td colspan="2">{{pricing.basket_rule}}</td><td class="text-success">−₹{{pricing.basket_discount}}</td></tr>
+    {% endif %}
     </tbody>
   </table>
-  <h4 class="text-end text-success">Total: ₹{{total}}</h4>
-  <div class="text-end"><a href="{{url_for('place_order')}}" class="btn btn-warning mt-2">Place Order</a></div>
+  <form action="{{url_for('cart')}}" class="d-flex justify-content-end gap-2">
+    <input name="coupon" value="{{pricing.coupon or ''}}" placeholder="Coupon code" class="form-control w-auto">
+    <button type="submit" class="btn btn-sm btn-outline-success">Apply</button>
+  </form>
+  <h4 class="text-end text-success mt-2">Total: ₹{{total}}</h4>
+  <form action="{{url_for('place_order')}}" class="d-flex justify-content-end gap-2 mt-2">
+    {% if slots %}
+    <select name="slot_id" class="form-select w-auto">
+      <option value="">Standard delivery</option>
+      {% for slot in slots %}
+      <option value="{{slot.id}}">{{slot.label}} ({{slot.left}} left)</option>
+      {% endfor %}
+    </select>
+    {% endif %}
+    {% if usable_points %}
+    <label class="d-flex align-items-center gap-1">⭐ Use
+      <input type="number" name="redeem_points" min="0" max="{{usable_points}}" value="0" class="form-control w-auto">
+      of {{points}} points</label>
+    {% endif %}
+    <button type="submit" class="btn btn-warning">Place Order</button>
+  </form>
   {% else %}
   <p>Your cart is empty.</p>
   {% endif %}
+  {% if also_bought %}
+  <h5 class="text-success mt-4">Customers also bought</h5>
+  <div class="row">
+    {% for med in also_bought %}
+    <div class="col-md-3 mb-3">
+      <div class="card shadow-sm">
+        <div class="card-body text-center">
+          <h6 class="card-title">{{med.name}}</h6>
+          <p class="card-text">₹{{med.price}}</p>
+          <a href="{{url_for('add_to_cart', medicine_id=med.id)}}" class="btn btn-sm btn-success">Add to Cart</a>
+        </div>
+      </div>
+    </div>
+    {% endfor %}
+  </div>
+  {% endif %}
+</div>
+'''
+
+PRESCRIPTION_PAGE = BOOTSTRAP + NAVBAR + '''
+<div class="container">
+  <h3 class="text-success mb-3">Prescription #{{prescription.id}} – {{prescription.patient_name}} ({{prescription.age}})</h3>
+  <p class="text-muted">Dosage: {{prescription.dosage}}{% if prescription.notes %} · {{prescription.notes}}{% endif %}</p>
+  <table class="table table-bordered bg-white shadow-sm">
+    <thead><tr><th>Prescribed</th><th>Catalog match</th><th>Confidence</th></tr></thead>
+    <tbody>
+    {% for m in prescription.matches %}
+      <tr class="{{ '' if m.confidence >= accept else 'table-warning' }}">
+        <td>{{m.line}}</td>
+        <td>{% if m.medicine_id in medicines %}{{medicines[m.medicine_id].name}} – ₹{{medicines[m.medicine_id].price}}{% else %}<em>No match</em>{% endif %}</td>
+        <td>{{ "%.0f"|format(m.confidence * 100) }}%</td>
+      </tr>
+    {% endfor %}
+    </tbody>
+  </table>
+  <div class="text-end"><a href="{{url_for('prescription_to_cart', prescription_id=prescription.id)}}" class="btn btn-success">Add matched items to cart</a></div>
+  <h5 class="text-success mt-4">Photos</h5>
+  <div class="d-flex flex-wrap gap-2 mb-3">
+    {% for img in prescription.images %}
+      {% if img.status == "ready" %}
+      <a href="{{url_for('prescription_image', image_id=img.id, variant='large')}}">
+        <picture>
+          <source srcset="{{url_for('prescription_image', image_id=img.id, variant='thumb')}}" type="image/webp">
+          <img src="{{url_for('prescription_image', image_id=img.id, variant='thumb_jpeg')}}" class="img-thumbnail" loading="lazy" alt="Prescription photo">
+        </picture>
+      </a>
+      {% else %}
+      <span class="badge bg-secondary">Photo {{img.status}}</span>
+      {% endif %}
+    {% endfor %}
+  </div>
+  <form method="post" enctype="multipart/form-data" action="{{url_for('upload_prescription_image', prescription_id=prescription.id)}}" class="d-flex gap-2">
+    <input type="file" name="photo" accept="image/*" capture="environment" class="form-control" required>
+    <button type="submit" class="btn btn-outline-success">Upload</button>
+  </form>
 </div>
 '''
 
 ORDERS_PAGE = BOOTSTRAP + NAVBAR + '''
 <div class="container">
-  <h3 class="text-success mb-3">My Orders 📦</h3>
+  <h3 class="text-success mb-3">My Orders 📦 <small class="text-muted fs-6">⭐ {{points}} points</small></h3>
+  <form action="{{url_for('order_statement')}}" class="d-flex gap-2 align-items-center mb-3">
+    <span>Statement</span>
+    <input type="date" name="from" class="form-control w-auto">
+    <span>to</span>
+    <input type="date" name="to" class="form-control w-auto">
+    <button type="submit" class="btn btn-sm btn-outline-success">📄 Download PDF</button>
+  </form>
   {% if orders %}
   {% for order in orders %}
     <div class="card mb-3 shadow-sm">
       <div class="card-body">
-        <h5>Order #{{order.id}}</h5>
+        <h5>Order #{{order.id}}
+          <span class="badge bg-secondary order-status" id="order-status-{{order.id}}"
+                data-final="{{ 0 if transitions[order.status] else 1 }}">{{order.status}}</span></h5>
         <small class="text-muted">{{order.date.strftime("%d-%m-%Y %H:%M")}}</small>
+        {% if order.slot %}
+        <div><small>🚚 Delivery {{order.slot.starts_at|store_time}}–{{order.slot.ends_at|store_time("%H:%M")}} ({{order.slot.zone}})</small></div>
+        {% endif %}
         <ul class="mt-2">
           {% for item in order.items %}
             <li>{{item.medicine_name}} × {{item.quantity}} = ₹{{item.price}}</li>
           {% endfor %}
         </ul>
+        {% if order.discount %}<div><small class="text-success">Discount −₹{{order.discount}}</small></div>{% endif %}
+        {% if order.points_paise %}<div><small class="text-success">Paid with points ₹{{ "%.2f"|format(order.points_paise / 100) }}</small></div>{% endif %}
         <h6 class="text-success">Total: ₹{{order.total_amount}}</h6>
+        <a href="{{url_for('order_invoice', order_id=order.id)}}" class="btn btn-sm btn-outline-secondary">🧾 Invoice PDF</a>
+        <a href="{{url_for('reorder', order_id=order.id)}}" class="btn btn-sm btn-outline-success">🔁 Reorder</a>
+        {% if order.status == "delivered" %}
+        <a href="{{url_for('return_items', order_id=order.id)}}" class="btn btn-sm btn-outline-warning">↩ Return items</a>
+        {% endif %}
+        {% if order.refunded_paise %}<small class="text-success ms-2">Refunded ₹{{ "%.2f"|format(order.refunded_paise / 100) }}</small>{% endif %}
+        {% if order.status == "placed" %}
+        <form method="post" action="{{url_for('change_order_status', order_id=order.id)}}" class="d-inline">
+          <button name="status" value="cancelled" class="btn btn-sm btn-outline-danger">Cancel</button>
+        </form>
+        {% endif %}
       </div>
     </div>
   {% endfor %}
@@ -275,8 +2885,445 @@ ORDERS_PAGE = BOOTSTRAP + NAVBAR + '''
   <p>You haven't placed any orders yet.</p>
   {% endif %}
 </div>
+<script>
+  // a single long-poll for all of the user's orders; it returns on the next status change to any of them
+  (async function(after){
+    while(document.querySelector(".order-status[data-final='0']")){
+      const res = await fetch(`/my_orders/wait?after=${after}`);
+      if(!res.ok) return;
+      const data = await res.json();
+      after = data.last_change_id;
+      for(const change of data.changes){
+        const badge = document.getElementById(`order-status-${change.order_id}`);
+        if(!badge) continue;
+        badge.textContent = change.to;
+        if(change.to === "delivered" || change.to === "cancelled") badge.dataset.final = "1";
+      }
+    }
+  })({{last_change}});
+</script>
 '''
 
+RETURN_PAGE = BOOTSTRAP + NAVBAR + '''
+<div class="container">
+  <h3 class="text-success mb-3">Return items from order #{{order.id}}</h3>
+  <form method="post" class="card p-3 shadow-sm">
+    <table class="table">
+      <thead><tr><th>Medicine</th><th>Ordered</th><th>Return</th></tr></thead>
+      <tbody>
+      {% for item, left in lines %}
+        <tr><td>{{item.medicine_name}}</td><td>{{item.quantity}}</td>
+          <td>{% if left %}<input type="number" name="qty_{{item.id}}" min="0" max="{{left}}" value="0" class="form-control w-auto">
+              {% else %}<small class="text-muted">already returned</small>{% endif %}</td></tr>
+      {% endfor %}
+      </tbody>
+    </table>
+    <input name="reason" class="form-control mb-3" placeholder="Reason (optional)" maxlength="200">
+    <button type="submit" class="btn btn-warning">Request return</button>
+  </form>
+</div>
+'''
+
+STAFF_RETURNS_PAGE = BOOTSTRAP + NAVBAR + '''
+<div class="container">
+  <h3 class="text-success mb-3">Return requests</h3>
+  <table class="table table-bordered bg-white shadow-sm">
+    <thead><tr><th>#</th><th>Order line</th><th>Qty</th><th>Reason</th><th>Decision</th></tr></thead>
+    <tbody>
+    {% for r in returns %}
+      <tr>
+        <td>{{r.id}}</td>
+        <td>#{{r.item.order_id}} · {{r.item.medicine_name}}</td>
+        <td>{{r.quantity}} of {{r.item.quantity}}</td>
+        <td>{{r.reason or ''}}</td>
+        <td>
+          <form method="post" class="d-flex gap-1 align-items-center">
+            <input type="hidden" name="return_id" value="{{r.id}}">
+            <input name="batch_no" placeholder="Batch" class="form-control form-control-sm w-auto">
+            <input name="expiry" type="date" class="form-control form-control-sm w-auto">
+            <label class="small"><input type="checkbox" name="resaleable" value="1"> restock</label>
+            <button name="decision" value="approve" class="btn btn-sm btn-success">Approve</button>
+            <button name="decision" value="reject" class="btn btn-sm btn-outline-danger">Reject</button>
+          </form>
+        </td>
+      </tr>
+    {% else %}
+      <tr><td colspan="5">No open return requests.</td></tr>
+    {% endfor %}
+    </tbody>
+  </table>
+</div>
+'''
+
+PACKING_PAGE = BOOTSTRAP + NAVBAR + '''
+<div class="container">
+  <h3 class="text-success mb-3">Packing queue</h3>
+  <div class="mb-3">
+    {% for s in statuses %}
+    <a href="{{url_for('packing_queue', status=s)}}" class="btn btn-sm {{ 'btn-success' if s == status else 'btn-outline-success' }}">{{s}}</a>
+    {% endfor %}
+  </div>
+  <table class="table table-bordered bg-white shadow-sm">
+    <thead><tr><th>Order</th><th>Placed</th><th>Items</th><th>Delivery</th><th></th></tr></thead>
+    <tbody>
+    {% for order in orders %}
+      <tr>
+        <td>#{{order.id}} · {{order.user.username}}</td>
+        <td>{{order.date.strftime("%d-%m %H:%M")}}</td>
+        <td>{% for item in order.items %}{{item.medicine_name}} × {{item.quantity}}{% if not loop.last %}, {% endif %}{% endfor %}</td>
+        <td>{% if order.slot %}{{order.slot.zone}} {{order.slot.starts_at|store_time("%d-%m %H:%M")}}{% endif %}</td>
+        <td>
+          <form method="post" action="{{url_for('change_order_status', order_id=order.id)}}" class="d-flex gap-1">
+            {% for to in transitions[order.status] %}
+            <button name="status" value="{{to}}" class="btn btn-sm {{ 'btn-outline-danger' if to == 'cancelled' else 'btn-success' }}">{{to}}</button>
+            {% endfor %}
+          </form>
+        </td>
+      </tr>
+    {% else %}
+      <tr><td colspan="5">Nothing {{status}}.</td></tr>
+    {% endfor %}
+    </tbody>
+  </table>
+</div>
+<script>
+  // reload when anything changes instead of polling on a timer
+  (async function watch(after){
+    while(true){
+      const res = await fetch(`/staff/packing/wait?after=${after}`);
+      if(!res.ok) return;
+      const data = await res.json();
+      if(data.changes.length){ location.reload(); return; }
+    }
+  })({{last_change}});
+</script>
+'''
+
+# ----------------------- CLI COMMANDS -----------------------
+@app.cli.command("build-recommendations")
+@click.option("--batch-size", default=5000, help="Order lines read per query.")
+@click.option("--flush-pairs", default=200000, help="Pairs held in memory before writing them out.")
+def build_recommendations_command(batch_size, flush_pairs):
+    """Fold orders placed since the last run into the 'customers also bought' counts."""
+    create_tables()
+    processed = update_co_purchases(batch_size=batch_size, flush_pairs=flush_pairs)
+    publish_also_bought_index()
+    print(f"✅ Processed {processed} new orders")
+
+@app.cli.command("import-interactions")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_interactions_command(path):
+    """Load ingredient interactions from a CSV with ingredient_a,ingredient_b,severity,note columns."""
+    create_tables()
+    print(f"✅ Imported {import_interactions_csv(path)} interactions")
+
+@app.cli.command("import-ingredients")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_ingredients_command(path):
+    """Load medicine ingredients from a CSV with medicine,ingredient columns."""
+    create_tables()
+    loaded, unknown = import_ingredients_csv(path)
+    print(f"✅ Imported {loaded} medicine ingredients")
+    if unknown:
+        print("⚠ Unknown medicines: " + ", ".join(unknown))
+
+@app.cli.command("match-prescriptions")
+@click.option("--batch-size", default=500, help="Prescriptions matched per transaction.")
+def match_prescriptions_command(batch_size):
+    """Resolve prescriptions added since the last run to catalog medicines."""
+    create_tables()
+    print(f"✅ Matched {match_prescription_backlog(batch_size=batch_size)} prescriptions")
+
+@app.cli.command("backfill-invoices")
+@click.option("--workers", default=os.cpu_count() or 2, help="Rendering processes.")
+@click.option("--batch-size", default=200, help="Orders loaded per query.")
+def backfill_invoices_command(workers, batch_size):
+    """Render invoices for every order that does not have one yet."""
+    create_tables()
+    os.makedirs(invoice_dir(), exist_ok=True)
+    rendered, last_id = 0, 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = (Order.query.outerjoin(Invoice, Invoice.order_id == Order.id)
+                     .filter(Invoice.order_id.is_(None), Order.id > last_id)
+                     .order_by(Order.id).limit(batch_size).all())
+            if not batch:
+                break
+            last_id = batch[-1].id
+            for result in pool.map(render_invoice_pdf, [invoice_data(o) for o in batch],
+                                   [invoice_dir()] * len(batch)):
+                record_invoice(result)
+                rendered += 1
+    print(f"✅ Rendered {rendered} invoices")
+
+@app.cli.command("export-statement")
+@click.argument("username")
+@click.argument("out", type=click.Path(dir_okay=False, writable=True))
+@click.option("--from", "start", help="First day, YYYY-MM-DD.")
+@click.option("--to", "end", help="Last day, YYYY-MM-DD.")
+def export_statement_command(username, out, start, end):
+    """Write USERNAME's order statement to the PDF file OUT."""
+    create_tables()
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username}")
+    try:
+        start, end = parse_statement_range(start, end)
+    except ValueError:
+        raise click.ClickException("Dates must look like 2024-01-31.")
+    with open(out, "wb") as f:
+        write_statement_pdf(f, user.username, statement_lines(user.id, start, end), start, end)
+    print(f"✅ Statement written to {out}")
+
+@app.cli.command("print-labels")
+@click.argument("out", type=click.Path(dir_okay=False, writable=True))
+@click.option("--changed-since", type=click.DateTime(), help="Only medicines updated at or after this time.")
+@click.option("--category", help="Only medicines in this category.")
+@click.option("--symbology", type=click.Choice(["code128", "ean13"]), default="code128")
+@click.option("--workers", default=os.cpu_count() or 2, help="Rendering processes.")
+def print_labels_command(out, changed_since, category, symbology, workers):
+    """Render shelf labels with barcodes and prices to the PDF file OUT."""
+    create_tables()
+    query = db.session.query(Medicine.id, Medicine.name, Medicine.price, Medicine.category)
+    if changed_since:
+        query = query.filter(Medicine.updated_at >= changed_since)
+    if category:
+        query = query.filter(Medicine.category == category)
+    labels = [tuple(row) for row in query.order_by(Medicine.category, Medicine.name)]
+    if not labels:
+        print("Nothing to print")
+        return
+    with tempfile.TemporaryDirectory() as tmp, ProcessPoolExecutor(max_workers=workers) as pool:
+        chunks = [labels[i:i + LABELS_PER_PART] for i in range(0, len(labels), LABELS_PER_PART)]
+        paths = [os.path.join(tmp, f"part-{n:05d}.pdf") for n in range(len(chunks))]
+        parts = list(pool.map(render_label_part, chunks, paths, [symbology] * len(chunks)))
+        pages = merge_pdfs(parts, out)
+    print(f"✅ {len(labels)} labels on {pages} sheets written to {out}")
+
+@app.cli.command("import-prices")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--at", type=click.DateTime(), help="When the new prices took effect, if earlier (default now).")
+def import_prices_command(path, at):
+    """Reprice medicines from a CSV with medicine,price columns, keeping their price history."""
+    create_tables()
+    try:
+        changed, unknown = import_prices_csv(path, at)
+    except ValueError as e:
+        db.session.rollback()
+        print(f"⚠ Nothing repriced: {e}")
+        return
+    print(f"✅ Repriced {changed} medicines")
+    if unknown:
+        print("⚠ Unknown medicines: " + ", ".join(unknown))
+
+@app.cli.command("price-as-of")
+@click.argument("medicine")
+@click.argument("when", type=click.DateTime())
+def price_as_of_command(medicine, when):
+    """Print what MEDICINE cost at WHEN."""
+    create_tables()
+    medicine_id = db.session.query(Medicine.id).filter_by(name=medicine).scalar()
+    price = price_as_of(medicine_id, when) if medicine_id else None
+    print(f"₹{price}" if price is not None else "⚠ No price on record")
+
+@app.cli.command("import-discounts")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_discounts_command(path):
+    """Replace the discount rules with those in a CSV."""
+    create_tables()
+    imported, skipped = import_discounts_csv(path)
+    print(f"✅ Imported {imported} discount rules")
+    if skipped:
+        print("⚠ Skipped (unknown kind, or BOGO value under 1): " + ", ".join(skipped))
+
+@app.cli.command("bench-pricing")
+@click.option("--rules", default=5000, help="Active rules to compile.")
+@click.option("--lines", default=20, help="Lines per cart.")
+@click.option("--carts", default=2000, help="Carts to price.")
+def bench_pricing_command(rules, lines, carts):
+    """Time cart pricing against synthetic rules (nothing is written to the database)."""
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    categories = [f"Category {n}" for n in range(50)]
+    synthetic = [DiscountRule(id=n, name=f"Rule {n}", code=f"CODE{n % 20}" if n % 10 == 0 else None,
+                              kind=rng.choice(DISCOUNT_KINDS), value=rng.randint(1, 30),
+                              medicine_id=rng.randint(1, 10000) if n % 3 == 0 else None,
+                              category=rng.choice(categories) if n % 3 == 1 else None,
+                              min_basket=rng.choice([0, 0, 100, 250, 500, 1000]),
+                              starts_at=now - timedelta(days=1), ends_at=now + timedelta(days=rng.randint(1, 30)))
+                 for n in range(1, rules + 1)]
+    started = time.perf_counter()
+    engine = DiscountEngine(synthetic, now)
+    compiled_ms = (time.perf_counter() - started) * 1000
+    baskets = [[(rng.randint(1, 10000), rng.choice(categories), rng.randint(5, 500), rng.randint(1, 5))
+                for _ in range(lines)] for _ in range(carts)]
+    timings = []
+    for basket in baskets:
+        started = time.perf_counter()
+        engine.price(basket, coupon=rng.choice([None, "CODE0", "CODE10"]))
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    p50, p99 = timings[len(timings) // 2], timings[int(len(timings) * 0.99)]
+    print(f"Compiled {rules} rules in {compiled_ms:.1f} ms")
+    print(f"{carts} carts of {lines} lines: p50 {p50 * 1000:.0f} µs, p99 {p99 * 1000:.0f} µs")
+    print("✅ Under 1 ms" if p99 < 1 else "⚠ Over 1 ms at p99")
+
+@app.cli.command("rebuild-usual-items")
+@click.option("--batch-size", default=500, help="Orders per transaction.")
+def rebuild_usual_items_command(batch_size):
+    """Recompute every user's usual items from their order history."""
+    create_tables()
+    rebuild_usual_items(batch_size=batch_size)
+    print(f"✅ {UsualItem.query.count()} usual items rebuilt")
+
+@app.cli.command("send-refill-reminders")
+@click.option("--notifier", "spec", default="queue", help="queue, file:PATH or smtp:HOST:PORT.")
+@click.option("--batch-size", default=1000, help="Reminders per keyset batch and transaction.")
+@click.option("--loop", is_flag=True, help="Keep running, checking every --interval seconds.")
+@click.option("--interval", default=60, help="Seconds between checks with --loop.")
+def send_refill_reminders_command(spec, batch_size, loop, interval):
+    """Send refill reminders that have come due."""
+    create_tables()
+    notifier = make_notifier(spec)
+    while True:
+        sent = send_due_reminders(notifier, batch_size=batch_size)
+        print(f"✅ Sent {sent} refill reminders")
+        if not loop:
+            break
+        time.sleep(interval)
+
+@app.cli.command("snapshot-points")
+@click.option("--batch-size", default=5000, help="Ledger entries folded per transaction.")
+def snapshot_points_command(batch_size):
+    """Fold new loyalty ledger entries into balance snapshots (run periodically)."""
+    create_tables()
+    print(f"✅ Folded {snapshot_points(batch_size=batch_size)} ledger entries into snapshots")
+
+@app.cli.command("settle-refunds")
+@click.option("--batch-size", default=500, help="Refunds settled per transaction.")
+def settle_refunds_command(batch_size):
+    """Settle approved refunds since the last run (restartable)."""
+    create_tables()
+    settled, total = settle_refunds(batch_size=batch_size)
+    print(f"✅ Settled {settled} refunds, ₹{total / 100:.2f} in total")
+
+@app.cli.command("export-restock")
+@click.argument("out", type=click.Path(dir_okay=False, writable=True))
+def export_restock_command(out):
+    """Write returned, resaleable units to OUT as a CSV for the inventory app's receive-stock command."""
+    create_tables()
+    print(f"✅ {export_restock_csv(out)} restock lines written to {out}")
+
+@app.cli.command("make-staff")
+@click.argument("username")
+def make_staff_command(username):
+    """Let USERNAME work the packing queue and change order statuses."""
+    create_tables()
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username}")
+    user.is_staff = True
+    db.session.commit()
+    print(f"✅ {username} is now staff")
+
+@app.cli.command("send-notifications")
+@click.option("--smtp", default="localhost:25", help="SMTP server as HOST:PORT.")
+@click.option("--workers", default=4, help="Sending threads, each with its own pooled connection.")
+@click.option("--batch-size", default=50, help="Messages claimed and sent per batch.")
+@click.option("--once", is_flag=True, help="Drain what is due now and exit instead of running forever.")
+@click.option("--metrics-every", default=30, help="Seconds between metrics lines while running.")
+def send_notifications_command(smtp, workers, batch_size, once, metrics_every):
+    """Deliver queued notifications over SMTP."""
+    create_tables()
+    host, _, port = smtp.partition(":")
+    dispatcher = NotificationDispatcher(host or "localhost", int(port or 25), workers=workers, batch_size=batch_size)
+    if once:
+        while dispatcher.run_once():
+            pass
+        dispatcher.pool.close()
+        print(f"✅ {dispatcher.stats()} {notification_metrics()}")
+        return
+    dispatcher.start()
+    try:
+        while True:
+            time.sleep(metrics_every)
+            print(json.dumps({**notification_metrics(), **dispatcher.stats()}))
+    except KeyboardInterrupt:
+        dispatcher.stop()
+
+@app.cli.command("smtp-sink")
+@click.option("--port", default=1025, help="Port to listen on (127.0.0.1).")
+@click.option("--out", "out_dir", type=click.Path(file_okay=False), help="Write each message here as an .eml file.")
+def smtp_sink_command(port, out_dir):
+    """Run a local SMTP server that accepts and keeps every message, for development and tests."""
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    print(f"✅ SMTP sink listening on 127.0.0.1:{port}")
+    with SMTPSink(port=port, out_dir=out_dir) as sink:
+        sink.serve_forever()
+
+@app.cli.command("set-refill-days")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def set_refill_days_command(path):
+    """Set how many days one unit of a medicine lasts, from a CSV with medicine,days_per_unit columns."""
+    create_tables()
+    name_to_id = dict(db.session.query(Medicine.name, Medicine.id))
+    updated, unknown = 0, []
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            medicine_id = name_to_id.get(row["medicine"].strip())
+            if medicine_id is None:
+                unknown.append(row["medicine"].strip())
+                continue
+            Medicine.query.filter_by(id=medicine_id).update({"days_per_unit": int(row["days_per_unit"]) or None})
+            updated += 1
+    if updated:
+        bump_index_version("catalog")
+    db.session.commit()
+    print(f"✅ Updated {updated} medicines")
+    if unknown:
+        print("⚠ Unknown medicines: " + ", ".join(unknown))
+
+@app.cli.command("assign-tax-classes")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def assign_tax_classes_command(path):
+    """Set medicines' GST classes (GST0, GST5, GST12, GST18, GST28) from a CSV with medicine,tax_class columns."""
+    create_tables()
+    assigned, unknown = assign_tax_classes_csv(path)
+    print(f"✅ Assigned {assigned} tax classes")
+    if unknown:
+        print("⚠ Unknown medicines/classes: " + ", ".join(unknown))
+
+@app.cli.command("tax-report")
+@click.option("--from", "start", help="First day, YYYY-MM-DD.")
+@click.option("--to", "end", help="Last day, YYYY-MM-DD.")
+def tax_report_command(start, end):
+    """Print GST collected per rate, from the breakdowns stored on order lines."""
+    create_tables()
+    start, end = parse_statement_range(start, end)
+    print(f"{'Rate':>6} {'Lines':>7} {'Taxable':>14} {'CGST':>12} {'SGST':>12}")
+    for rate_bp, taxable, cgst, sgst, count in tax_summary(start, end):
+        print(f"{rate_bp / 100:>5g}% {count:>7} {taxable / 100:>14.2f} {cgst / 100:>12.2f} {sgst / 100:>12.2f}")
+
+@app.cli.command("open-slots")
+@click.option("--zone", required=True, help="Delivery zone, e.g. a store or area name.")
+@click.option("--days", default=7, help="Open slots for this many days from today.")
+@click.option("--windows", default="09-11,14-16,18-20", help="Daily windows as start-end hours, store local time.")
+@click.option("--capacity", default=50, help="Deliveries per slot.")
+def open_slots_command(zone, days, windows, capacity):
+    """Create delivery slots for ZONE; slots that already exist are left alone.
+
+    Windows are hours of the store's local day (STORE_TIMEZONE), stored in UTC.
+    """
+    create_tables()
+    today = datetime.now(STORE_TZ).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    rows = [{"zone": zone, "starts_at": from_store_time(today + timedelta(days=d, hours=start)),
+             "ends_at": from_store_time(today + timedelta(days=d, hours=end)), "capacity": capacity, "booked": 0}
+            for d in range(days) for start, end in parse_slot_windows(windows)]
+    db.session.execute(sqlite_insert(DeliverySlot).values(rows).on_conflict_do_nothing())
+    db.session.commit()
+    print(f"✅ Opened {len(rows)} slots for {zone}")
+
 # ----------------------- MAIN -----------------------
 if __name__ == "__main__":
     with app.app_context():
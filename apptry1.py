@@ -772,7 +772,7 @@ a:hover {
 
     <div class="product-item">
 
-        <img src="Atom.jpg" alt="Atom Protein Powder">
+        <img src="Atom.jpg" alt="Atom Protein Powder" loading="lazy" decoding="async">
 
         <p class="product-name">Atom Protein Powder</p>
 
@@ -792,7 +792,7 @@ a:hover {
 
     <div class="product-item">
 
-        <img src="Cyrup.webp" alt="Cyrup Syrup">
+        <img src="Cyrup.webp" alt="Cyrup Syrup" loading="lazy" decoding="async">
 
         <p class="product-name">Cyrup Syrup</p>
 
@@ -812,7 +812,7 @@ a:hover {
 
     <div class="product-item">
 
-        <img src="Everherb .png" alt="Aloevera Juice">
+        <img src="Everherb .png" alt="Aloevera Juice" loading="lazy" decoding="async">
 
         <p class="product-name">Aloevera Juice</p>
 
@@ -832,7 +832,7 @@ a:hover {
 
     <div class="product-item">
 
-        <img src="Atom.jpg" alt="Atom Mass Gainer">
+        <img src="Atom.jpg" alt="Atom Mass Gainer" loading="lazy" decoding="async">
 
         <p class="product-name">Atom Mass Gainer</p>
 
@@ -852,7 +852,7 @@ a:hover {
 
     <div class="product-item">
 
-        <img src="intramuscular-injection_thumb-1-732x549-1.jpg" alt="intramuscular-injection_thumb-1-732x549-1">
+        <img src="intramuscular-injection_thumb-1-732x549-1.jpg" alt="intramuscular-injection_thumb-1-732x549-1" loading="lazy" decoding="async">
 
         <p class="product-name">intramuscular-injection_thumb-1-732x549-1</p>
 
@@ -872,7 +872,7 @@ a:hover {
 
     <div class="product-item">
 
-        <img src="Ipca Acne.png" alt="Ipca Acne">
+        <img src="Ipca Acne.png" alt="Ipca Acne" loading="lazy" decoding="async">
 
         <p class="product-name">Ipca Acne</p>
 
@@ -892,7 +892,7 @@ a:hover {
 
     <div class="product-item">
 
-        <img src="kevinanabolic-1800x1800-1--500x500.webp" alt="Anabolic Mass Gainer">
+        <img src="kevinanabolic-1800x1800-1--500x500.webp" alt="Anabolic Mass Gainer" loading="lazy" decoding="async">
 
         <p class="product-name">Anabolic Mass Gainer</p>
 
@@ -912,7 +912,7 @@ a:hover {
 
     <div class="product-item">
 
-        <img src="Medicine.png" alt="Peraceta">
+        <img src="Medicine.png" alt="Peraceta" loading="lazy" decoding="async">
 
         <p class="product-name">Peraceta</p>
 
@@ -932,7 +932,7 @@ a:hover {
 
     <div class="product-item">
 
-        <img src="Men'S Diabetic.png" alt="Men'S Diabestic Sleepers">
+        <img src="Men'S Diabetic.png" alt="Men'S Diabestic Sleepers" loading="lazy" decoding="async">
 
         <p class="product-name">Men'S Diabestic Sleepers</p>
 
@@ -952,7 +952,7 @@ a:hover {
 
     <div class="product-item">
 
-        <img src="Neurobion.png" alt="Neurobion">
+        <img src="Neurobion.png" alt="Neurobion" loading="lazy" decoding="async">
 
         <p class="product-name">Neurobion</p>
 
@@ -972,7 +972,7 @@ a:hover {
 
     <div class="product-item">
 
-        <img src="ylfuylfxrh0cvzrxopf3.avif" alt="Saridon">
+        <img src="ylfuylfxrh0cvzrxopf3.avif" alt="Saridon" loading="lazy" decoding="async">
 
         <p class="product-name">Saridon</p>
 